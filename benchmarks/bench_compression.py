@@ -0,0 +1,113 @@
+# coding: utf-8
+"""
+Compression ratio versus CPU cost per codec and payload.
+
+Usage::
+
+    python benchmarks/bench_compression.py [--levels 1 6 9]
+
+For every installed codec (``zlib`` always; ``zstd``/``lz4`` if their
+packages are installed), level and payload (JSON dicts, DataFrames if
+pandas is installed, and small device-state messages with and without a
+shared dictionary), prints the compressed size relative to the original
+and the compression/decompression throughput in MB/s of input.
+"""
+import argparse
+import json
+import random
+import time
+
+from paho_mqtt_helpers import codec
+from paho_mqtt_helpers.compression import (available, build_dictionary,
+                                           Compressor, Decompressor)
+
+
+def _timeit(func, number: int) -> float:
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - start) / number
+
+
+def _state_messages(count: int) -> list:
+    rng = random.Random(0)
+    return [json.dumps({'device': f'pump-{rng.randint(0, 9)}',
+                        'state': rng.choice(['on', 'off', 'error']),
+                        'temperature': round(rng.uniform(20, 30), 2),
+                        'pressure': round(rng.uniform(0, 2), 3),
+                        'sequence': i}).encode('utf-8')
+            for i in range(count)]
+
+
+def _payloads():
+    rng = random.Random(1)
+    for n_keys in (100, 10000):
+        yield f'dict-{n_keys}', codec.encode(
+            {f'key{i}': [rng.random(), i, f'value{i}']
+             for i in range(n_keys)}).encode('utf-8')
+    try:
+        import numpy as np
+        import pandas as pd
+    except ImportError:
+        return
+    for n_rows in (1000, 100000):
+        frame = pd.DataFrame({'a': np.random.RandomState(n_rows)
+                              .rand(n_rows),
+                              'b': np.arange(n_rows) % 100})
+        yield f'frame-{n_rows}', codec.encode(frame).encode('utf-8')
+
+
+def measure(compressor: Compressor, decompressor: Decompressor,
+            data: bytes) -> dict:
+    number = max(1, int(2e6 // len(data)))
+    compressed = compressor.compress(data)
+    compress_s = _timeit(lambda: compressor.compress(data), number)
+    if compressed is data:
+        decompress_s = float('nan')
+    else:
+        decompress_s = _timeit(lambda: decompressor.decompress(
+            compressed[1:]), number)
+    return {'ratio': round(len(compressed) / len(data), 3),
+            'compress_mb_s': round(len(data) / compress_s / 1e6, 1),
+            'decompress_mb_s': round(len(data) / decompress_s / 1e6, 1)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--levels', type=int, nargs='+')
+    args = parser.parse_args()
+
+    decompressor = Decompressor()
+    codecs = available()
+    for name, data in _payloads():
+        for codec_ in codecs:
+            for level in args.levels or [None]:
+                compressor = Compressor(codec_, threshold=0, level=level)
+                print(dict(payload=name, size=len(data), codec=codec_,
+                           level=level,
+                           **measure(compressor, decompressor, data)))
+
+    # Small repetitive messages: shared dictionary versus none.
+    messages = _state_messages(2000)
+    training, test = messages[:1000], messages[1000:]
+    for codec_ in codecs:
+        if codec_ == 'lz4':
+            continue
+        dictionary = build_dictionary(training, size=4096, codec=codec_)
+        decompressor.add_dictionary(dictionary)
+        for mode, compressor in (
+                ('plain', Compressor(codec_, threshold=0)),
+                ('dictionary', Compressor(codec_, threshold=0,
+                                          dictionary=dictionary))):
+            size = sum(len(message) for message in test)
+            compressed = sum(len(compressor.compress(message))
+                             for message in test)
+            seconds = _timeit(lambda: [compressor.compress(message)
+                                       for message in test], 5)
+            print(dict(payload='state-messages', codec=codec_, mode=mode,
+                       ratio=round(compressed / size, 3),
+                       compress_mb_s=round(size / seconds / 1e6, 1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# coding: utf-8
+"""
+Drive many MQTT clients from one :class:`MqttSelectorEngine` thread.
+
+Usage::
+
+    python benchmarks/bench_engine.py --clients 500 --seconds 5
+
+Each client subscribes to its own topic and publishes to it in a loop; the
+benchmark reports connect time, message throughput and the number of
+threads in use, for the selector engine and (with ``--threads``) for the
+thread-per-client ``loop_start()`` baseline.
+"""
+import argparse
+import resource
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from paho_mqtt_helpers.broker import FakeBroker
+from paho_mqtt_helpers.engine import MqttSelectorEngine
+
+
+def _raise_fd_limit(n: int) -> None:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = min(max(soft, 4 * n + 64), hard)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+
+def run(n_clients: int, seconds: float, port: int, threads: bool) -> dict:
+    connected = threading.Semaphore(0)
+    received = [0]
+
+    def on_connect(client, userdata, flags, rc):
+        client.subscribe(f'bench/{userdata}')
+        connected.release()
+
+    def on_message(client, userdata, msg):
+        received[0] += 1
+        client.publish(msg.topic, msg.payload)
+
+    engine = None if threads else MqttSelectorEngine()
+    engine_thread = None
+    if engine is not None:
+        engine_thread = threading.Thread(target=engine.run_forever,
+                                         daemon=True)
+        engine_thread.start()
+
+    clients = []
+    start = time.perf_counter()
+    for i in range(n_clients):
+        client = mqtt.Client(client_id=f'bench-{i}', userdata=i)
+        client.on_connect = on_connect
+        client.on_message = on_message
+        client.connect('127.0.0.1', port, keepalive=5)
+        if engine is not None:
+            engine.add(client)
+        else:
+            client.loop_start()
+        clients.append(client)
+    for _ in range(n_clients):
+        connected.acquire()
+    connect_time = time.perf_counter() - start
+
+    for i, client in enumerate(clients):
+        client.publish(f'bench/{i}', b'x' * 32)
+    time.sleep(1.0)  # Warm up.
+    before = received[0]
+    time.sleep(seconds)
+    rate = (received[0] - before) / seconds
+    thread_count = threading.active_count()
+
+    if engine is not None:
+        engine.stop()
+        engine_thread.join()
+        engine.close()
+    for client in clients:
+        if engine is None:
+            client.loop_stop()
+        client.disconnect()
+    return {'mode': 'threads' if threads else 'engine',
+            'clients': n_clients,
+            'connect_s': round(connect_time, 3),
+            'msgs_per_s': round(rate, 1),
+            'threads': thread_count}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--threads', action='store_true',
+                        help='Also run the thread-per-client baseline.')
+    args = parser.parse_args()
+
+    _raise_fd_limit(args.clients)
+    broker = FakeBroker().start()
+    try:
+        print(run(args.clients, args.seconds, broker.port, threads=False))
+        if args.threads:
+            print(run(args.clients, args.seconds, broker.port, threads=True))
+    finally:
+        broker.stop()
+
+
+if __name__ == '__main__':
+    main()
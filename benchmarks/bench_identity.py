@@ -0,0 +1,61 @@
+# coding: utf-8
+"""
+Cost per call of the plugin identity properties and topic builder.
+
+Usage::
+
+    python benchmarks/bench_identity.py
+
+Compares the cached ``plugin_path``/``plugin_name``/``url_safe_plugin_name``
+/``client_id``/``plugin_topic()`` accessors with recomputing them from
+scratch (``inspect.getfile`` + ``os.path.realpath``) on every call.
+"""
+import datetime
+import inspect
+import os
+import timeit
+import urllib.parse
+
+from paho_mqtt_helpers import BaseMqttReactor
+
+
+class BenchReactor(BaseMqttReactor):
+    def listen(self) -> None:
+        pass
+
+
+def _uncached_plugin_path(reactor) -> str:
+    return os.path.dirname(os.path.realpath(inspect.getfile(
+        reactor.__class__)))
+
+
+def _uncached_reply_topic(reactor) -> str:
+    name = urllib.parse.quote_plus(os.path.basename(
+        _uncached_plugin_path(reactor)))
+    return f"microdrop/{name}/reply"
+
+
+def _uncached_client_id(reactor) -> str:
+    path = _uncached_plugin_path(reactor)
+    name = urllib.parse.quote_plus(os.path.basename(path))
+    return f"{name}>>{path}>>" \
+           f"{datetime.datetime.now().isoformat().replace('>>', '')}"
+
+
+def main(number: int = 100000) -> None:
+    reactor = BenchReactor()
+    cases = {
+        'plugin_path (uncached)': lambda: _uncached_plugin_path(reactor),
+        'plugin_path': lambda: reactor.plugin_path,
+        'client_id (uncached)': lambda: _uncached_client_id(reactor),
+        'client_id': lambda: reactor.client_id,
+        'reply topic (uncached)': lambda: _uncached_reply_topic(reactor),
+        "plugin_topic('reply')": lambda: reactor.plugin_topic('reply'),
+    }
+    for name, func in cases.items():
+        seconds = min(timeit.repeat(func, number=number, repeat=3))
+        print(f'{name:<28} {seconds / number * 1e9:10.1f} ns/call')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# coding: utf-8
+"""
+Track the cold-start cost of ``import paho_mqtt_helpers``.
+
+Usage::
+
+    python benchmarks/bench_import.py [--runs 5] [--top 15] [--json out.json]
+
+Runs ``python -X importtime -c "import paho_mqtt_helpers"`` in fresh
+interpreters, reports the median cumulative import time and the slowest
+top-level imports, and flags whether pandas was pulled in (it should only
+load once a pandas payload is encoded or decoded).
+"""
+import argparse
+import json
+import re
+import statistics
+import subprocess
+import sys
+
+_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+
+def import_times(module: str) -> dict:
+    """Cumulative import time (µs) per module, from ``-X importtime``."""
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        check=True, stderr=subprocess.PIPE, universal_newlines=True).stderr
+    times = {}
+    for line in output.splitlines():
+        match = _LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            times[name] = {'self_us': int(self_us),
+                           'cumulative_us': int(cumulative_us),
+                           'depth': len(indent) // 2}
+    return times
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--module', default='paho_mqtt_helpers')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--json', help='Write results to this file.')
+    args = parser.parse_args()
+
+    runs = [import_times(args.module) for _ in range(args.runs)]
+    totals = [run[args.module]['cumulative_us'] for run in runs]
+    last = runs[-1]
+    top_level = sorted(((name, info['cumulative_us'])
+                        for name, info in last.items()
+                        if info['depth'] == 1 and name != args.module),
+                       key=lambda item: -item[1])[:args.top]
+    result = {'module': args.module,
+              'median_ms': statistics.median(totals) / 1e3,
+              'runs_ms': [t / 1e3 for t in totals],
+              'pandas_imported': 'pandas' in last,
+              'top_imports_ms': {name: us / 1e3 for name, us in top_level}}
+
+    print(f"{args.module}: {result['median_ms']:.1f} ms median cumulative "
+          f"import time ({args.runs} runs); pandas imported: "
+          f"{result['pandas_imported']}")
+    for name, ms in result['top_imports_ms'].items():
+        print(f'  {ms:8.1f} ms  {name}')
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(result, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
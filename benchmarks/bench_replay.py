@@ -0,0 +1,95 @@
+# coding: utf-8
+"""
+Replay a recorded traffic log into a reactor as a repeatable benchmark.
+
+Usage::
+
+    python benchmarks/bench_replay.py capture/ --reactor my_plugin:MyReactor
+    python benchmarks/bench_replay.py capture/ --speed 10 --through-broker
+
+Record the log with ``reactor.enable_recording('capture/')``.  By default
+messages are passed straight to ``on_message`` as fast as possible, which
+measures the dispatch, decode and handler cost of the captured traffic.
+``--reactor`` (``module:Class``) replays into the plugin that received it;
+without it, a reactor with one catch-all route and a no-op handler is used.
+``--through-broker`` publishes the messages through an in-process
+:class:`~paho_mqtt_helpers.broker.FakeBroker` to a subscribed reactor.
+"""
+import argparse
+import importlib
+import threading
+import time
+
+from paho_mqtt_helpers import BaseMqttReactor
+from paho_mqtt_helpers.broker import FakeBroker
+from paho_mqtt_helpers.recording import TrafficLog, replay
+
+
+class SinkReactor(BaseMqttReactor):
+    def __init__(self, **kwargs) -> None:
+        self.received = 0
+        super().__init__(**kwargs)
+        self.listen()
+
+    def listen(self) -> None:
+        self.addGetRoute('{topic:any}', self.on_any)
+
+    def subscribe(self) -> None:
+        self.mqtt_client.subscribe('#')
+
+    def on_any(self, payload, args) -> None:
+        self.received += 1
+
+
+class SenderReactor(BaseMqttReactor):
+    def listen(self) -> None:
+        pass
+
+
+def _reactor_class(spec: str):
+    module, name = spec.split(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('log', help='Traffic log directory.')
+    parser.add_argument('--reactor', help='Reactor class (module:Class).')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='Speed relative to the recording; 0 (default) '
+                        'for as fast as possible.')
+    parser.add_argument('--through-broker', action='store_true')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    cls = _reactor_class(args.reactor) if args.reactor else SinkReactor
+    log = TrafficLog(args.log)
+    if not args.through_broker:
+        reactor = cls()
+        reactor.listen()
+        for _ in range(args.repeat):
+            print(replay(log, reactor, speed=args.speed))
+        return
+
+    with FakeBroker() as broker:
+        receiver = cls(port=broker.port)
+        sender = SenderReactor(port=broker.port)
+        threads = []
+        for reactor in (receiver, sender):
+            reactor._connect()
+            thread = threading.Thread(target=reactor.mqtt_client.loop_forever,
+                                      daemon=True)
+            thread.start()
+            threads.append(thread)
+        # Wait for the receiver's subscriptions.
+        time.sleep(1)
+        for _ in range(args.repeat):
+            print(replay(log, sender, speed=args.speed, through_broker=True))
+        for reactor, thread in zip((receiver, sender), threads):
+            reactor.should_exit = True
+            reactor.mqtt_client.disconnect()
+            thread.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+# coding: utf-8
+"""
+Shared-memory handoff bandwidth versus memcpy.
+
+Usage::
+
+    python benchmarks/bench_sharedmem.py [--mb 100]
+
+Times exporting an array (or DataFrame) into a shared memory segment and
+attaching it on the receiving side (what ``sendMessage(...,
+shared_memory=True)`` and ``on_message`` do, minus the small descriptor
+message), against a plain ``numpy.copyto`` of the same data.
+"""
+import argparse
+import gc
+import time
+
+import numpy as np
+import pandas as pd
+
+from paho_mqtt_helpers.sharedmem import SharedMemoryStore
+
+
+def _best(func, repeat: int = 5) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+        gc.collect()
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--mb', type=int, default=100)
+    args = parser.parse_args()
+
+    n = args.mb * (1 << 20) // 8
+    array = np.random.RandomState(0).rand(n)
+    frame = pd.DataFrame(array.reshape(-1, 4), columns=list('abcd'))
+    sender = SharedMemoryStore(lease=0)
+    receiver = SharedMemoryStore()
+    target = np.empty_like(array)
+
+    results = {'memcpy': _best(lambda: np.copyto(target, array))}
+    for name, obj in (('ndarray', array), ('DataFrame', frame)):
+        results[f'{name}-handoff'] = _best(
+            lambda: receiver.attach(sender.export(obj)[1:]))
+    sender.close()
+    for name, seconds in results.items():
+        print(f'{name:<20} {array.nbytes / seconds / 1e6:10.1f} MB/s')
+
+
+if __name__ == '__main__':
+    main()
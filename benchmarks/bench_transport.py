@@ -0,0 +1,85 @@
+# coding: utf-8
+"""
+Compare round-trip latency of the reactor transport profiles.
+
+Usage::
+
+    python benchmarks/bench_transport.py --count 5000
+
+A client subscribes to a topic and publishes to it again as soon as each
+message comes back, so every sample is one publish -> broker -> deliver
+round trip.  Reported per profile: p50/p99 latency in microseconds.
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from paho_mqtt_helpers.broker import FakeBroker
+from paho_mqtt_helpers.transport import (DEFAULT_TCP, LOW_LATENCY_TCP,
+                                         UnixSocketProfile)
+
+
+def measure(profile, port: int, count: int, payload_size: int) -> dict:
+    samples = []
+    done = threading.Event()
+    payload = b'x' * payload_size
+    sent = [0.0]
+
+    def on_connect(client, userdata, flags, rc):
+        client.subscribe('bench/rtt')
+
+    def on_subscribe(client, userdata, mid, granted_qos):
+        sent[0] = time.perf_counter()
+        client.publish('bench/rtt', payload)
+
+    def on_message(client, userdata, msg):
+        samples.append(time.perf_counter() - sent[0])
+        if len(samples) >= count:
+            done.set()
+            return
+        sent[0] = time.perf_counter()
+        client.publish('bench/rtt', payload)
+
+    client = profile.create_client(client_id='bench-rtt')
+    client.on_connect = on_connect
+    client.on_subscribe = on_subscribe
+    client.on_message = on_message
+    client.connect('127.0.0.1', port)
+    thread = threading.Thread(target=client.loop_forever,
+                              kwargs={'timeout': profile.loop_timeout},
+                              daemon=True)
+    thread.start()
+    done.wait()
+    client.disconnect()
+    thread.join()
+
+    samples.sort()
+    return {'p50_us': round(samples[len(samples) // 2] * 1e6, 1),
+            'p99_us': round(samples[int(len(samples) * .99)] * 1e6, 1)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--count', type=int, default=5000)
+    parser.add_argument('--payload-size', type=int, default=64)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'mqtt.sock')
+        broker = FakeBroker(path=path).start()
+        profiles = {'tcp': DEFAULT_TCP,
+                    'tcp-low-latency': LOW_LATENCY_TCP,
+                    'unix': UnixSocketProfile(path)}
+        try:
+            for name, profile in profiles.items():
+                result = measure(profile, broker.port, args.count,
+                                 args.payload_size)
+                print(dict(profile=name, **result))
+        finally:
+            broker.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+# coding: utf-8
+"""
+Pinned benchmark scenarios for :class:`paho_mqtt_helpers.BaseMqttReactor`.
+
+Usage::
+
+    python benchmarks/suite.py --output results.json
+    python benchmarks/suite.py --baseline results.json [--threshold 0.1]
+    python benchmarks/suite.py --only dispatch encode
+
+Scenarios (all hermetic, network scenarios use the in-process
+:class:`~paho_mqtt_helpers.broker.FakeBroker`):
+
+- ``dispatch``: ``on_message`` throughput versus number of routes;
+- ``encode``/``decode``: codec throughput versus payload size, for dicts
+  and (if pandas is installed) DataFrames;
+- ``publish``: ``sendMessage`` rate at QoS 0 and QoS 1;
+- ``reconnect``: time from disconnect until the reactor is connected
+  again and every subscription of a large route table is acknowledged.
+
+Every result is a rate (higher is better) or a duration (lower is better);
+``--baseline`` prints the relative change against a stored run and exits
+non-zero if any metric regressed by more than ``--threshold``.
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import threading
+import time
+
+import paho.mqtt
+import paho.mqtt.client as mqtt
+
+from paho_mqtt_helpers import BaseMqttReactor, codec
+from paho_mqtt_helpers.broker import FakeBroker
+
+ROUTE_COUNTS = (10, 100, 1000)
+DICT_SIZES = (10, 1000, 100000)
+FRAME_ROWS = (100, 10000, 100000)
+SUBSCRIPTION_COUNTS = (100, 1000)
+PUBLISH_COUNT = 20000
+# Seconds to wait for acknowledgements before a scenario fails.
+TIMEOUT = 60.
+
+
+class BenchReactor(BaseMqttReactor):
+    def __init__(self, routes: int = 0, **kwargs) -> None:
+        self.n_routes = routes
+        self.received = 0
+        super().__init__(**kwargs)
+        self.listen()
+
+    def listen(self) -> None:
+        for i in range(self.n_routes):
+            self.addGetRoute(f'bench/{i}/{{value}}', self.on_value)
+
+    def on_value(self, payload, args) -> None:
+        self.received += 1
+
+
+def _timeit(func, repeat: int = 3) -> float:
+    """Best wall time of ``repeat`` calls to ``func``."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _message(topic: str, payload: bytes) -> mqtt.MQTTMessage:
+    message = mqtt.MQTTMessage(topic=topic.encode('utf-8'))
+    message.payload = payload
+    return message
+
+
+def _make_dict(n_keys: int) -> dict:
+    rng = random.Random(n_keys)
+    return {f'key{i}': [rng.random(), i, f'value{i}'] for i in range(n_keys)}
+
+
+def _make_frame(n_rows: int):
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.RandomState(n_rows)
+    return pd.DataFrame({'a': rng.rand(n_rows), 'b': rng.randint(0, 100,
+                                                                n_rows),
+                         'c': rng.rand(n_rows)})
+
+
+def _payloads():
+    for n_keys in DICT_SIZES:
+        yield f'dict-{n_keys}', _make_dict(n_keys)
+    try:
+        import pandas  # noqa: F401
+    except ImportError:
+        return
+    for n_rows in FRAME_ROWS:
+        yield f'frame-{n_rows}', _make_frame(n_rows)
+
+
+###############################################################################
+# Scenarios
+# =========
+def bench_dispatch() -> dict:
+    results = {}
+    n_messages = 20000
+    for n_routes in ROUTE_COUNTS:
+        reactor = BenchReactor(routes=n_routes)
+        messages = [_message(f'bench/{i % n_routes}/x', b'{"value": 1}')
+                    for i in range(n_messages)]
+
+        def run():
+            for message in messages:
+                reactor.on_message(None, None, message)
+
+        results[f'routes-{n_routes}.msgs_per_s'] = n_messages / _timeit(run)
+    return results
+
+
+def bench_encode() -> dict:
+    results = {}
+    for name, payload in _payloads():
+        size = len(codec.encode(payload))
+        seconds = _timeit(lambda: codec.encode(payload))
+        results[f'{name}.mb_per_s'] = size / seconds / 1e6
+    return results
+
+
+def bench_decode() -> dict:
+    results = {}
+    for name, payload in _payloads():
+        data = codec.encode(payload).encode('utf-8')
+        seconds = _timeit(lambda: codec.decode(data))
+        results[f'{name}.mb_per_s'] = len(data) / seconds / 1e6
+    return results
+
+
+def _acquire(semaphore: threading.Semaphore, count: int, what: str) -> None:
+    end = time.monotonic() + TIMEOUT
+    for _ in range(count):
+        if not semaphore.acquire(timeout=max(end - time.monotonic(), 0)):
+            raise RuntimeError(f'Timed out waiting for {what}.')
+
+
+def _start(reactor: BaseMqttReactor) -> None:
+    # The reactor's ``on_disconnect`` reconnects (or exits the process);
+    # the benchmarks disconnect on purpose.
+    reactor.mqtt_client.on_disconnect = None
+    if not reactor._connect():
+        raise RuntimeError('Error connecting to the broker.')
+    reactor.mqtt_client.loop_start()
+
+
+def _stop(reactor: BaseMqttReactor) -> None:
+    reactor.mqtt_client.disconnect()
+    reactor.mqtt_client.loop_stop()
+
+
+def bench_publish(broker: FakeBroker) -> dict:
+    results = {}
+    payload = _make_dict(10)
+    for qos in (0, 1):
+        reactor = BenchReactor(port=broker.port)
+        published = threading.Semaphore(0)
+        reactor.mqtt_client.on_publish = lambda *args: published.release()
+        _start(reactor)
+
+        start = time.perf_counter()
+        for i in range(PUBLISH_COUNT):
+            reactor.sendMessage('bench/publish', payload, qos=qos)
+        _acquire(published, PUBLISH_COUNT, 'publishes')
+        seconds = time.perf_counter() - start
+        _stop(reactor)
+        results[f'qos{qos}.msgs_per_s'] = PUBLISH_COUNT / seconds
+    return results
+
+
+def bench_reconnect(broker: FakeBroker) -> dict:
+    results = {}
+    for n_routes in SUBSCRIPTION_COUNTS:
+        reactor = BenchReactor(routes=n_routes, port=broker.port)
+        subscribed = threading.Semaphore(0)
+        reactor.mqtt_client.on_subscribe = \
+            lambda *args: subscribed.release()
+        # Subscriptions sent by ``on_connect``, which adds routes of its own
+        # before subscribing.
+        n_subscriptions = []
+        connected = threading.Semaphore(0)
+        subscribe = reactor.subscribe
+
+        def counting_subscribe():
+            n_subscriptions.append(len(reactor.subscriptions))
+            subscribe()
+            connected.release()
+
+        reactor.subscribe = counting_subscribe
+
+        def wait_subscribed():
+            _acquire(connected, 1, 'connection')
+            _acquire(subscribed, n_subscriptions[-1], 'subscriptions')
+
+        _start(reactor)
+        wait_subscribed()
+
+        start = time.perf_counter()
+        _stop(reactor)
+        _start(reactor)
+        wait_subscribed()
+        results[f'routes-{n_routes}.seconds'] = time.perf_counter() - start
+        _stop(reactor)
+    return results
+
+
+SCENARIOS = {'dispatch': bench_dispatch,
+             'encode': bench_encode,
+             'decode': bench_decode,
+             'publish': bench_publish,
+             'reconnect': bench_reconnect}
+NETWORK_SCENARIOS = {'publish', 'reconnect'}
+
+
+###############################################################################
+# Runner
+# ======
+def run(names) -> dict:
+    results = {'meta': {'python': sys.version.split()[0],
+                        'platform': platform.platform(),
+                        'paho-mqtt': paho.mqtt.__version__,
+                        'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+               'results': {}}
+    broker = None
+    if NETWORK_SCENARIOS.intersection(names):
+        broker = FakeBroker().start()
+    try:
+        for name in names:
+            func = SCENARIOS[name]
+            args = (broker, ) if name in NETWORK_SCENARIOS else ()
+            scenario_results = func(*args)
+            if not scenario_results:
+                raise RuntimeError(f'Scenario {name} returned no results.')
+            for key, value in scenario_results.items():
+                results['results'][f'{name}.{key}'] = value
+                print(f'{name}.{key:<36} {value:14.3f}')
+    finally:
+        if broker is not None:
+            broker.stop()
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    """Print relative change per metric; ``False`` if any regressed."""
+    ok = True
+    for key, value in results['results'].items():
+        if key not in baseline['results']:
+            continue
+        reference = baseline['results'][key]
+        change = (value - reference) / reference
+        # Durations improve when they go down, rates when they go up.
+        improvement = -change if key.endswith('.seconds') else change
+        regressed = improvement < -threshold
+        ok &= not regressed
+        print(f"{key:<46} {change:+8.1%}{'  REGRESSION' if regressed else ''}")
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--only', nargs='+', choices=sorted(SCENARIOS),
+                        default=list(SCENARIOS))
+    parser.add_argument('--output', help='Write results as JSON.')
+    parser.add_argument('--baseline', help='Compare against stored JSON.')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Allowed relative regression (default: 0.1).')
+    args = parser.parse_args()
+
+    results = run(args.only)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as input_:
+            baseline = json.load(input_)
+        if not compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,48 +1,178 @@
 # coding: utf-8
 import datetime
 import inspect
-import json
 import logging
 import os
 import re
 import signal
 import socket
+import struct
 import sys
+import threading
+import time
+import urllib.parse
 
 import paho.mqtt.client as mqtt
 
-from typing import Callable, Any
+from typing import TYPE_CHECKING, Callable, Any
 from mqtt_messages import MqttMessages
-from pandas_helpers import pandas_object_hook, PandasJsonEncoder
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 from wheezy.routing import PathRouter
+from wheezy.routing.utils import route_name
 
+from . import codec, envelope
+from .blobs import BlobStore, MISSING, STORES
+from .chunking import ChunkSender, Reassembler
+from .codec import pandas_object_hook, PandasJsonEncoder, pre_encode
+from .compression import Compressor, Decompressor
+from .delta import DeltaCodec
+from .engine import MqttSelectorEngine, TimerWheel
+from .envelope import EnvelopeStamper, SequenceTracker
+from .metrics import MetricsRegistry, PeriodicTask, PhaseStats
+from .routes import Route
+from .transport import (TransportProfile, TcpProfile, UnixSocketProfile,
+                        DEFAULT_TCP, LOW_LATENCY_TCP)
 from ._version import get_versions
 
+if TYPE_CHECKING:
+    # Feature modules are imported by the methods enabling them.
+    from .dedup import PublishDeduplicator
+    from .mirror import StateMirror
+    from .profiling import RemoteProfiler
+    from .recording import Recorder
+    from .tracing import Trace, Tracer
+    from .watchdog import HandlerWatchdog
+
 __version__ = get_versions()['version']
 del get_versions
 
 logger = logging.getLogger(__name__)
 
+#: Seconds before the first reconnection attempt of a reactor run by an
+#: engine, doubled after each failed attempt up to ``MAX_RECONNECT_DELAY``.
+RECONNECT_DELAY = 1.
+MAX_RECONNECT_DELAY = 60.
+#: Seconds between checks for messages waiting too long for their blob.
+BLOB_EXPIRY_INTERVAL = 1.
+#: Seconds between removals of old disk blobs (see :meth:`BlobStore.clean`).
+BLOB_CLEAN_INTERVAL = 60.
+#: Seconds between checks for stalled incoming chunked transfers.
+CHUNK_EXPIRY_INTERVAL = 1.
+
 
 class BaseMqttReactor(MqttMessages):
     """
     Base class for MQTT-based plugins.
     """
+    # Plugin identity, computed on first access.
+    _plugin_path = None
+    _plugin_name = None
+    _url_safe_plugin_name = None
+    _client_id = None
 
     def __init__(self, host: str = 'localhost', port: int = 1883,
-                 keepalive: int = 60, base: str = "microdrop") -> None:
+                 keepalive: int = 60, base: str = "microdrop",
+                 transport: TransportProfile = None,
+                 persistent_session: bool = False, instance_key: str = None,
+                 protocol: int = mqtt.MQTTv311,
+                 session_expiry: int = 3600) -> None:
+        """
+        Parameters
+        ----------
+        transport : TransportProfile, optional
+            How to reach the broker (e.g., :data:`LOW_LATENCY_TCP` or a
+            :class:`UnixSocketProfile`).  Defaults to plain TCP.
+        persistent_session : bool
+            Connect with a stable client ID (see :attr:`client_id`) and ask
+            the broker to keep the session, so subscriptions and queued QoS 1
+            messages survive restarts.
+        instance_key : str, optional
+            Distinguishes several instances of the same plugin in
+            persistent-session mode.  Defaults to the host name.
+        protocol : int
+            ``paho.mqtt.client.MQTTv311`` or ``MQTTv5``.
+        session_expiry : int
+            MQTT 5 session expiry interval (seconds) in persistent-session
+            mode.
+        """
         super().__init__()
         self._host = host
         self._port = port
         self._keepalive = keepalive
-        self.mqtt_client = mqtt.Client(client_id=self.client_id)
+        self.persistent_session = persistent_session
+        self.instance_key = instance_key or socket.gethostname()
+        self.protocol = protocol
+        self.session_expiry = session_expiry
+        self.transport = transport or DEFAULT_TCP
+        if protocol == mqtt.MQTTv5:
+            # MQTT 5 uses ``clean_start`` on connect instead.
+            self.mqtt_client = self.transport.create_client(
+                client_id=self.client_id, protocol=protocol)
+        else:
+            self.mqtt_client = self.transport.create_client(
+                client_id=self.client_id, protocol=protocol,
+                clean_session=not persistent_session)
         self.mqtt_client.on_connect = self.on_connect
         self.mqtt_client.on_disconnect = self.on_disconnect
         self.mqtt_client.on_message = self.on_message
         self.should_exit = False
         self.router = PathRouter()
         self.subscriptions = []
+        # QoS 1 so the broker queues messages while a persistent session is
+        # offline.
+        self.subscription_qos = 1 if persistent_session else 0
+        # Pattern -> :class:`Route`, in registration order.
+        self._routes = {}
+        self._topic_cache = {}
         self.base = base
+        self._engine = None
+        #: Per-route :class:`MetricsRegistry` (see :meth:`enable_metrics`).
+        self.metrics = None
+        self._metrics_task = None
+        #: Sampling :class:`Tracer` (see :meth:`enable_tracing`).
+        self.tracer = None
+        #: :class:`HandlerWatchdog` (see :meth:`enable_watchdog`).
+        self.watchdog = None
+        #: :class:`EnvelopeStamper` (see :meth:`enable_envelopes`).
+        self._stamper = None
+        self._sequences = SequenceTracker()
+        #: :class:`PhaseStats` (see :meth:`enable_phase_stats`).
+        self.phase_stats = None
+        self._phase_stats_task = None
+        #: :class:`RemoteProfiler` (see :meth:`enable_profiling`).
+        self.profiler = None
+        self._profile_timer = None
+        #: Traffic :class:`Recorder` (see :meth:`enable_recording`).
+        self.recorder = None
+        #: :class:`Compressor` (see :meth:`enable_compression`).
+        self.compressor = None
+        #: Decompresses received compressed payloads, up to
+        #: ``decompressor.max_size`` bytes each; register shared
+        #: dictionaries with ``decompressor.add_dictionary()``.
+        self.decompressor = Decompressor()
+        #: :class:`ChunkSender` (see :meth:`enable_chunking`).
+        self.chunker = None
+        #: Reassembles received chunked payloads (limits are attributes).
+        self.reassembler = Reassembler()
+        self._chunks_task = None
+        #: :class:`StreamDispatcher` (see :meth:`addStreamRoute`).
+        self.streams = None
+        # :class:`SharedMemoryStore`, created on first use.
+        self._shared_memory_store = None
+        #: Resolves received blob references (see :meth:`enable_blobs`).
+        self.blobs = BlobStore(f'{base}/blobs', self._decode_blob)
+        self._blobs_task = None
+        self._blobs_clean_task = None
+        #: :class:`StateMirror` (see :meth:`enable_mirror`).
+        self.mirror = None
+        #: Rebuilds received delta-encoded states (see :meth:`enable_deltas`).
+        self.deltas = DeltaCodec(self._request_keyframe)
+        #: :class:`PublishDeduplicator` (see :meth:`enable_dedup`).
+        self.dedup = None
+        #: Encoded payloads of messages sent with ``cache=True`` (limits are
+        #: attributes).
+        self.encode_cache = codec.EncodeCache()
 
     ###########################################################################
     # Attributes
@@ -77,95 +207,955 @@ class BaseMqttReactor(MqttMessages):
     @property
     def plugin_path(self) -> str:
         """Get parent directory of class location"""
-        return os.path.dirname(os.path.realpath(inspect.getfile(self.__class__)))
+        if self._plugin_path is None:
+            self._plugin_path = os.path.dirname(
+                os.path.realpath(inspect.getfile(self.__class__)))
+        return self._plugin_path
 
     @property
     def plugin_name(self) -> str:
         """Get plugin name via the basname of the plugin path """
-        return os.path.basename(self.plugin_path)
+        if self._plugin_name is None:
+            self._plugin_name = os.path.basename(self.plugin_path)
+        return self._plugin_name
 
     @property
     def url_safe_plugin_name(self) -> str:
         """Make plugin name safe for mqtt and http requests"""
-        return moves.urllib.parse.quote_plus(self.plugin_name)
+        if self._url_safe_plugin_name is None:
+            self._url_safe_plugin_name = \
+                urllib.parse.quote_plus(self.plugin_name)
+        return self._url_safe_plugin_name
 
     @property
     def client_id(self) -> str:
-        """ ID used for mqtt client """
-        return f"{self.url_safe_plugin_name}>>{self.plugin_path}>>" \
-               f"{datetime.datetime.now().isoformat().replace('>>', '')}"
+        """
+        ID used for mqtt client (computed once per instance).
 
-    def addGetRoute(self, route: str, handler: Callable) -> None:
-        """Adds route along with corresponding subscription"""
-        self.router.add_route(route, handler)
-        # Replace characters between curly brackets with "+" wildcard
-        self.subscriptions.append(re.sub(r"\{(.+?)\}", "+", route))
+        In persistent-session mode the ID is derived from the plugin name and
+        :attr:`instance_key` only, so the broker can resume the session after
+        a restart.  Otherwise it includes the creation time.
+        """
+        if self._client_id is None:
+            if self.persistent_session:
+                self._client_id = \
+                    f"{self.url_safe_plugin_name}>>{self.instance_key}"
+            else:
+                self._client_id = \
+                    f"{self.url_safe_plugin_name}>>{self.plugin_path}>>" \
+                    f"{datetime.datetime.now().isoformat().replace('>>', '')}"
+        return self._client_id
+
+    def plugin_topic(self, *parts: str) -> str:
+        """
+        Topic under this plugin's namespace, e.g.,
+        ``plugin_topic('metrics')`` -> ``'<base>/<plugin>/metrics'``.
+
+        Joined topics are cached, so calling this per message is cheap.
+        """
+        try:
+            return self._topic_cache[parts]
+        except KeyError:
+            if len(self._topic_cache) >= 1024:
+                self._topic_cache.clear()
+            topic = '/'.join((self.base, self.url_safe_plugin_name) + parts)
+            self._topic_cache[parts] = topic
+            return topic
+
+    def addGetRoute(self, route: str, handler: Callable,
+                    slow_threshold: float = None) -> None:
+        """
+        Adds route along with corresponding subscription.
+
+        A new handler for a registered route replaces the previous one.
+        ``slow_threshold`` overrides the watchdog threshold (in seconds) for
+        this route's handler (see :meth:`enable_watchdog`).
+        """
+        self._add_route(Route(route, handler, slow_threshold))
+
+    def addStreamRoute(self, route: str, handler: Callable,
+                       records: str = None, queue_size: int = 16,
+                       timeout: float = 60.) -> None:
+        """
+        Adds a streaming route (see :mod:`paho_mqtt_helpers.streaming`).
+
+        ``handler(stream, args)`` runs on its own thread per transfer, with
+        ``stream`` iterating over the payload bytes as chunks arrive, or
+        over the JSON records under the :mod:`ijson` prefix ``records``
+        (e.g., ``'item'``).  The transfer is dropped if the handler falls
+        ``queue_size`` chunks behind, or if no chunk arrives for
+        ``timeout`` seconds.
+
+        Raises
+        ------
+        ValueError
+            If ``records`` is set but :mod:`ijson` is not installed.
+        """
+        from .streaming import StreamDispatcher, StreamRoute
+
+        if self.streams is None:
+            self.streams = StreamDispatcher(self.decompressor)
+        self._add_route(StreamRoute(route, handler, records=records,
+                                    queue_size=queue_size, timeout=timeout))
 
     def sendMessage(self, topic: str, msg: Any, retain: bool = False,
-                    qos: int = 0, dup: bool = False) -> None:
-        message = json.dumps(msg, cls=PandasJsonEncoder)
-        self.mqtt_client.publish(topic, message, retain=retain, qos=qos)
+                    qos: int = 0, dup: bool = False,
+                    shared_memory: bool = False, delta: bool = False,
+                    cache: bool = False) -> None:
+        """
+        Publish ``msg`` as JSON to ``topic``.
+
+        ``msg`` may be encoded once beforehand with :func:`pre_encode`.
+        With ``cache``, its encoding is kept in :attr:`encode_cache` for
+        later publishes of the same (unmodified) object.
+
+        With ``shared_memory``, ``msg`` (an array, DataFrame or Series) is
+        handed to receivers on the same host through a shared memory segment
+        instead (see :mod:`paho_mqtt_helpers.sharedmem`).  Large payloads
+        may be sent as blob references (see :meth:`enable_blobs`).
+
+        Identical consecutive payloads may be suppressed (see
+        :meth:`enable_dedup`).
+
+        With ``delta``, ``msg`` (a dictionary) is sent as the changes since
+        the previous ``delta`` publish on ``topic`` (see
+        :meth:`enable_deltas`).
+
+        Raises
+        ------
+        ValueError
+            If ``delta`` is set but delta encoding is not enabled, or
+            ``msg`` is not a dictionary.
+        """
+        trace = self.tracer.current() if self.tracer is not None else None
+        stats = self.phase_stats
+        if trace is not None:
+            trace.enter('publish')
+        if stats is not None:
+            stats.enter('encode')
+        try:
+            if shared_memory:
+                message = self._shared_memory().export(msg)
+            elif delta:
+                message = self.deltas.encode(topic, msg, retain=retain,
+                                             qos=qos)
+                if self.compressor is not None:
+                    message = self.compressor.compress(message)
+            else:
+                if isinstance(msg, codec.Encoded):
+                    message = msg
+                elif cache:
+                    message = self.encode_cache.encode(msg)
+                else:
+                    message = codec.encode(msg)
+                if self.compressor is not None:
+                    if isinstance(message, str):
+                        message = message.encode('utf-8')
+                    message = self.compressor.compress(message)
+                chunk_size = None if self.chunker is None \
+                    else self.chunker.chunk_size
+                if self.blobs.accepts(len(message), chunk_size):
+                    if isinstance(message, str):
+                        message = message.encode('utf-8')
+                    blob = message
+                    message, blob_topic = self.blobs.reference(blob)
+                    if blob_topic is not None:
+                        self.mqtt_client.publish(blob_topic, blob,
+                                                 retain=True, qos=1)
+            if self.dedup is not None and \
+                    self.dedup.suppress(topic, message, retain=retain,
+                                        qos=qos):
+                return
+            properties = None
+            if self._stamper is not None:
+                stamp = self._stamper.stamp(topic)
+                if self.protocol == mqtt.MQTTv5:
+                    properties = Properties(PacketTypes.PUBLISH)
+                    properties.UserProperty = (envelope.PROPERTY,
+                                               stamp.to_property())
+                else:
+                    if isinstance(message, str):
+                        message = message.encode('utf-8')
+                    message = bytes([codec.ENVELOPE]) + stamp.to_bytes() + \
+                        message
+            if self.chunker is not None and isinstance(message, str):
+                message = message.encode('utf-8')
+            if stats is not None:
+                stats.exit()
+                stats.enter('publish')
+            if self.chunker is not None and \
+                    len(message) > self.chunker.chunk_size:
+                if retain:
+                    logger.warning('Chunked message on %s is not retained.',
+                                   topic)
+                self.chunker.send(topic, message, qos=qos,
+                                  properties=properties)
+            else:
+                self.mqtt_client.publish(topic, message, retain=retain,
+                                         qos=qos, properties=properties)
+        finally:
+            if stats is not None:
+                stats.exit()
+            if trace is not None:
+                trace.exit('publish')
+
+    def enable_metrics(self,
+                       publish_interval: float = None) -> MetricsRegistry:
+        """
+        Record per-route message counts, decode/handler times, payload sizes
+        and errors in :attr:`metrics`.
+
+        Parameters
+        ----------
+        publish_interval : float, optional
+            If set, publish the metrics as JSON to
+            ``<base>/<plugin>/metrics`` every ``publish_interval`` seconds.
+        """
+        if self.metrics is None:
+            self.metrics = MetricsRegistry()
+        if publish_interval and self._metrics_task is None:
+            self._metrics_task = PeriodicTask(
+                publish_interval, self._publish_metrics,
+                name='MetricsPublisher').start()
+        return self.metrics
+
+    def enable_tracing(self, sample_rate: float = 0.01,
+                       capacity: int = 10000) -> 'Tracer':
+        """
+        Trace the ``on_message`` phases of a sample of messages.
+
+        Spans are kept in the ring buffer of :attr:`tracer`; use
+        ``tracer.dump()`` to retrieve them and ``tracer.add_hooks()`` to run
+        code before/after each traced phase.
+        """
+        from .tracing import Tracer
+
+        self.tracer = Tracer(sample_rate=sample_rate, capacity=capacity)
+        return self.tracer
+
+    def enable_watchdog(self, threshold: float = 1.0,
+                        check_interval: float = 0.1,
+                        publish_alerts: bool = False) -> 'HandlerWatchdog':
+        """
+        Report handlers running longer than ``threshold`` seconds (or their
+        route's ``slow_threshold``).
+
+        Each event is logged with the handler thread's stack, counted in
+        the route's ``slow_handlers`` metric (if metrics are enabled) and,
+        with ``publish_alerts``, published to ``<base>/<plugin>/alerts``.
+        """
+        from .watchdog import HandlerWatchdog
+
+        if self.watchdog is None:
+            self._publish_alerts = publish_alerts
+            self.watchdog = HandlerWatchdog(
+                threshold=threshold, check_interval=check_interval,
+                on_slow=self._on_slow_handler).start()
+        return self.watchdog
+
+    def enable_envelopes(self) -> None:
+        """
+        Stamp sent messages with send times and sequence numbers, and record
+        per-route end-to-end latency and sequence gaps of received enveloped
+        messages in :attr:`metrics`.
+
+        With MQTT 5 the envelope is a user property; otherwise it is a
+        binary header that receivers strip transparently (they need this
+        version of the package, but not envelopes enabled).
+        """
+        self._stamper = EnvelopeStamper(self.client_id)
+        self.enable_metrics()
+
+    def enable_compression(self, algorithm: str = 'zlib',
+                           threshold: int = 1024, level: int = None,
+                           dictionary: bytes = None) -> Compressor:
+        """
+        Compress sent payloads of at least ``threshold`` bytes (see
+        :mod:`paho_mqtt_helpers.compression`).
+
+        Receivers decompress transparently; a shared ``dictionary`` must
+        also be registered with ``decompressor.add_dictionary()`` on the
+        receiving side (it is here).
+
+        Raises
+        ------
+        ValueError
+            If ``algorithm`` (``'zlib'``, ``'zstd'`` or ``'lz4'``) is
+            unknown or its package is not installed.
+        """
+        self.compressor = Compressor(algorithm, threshold=threshold,
+                                     level=level, dictionary=dictionary)
+        if dictionary is not None:
+            self.decompressor.add_dictionary(dictionary)
+        return self.compressor
+
+    def enable_chunking(self, chunk_size: int = 256 << 10,
+                        window: int = 4) -> ChunkSender:
+        """
+        Send payloads larger than ``chunk_size`` bytes in chunks (see
+        :mod:`paho_mqtt_helpers.chunking`), at most ``window`` of them
+        queued at a time so other messages are interleaved.
+
+        Receivers reassemble chunked payloads transparently.  Chunked
+        messages are never retained.
+
+        Note that this wraps the client's ``on_publish`` callback; set any
+        other ``on_publish`` callback before calling this method.
+        """
+        if self.chunker is not None:
+            return self.chunker
+        self.chunker = chunker = ChunkSender(self.mqtt_client,
+                                             chunk_size=chunk_size,
+                                             window=window)
+        on_publish = self.mqtt_client.on_publish
+
+        def chunking_on_publish(client, userdata, mid):
+            chunker.on_publish(client, userdata, mid)
+            if on_publish is not None:
+                on_publish(client, userdata, mid)
+
+        self.mqtt_client.on_publish = chunking_on_publish
+        return chunker
+
+    def enable_blobs(self, threshold: int = 64 << 10, store: str = 'broker',
+                     directory: str = None) -> BlobStore:
+        """
+        Send encoded payloads of at least ``threshold`` bytes as references
+        to content-addressed blobs (see :mod:`paho_mqtt_helpers.blobs`),
+        stored once on the broker (retained ``<base>/blobs/<hash>``
+        topics) or, with ``store='disk'``, in ``directory`` for receivers
+        on the same host.  Disk blobs not referenced for ``blobs.max_age``
+        seconds are removed every :data:`BLOB_CLEAN_INTERVAL` seconds.
+
+        Receivers resolve references transparently, through the LRU cache
+        of :attr:`blobs`; disk blobs are read from ``blobs.directory``.
+
+        Broker blobs are at most one message: with chunking enabled (see
+        :meth:`enable_chunking`), payloads larger than the chunk size are
+        chunked instead.  Retained blobs are never removed from the broker.
+
+        Raises
+        ------
+        ValueError
+            If ``store`` is unknown.
+        """
+        if store not in STORES:
+            raise ValueError(f'Unknown blob store: {store!r} (expected one '
+                             f'of {sorted(STORES)}).')
+        self.blobs.threshold = threshold
+        self.blobs.store = STORES[store]
+        if directory is not None:
+            self.blobs.directory = directory
+        if store == 'disk' and self._blobs_clean_task is None:
+            self._blobs_clean_task = PeriodicTask(
+                BLOB_CLEAN_INTERVAL, self.blobs.clean,
+                name='BlobCleanup').start()
+        return self.blobs
+
+    def enable_mirror(self, *filters: str, max_topics: int = 10000,
+                      max_bytes: int = 64 << 20) -> 'StateMirror':
+        """
+        Subscribe to the topic ``filters`` and keep the last decoded value
+        of each matching topic (retained or not) in :attr:`mirror` (see
+        :mod:`paho_mqtt_helpers.mirror`), e.g.,
+        ``reactor.mirror.query('microdrop/+/state/#')``.
+
+        May be called again to mirror more filters; the limits are set on
+        the first call.
+        """
+        from .mirror import StateMirror
+
+        if self.mirror is None:
+            self.mirror = StateMirror(max_topics=max_topics,
+                                      max_bytes=max_bytes)
+        for filter_ in filters:
+            self.mirror.add_filter(filter_)
+            if filter_ not in self.subscriptions:
+                self.subscriptions.append(filter_)
+                if self.mqtt_client.is_connected():
+                    self.mqtt_client.subscribe(filter_,
+                                               qos=self.subscription_qos)
+        return self.mirror
+
+    def enable_deltas(self, keyframe_interval: int = 100) -> DeltaCodec:
+        """
+        Allow ``sendMessage(topic, state, delta=True)``: publish only the
+        changes to ``state`` since the previous publish on ``topic``, with a
+        full keyframe every ``keyframe_interval`` publishes (see
+        :mod:`paho_mqtt_helpers.delta`).
+
+        Receivers rebuild full states transparently, and request a keyframe
+        on ``<base>/delta/keyframe`` when they miss a delta; this reactor
+        answers requests for the topics it publishes.
+        """
+        self.deltas.keyframe_interval = keyframe_interval
+        topic = f'{self.base}/delta/keyframe'
+        if topic not in self.subscriptions:
+            self.addGetRoute(topic, self._on_keyframe_request)
+            if self.mqtt_client.is_connected():
+                self.mqtt_client.subscribe(topic, qos=self.subscription_qos)
+        return self.deltas
+
+    def enable_dedup(self,
+                     max_interval: float = None) -> 'PublishDeduplicator':
+        """
+        Skip publishing a payload identical to the previous one sent on the
+        same topic, unless ``max_interval`` seconds have passed since (see
+        :mod:`paho_mqtt_helpers.dedup`).
+
+        Suppressed messages and bytes are counted in :attr:`dedup`.  All
+        topics are published again after a reconnect.
+        """
+        from .dedup import PublishDeduplicator
+
+        if self.dedup is None:
+            self.dedup = PublishDeduplicator(max_interval=max_interval)
+        self.dedup.max_interval = max_interval
+        return self.dedup
+
+    def enable_profiling(self) -> 'RemoteProfiler':
+        """
+        Accept remote profiling requests on ``<base>/<plugin>/profile/start``,
+        ``<base>/<plugin>/profile/stop`` and
+        ``<base>/<plugin>/tracemalloc/snapshot`` (see
+        :mod:`paho_mqtt_helpers.profiling`).
+
+        Anyone able to publish on these topics can slow this plugin down:
+        only enable profiling on trusted brokers.
+        """
+        from .profiling import RemoteProfiler
+
+        if self.profiler is None:
+            self.profiler = RemoteProfiler()
+        routes = ((self.plugin_topic('profile', 'start'),
+                   self._on_profile_start),
+                  (self.plugin_topic('profile', 'stop'),
+                   self._on_profile_stop),
+                  (self.plugin_topic('tracemalloc', 'snapshot'),
+                   self._on_tracemalloc_snapshot))
+        for topic, handler in routes:
+            if topic not in self.subscriptions:
+                self.addGetRoute(topic, handler)
+                if self.mqtt_client.is_connected():
+                    self.mqtt_client.subscribe(topic,
+                                               qos=self.subscription_qos)
+        return self.profiler
+
+    def enable_recording(self, directory: str, **kwargs) -> 'Recorder':
+        """
+        Append every received message (before decoding) to the traffic log
+        in ``directory``; keyword arguments are passed to :class:`Recorder`.
+
+        Replay the log with :func:`paho_mqtt_helpers.recording.replay`.
+        """
+        if self.recorder is not None:
+            return self.recorder
+        from .recording import Recorder
+
+        self.recorder = recorder = Recorder(directory, **kwargs)
+        on_message = self.mqtt_client.on_message
+
+        def recording_on_message(client, userdata, msg):
+            recorder.record(msg.topic, msg.payload, msg.qos, msg.retain)
+            on_message(client, userdata, msg)
+
+        # Wrap the client callback, so the reactor hot path is unchanged
+        # while recording is off.
+        self._unrecorded_on_message = on_message
+        self.mqtt_client.on_message = recording_on_message
+        return recorder
+
+    def enable_phase_stats(self, summary_interval: float = None) -> PhaseStats:
+        """
+        Keep cumulative time per loop phase and thread: ``network``
+        (``loop_read``/``loop_write``/``loop_misc``, excluding callbacks),
+        ``decode``, ``handler``, ``encode`` and ``publish``.
+
+        See :meth:`stats`.  With ``summary_interval``, a one-line summary is
+        logged every ``summary_interval`` seconds.
+        """
+        if self.phase_stats is None:
+            self.phase_stats = PhaseStats()
+            client = self.mqtt_client
+            # paho's loop (and the selector engine) call these through the
+            # instance, so per-instance wrappers see all network I/O.
+            for name in ('loop_read', 'loop_write', 'loop_misc'):
+                setattr(client, name,
+                        self._phase_timed('network', getattr(client, name)))
+        if summary_interval and self._phase_stats_task is None:
+            self._phase_stats_task = PeriodicTask(
+                summary_interval,
+                lambda: logger.info('Reactor phases: %s',
+                                    self.phase_stats.summary()),
+                name='PhaseStatsSummary').start()
+        return self.phase_stats
+
+    def stats(self) -> dict:
+        """
+        Cumulative time per phase and per thread (see
+        :meth:`enable_phase_stats`).
+        """
+        if self.phase_stats is None:
+            return {}
+        return self.phase_stats.to_dict()
 
     def subscribe(self) -> None:
         for subscription in self.subscriptions:
-            self.mqtt_client.subscribe(subscription)
+            self.mqtt_client.subscribe(subscription,
+                                       qos=self.subscription_qos)
 
     ###########################################################################
     # Private methods
     # ===============
-    def _connect(self, **kwargs) -> None:
+    def _shared_memory(self):
+        if self._shared_memory_store is None:
+            # Imported on first use: ``multiprocessing.shared_memory`` is
+            # slow to import.
+            from .sharedmem import SharedMemoryStore
+
+            self._shared_memory_store = SharedMemoryStore()
+        return self._shared_memory_store
+
+    def _add_route(self, route: Route) -> None:
+        """
+        Adds ``route`` to the router along with its subscription.
+
+        A new handler for a registered pattern replaces the previous one.
+        """
+        previous = self._routes.get(route.pattern)
+        if previous is not None and type(previous) is type(route) and \
+                previous.handler == route.handler:
+            # Already registered (e.g., ``listen()`` after a reconnect).
+            return
+        self._routes[route.pattern] = route
+        if previous is None:
+            self.router.add_route(route.pattern, route,
+                                  name=route_name(route.handler))
+        else:
+            logger.warning('Replacing the handler of route %s.',
+                           route.pattern)
+            # Patterns are matched in registration order: rebuild the
+            # router with the new route in place of the previous one.
+            self.router = PathRouter()
+            for route_ in self._routes.values():
+                self.router.add_route(route_.pattern, route_,
+                                      name=route_name(route_.handler))
+        # Replace characters between curly brackets with "+" wildcard
+        subscription = re.sub(r"\{(.+?)\}", "+", route.pattern)
+        if subscription not in self.subscriptions:
+            self.subscriptions.append(subscription)
+
+    def _connect(self, **kwargs) -> bool:
+        """``True`` if the connection to the broker was opened."""
         host = kwargs.get('host', self.host)
         port = kwargs.get('port', self.port)
         keepalive = kwargs.get('keepalive', self.keepalive)
+        if self.protocol == mqtt.MQTTv5:
+            properties = None
+            if self.persistent_session:
+                properties = Properties(PacketTypes.CONNECT)
+                properties.SessionExpiryInterval = self.session_expiry
+            kwargs = {'clean_start': not self.persistent_session,
+                      'properties': properties}
+        else:
+            kwargs = {}
         try:
             # Connect to MQTT broker.
-            self.mqtt_client.connect(host=host, port=port, keepalive=keepalive)
+            self.mqtt_client.connect(host=host, port=port, keepalive=keepalive,
+                                     **kwargs)
         except socket.error:
             logger.error('Error connecting to MQTT broker.')
+            return False
+        return True
+
+    def _reconnect(self, delay: float = None) -> None:
+        """
+        Reconnect on the engine thread (``delay`` seconds after the previous
+        attempt), retrying with exponential backoff (up to
+        :data:`MAX_RECONNECT_DELAY` seconds) until connected.
+        """
+        if self.should_exit or self._connect():
+            return
+        delay = min((delay or RECONNECT_DELAY) * 2, MAX_RECONNECT_DELAY)
+        logger.debug('Reconnecting in %s seconds.', delay)
+        self._engine.call_later(delay, lambda: self._reconnect(delay))
+
+    def _phase_timed(self, phase: str, func: Callable) -> Callable:
+        stats = self.phase_stats
+
+        def wrapper(*args, **kwargs):
+            stats.enter(phase)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.exit()
+        return wrapper
+
+    def _unframe(self, data: bytes) -> tuple:
+        """
+        Strip frame headers from ``data``.
+
+        Returns ``(envelope or None, JSON payload, shared memory
+        descriptor, blob reference or delta)``.
+
+        Raises
+        ------
+        ValueError
+            If the frame type is unknown.
+        """
+        stamp = None
+        if data[0] == codec.ENVELOPE:
+            stamp, data = envelope.split(data[1:])
+        if data and data[0] == codec.COMPRESSED:
+            data = self.decompressor.decompress(data[1:])
+        if codec.is_framed(data) and \
+                data[0] not in (codec.SHARED_MEMORY, codec.BLOB, codec.DELTA):
+            raise ValueError(f'Unknown frame type: {data[0]:#x}')
+        return stamp, data
+
+    def _decode_blob(self, data: bytes) -> Any:
+        if codec.is_framed(data):
+            _, data = self._unframe(data)
+        return codec.decode(data)
+
+    def _on_blob(self, msg) -> None:
+        """Cache a broker blob, then handle the messages waiting for it."""
+        self.mqtt_client.unsubscribe(msg.topic)
+        try:
+            messages = self.blobs.resolve(msg.topic, msg.payload)
+        except (ValueError, struct.error):
+            logger.error('Invalid blob on topic %s', msg.topic)
+            return
+        for waiting in messages:
+            self.on_message(self.mqtt_client, None, waiting)
+
+    def _expire_blobs(self) -> None:
+        for key in self.blobs.expire():
+            self.mqtt_client.unsubscribe(self.blobs.topic(key))
+
+    def _request_keyframe(self, topic: str) -> None:
+        self.sendMessage(f'{self.base}/delta/keyframe', {'topic': topic})
+
+    def _on_keyframe_request(self, payload, args) -> None:
+        topic = (payload or {}).get('topic')
+        request = self.deltas.keyframe_request(topic)
+        if request is None:
+            return
+        state, retain, qos = request
+        self.sendMessage(topic, state, retain=retain, qos=qos, delta=True)
+
+    def _on_slow_handler(self, event: dict) -> None:
+        if self.metrics is not None:
+            self.metrics.route(event['route']).slow_handlers += 1
+        if self._publish_alerts:
+            self.sendMessage(self.plugin_topic('alerts'),
+                             dict(event, type='slow-handler'))
+
+    def _publish_metrics(self) -> None:
+        self.sendMessage(self.plugin_topic('metrics'), self.metrics.to_dict())
 
     ###########################################################################
     # MQTT client handlers
     # ====================
-    def on_connect(self, client, userdata, flags, rc) -> None:
-        self.addGetRoute(f"microdrop/{self.url_safe_plugin_name}/exit", self.exit)
+    def on_connect(self, client, userdata, flags, rc, properties=None) -> None:
+        if self.dedup is not None:
+            # Receivers may have missed messages while disconnected.
+            self.dedup.forget()
+        self.addGetRoute(f"microdrop/{self.url_safe_plugin_name}/exit",
+                         self.exit)
         self.listen()  # Listen is not defined in the base class
+        if self.persistent_session and flags.get('session present'):
+            # Broker resumed our session, subscriptions included.
+            logger.debug('Resumed MQTT session; skipping subscribe.')
+            return
         self.subscribe()
 
     def on_disconnect(self, *args, **kwargs) -> None:
+        if self._engine is not None:
+            # Shared engine thread: never block it or exit the process.
+            if self.should_exit:
+                self._engine.remove(self.mqtt_client)
+            else:
+                self._engine.call_later(RECONNECT_DELAY, self._reconnect)
+            return
         # Startup Mqtt Loop after disconnected (unless should terminate)
         if self.should_exit:
             sys.exit()
         self._connect()
-        self.mqtt_client.loop_forever()
+        self.mqtt_client.loop_forever(timeout=self.transport.loop_timeout)
+
+    def _on_profile_start(self, payload, args) -> None:
+        """
+        Start profiling for ``payload['seconds']`` (default: 10) seconds.
+
+        ``payload`` may also set ``mode`` (``'cprofile'`` or ``'sampler'``),
+        the sampler ``interval`` and the number of ``top`` entries to
+        report (see :data:`paho_mqtt_helpers.profiling.LIMITS`).  The
+        result is published to ``<base>/<plugin>/profile/result``.
+        """
+        from .profiling import parameter
+
+        payload = payload or {}
+        try:
+            if not isinstance(payload, dict):
+                raise ValueError('Invalid profiling request.')
+            seconds = parameter(payload, 'seconds', 10.)
+            self.profiler.start(mode=payload.get('mode', 'cprofile'),
+                                interval=parameter(payload, 'interval',
+                                                   0.005),
+                                top=parameter(payload, 'top', 50))
+        except (RuntimeError, ValueError) as exception:
+            self.sendMessage(self.plugin_topic('profile', 'result'),
+                             {'error': str(exception)})
+            return
+        # Stop through our own control topic, so that ``cProfile`` is
+        # disabled on the MQTT loop thread that enabled it.
+        self._profile_timer = threading.Timer(
+            seconds, self.sendMessage,
+            args=(self.plugin_topic('profile', 'stop'), None))
+        self._profile_timer.daemon = True
+        self._profile_timer.start()
+
+    def _on_profile_stop(self, payload, args) -> None:
+        if self._profile_timer is not None:
+            self._profile_timer.cancel()
+            self._profile_timer = None
+        result = self.profiler.stop()
+        if result is not None:
+            self.sendMessage(self.plugin_topic('profile', 'result'), result)
+
+    def _on_tracemalloc_snapshot(self, payload, args) -> None:
+        """
+        Publish the top allocation sites to
+        ``<base>/<plugin>/tracemalloc/result``.
+
+        ``payload`` may set ``top``, ``frames`` (traceback depth when
+        tracing starts) and ``stop`` (default: true; false keeps tracing, to
+        diff the next snapshot against this one).
+        """
+        from .profiling import parameter
+
+        payload = payload or {}
+        try:
+            if not isinstance(payload, dict):
+                raise ValueError('Invalid snapshot request.')
+            result = self.profiler.snapshot(
+                top=parameter(payload, 'top', 25),
+                frames=parameter(payload, 'frames', 1),
+                stop=bool(payload.get('stop', True)))
+        except ValueError as exception:
+            result = {'error': str(exception)}
+        self.sendMessage(self.plugin_topic('tracemalloc', 'result'), result)
 
     def on_message(self, client, userdata, msg) -> None:
         """
         Callback for when a ``PUBLISH`` message is received from the broker.
         """
+        if self.blobs.pending and self.blobs.is_blob_topic(msg.topic):
+            return self._on_blob(msg)
+        if self.streams is not None:
+            from .streaming import StreamRoute
+
+            route, args = self.router.match(msg.topic)
+            if isinstance(route, StreamRoute):
+                return self.streams.dispatch(route, args, msg.topic,
+                                             msg.payload)
+        trace = None
+        if self.tracer is not None:
+            trace = self.tracer.sample(msg.topic)
+        if trace is not None or self.metrics is not None or \
+                self.watchdog is not None or self.phase_stats is not None or \
+                (self.mirror is not None and
+                 self.mirror.mirrors(msg.topic)) or \
+                codec.is_framed(msg.payload):
+            return self._on_message_instrumented(msg, trace)
+
         method, args = self.router.match(msg.topic)
 
         try:
-            payload = json.loads(msg.payload, object_hook=pandas_object_hook)
+            # Empty, e.g., a cleared retained message.
+            payload = codec.decode(msg.payload) if msg.payload else None
         except ValueError:
-            print("Message contains invalid json")
-            print(f"topic: {msg.topic}")
+            logger.error('Invalid JSON payload on topic %s', msg.topic)
             payload = None
 
         if method:
             method(payload, args)
 
+    def _on_message_instrumented(self, msg, trace: 'Trace' = None) -> None:
+        """
+        Same as :meth:`on_message`, recording per-route metrics, phase
+        times and/or the phases of a sampled trace, watching for slow
+        handlers and updating the :attr:`mirror`.  Also handles framed
+        payloads (see :func:`codec.is_framed`).
+        """
+        data = msg.payload
+        size = len(data)
+        stamp = None
+        blob = MISSING
+        invalid = False
+        try:
+            if data and data[0] == codec.CHUNK:
+                if self._chunks_task is None:
+                    self._chunks_task = PeriodicTask(
+                        CHUNK_EXPIRY_INTERVAL, self.reassembler.expire,
+                        name='ChunkExpiry').start()
+                data = self.reassembler.add(msg.topic, data[1:])
+                if data is None:
+                    # Transfer incomplete.
+                    return
+                size = len(data)
+            if codec.is_framed(data):
+                stamp, data = self._unframe(data)
+            elif self.protocol == mqtt.MQTTv5:
+                stamp = envelope.from_message(msg)
+            if data and data[0] == codec.BLOB:
+                key, blob = self.blobs.lookup(data[1:])
+                if blob is MISSING:
+                    # Handled again once the blob arrives.
+                    if self.blobs.wait(key, msg):
+                        self.mqtt_client.subscribe(self.blobs.topic(key),
+                                                   qos=1)
+                        if self._blobs_task is None:
+                            self._blobs_task = PeriodicTask(
+                                BLOB_EXPIRY_INTERVAL, self._expire_blobs,
+                                name='BlobExpiry').start()
+                    return
+        except (ValueError, struct.error):
+            logger.error('Invalid frame header on topic %s', msg.topic)
+            data = b''
+            invalid = True
+        if trace is not None:
+            trace.event('receive')
+            trace.enter('route-match')
+        route, args = self.router.match(msg.topic)
+        if trace is not None:
+            trace.exit('route-match')
+        metrics = None
+        if self.metrics is not None:
+            if not route:
+                self.metrics.unmatched += 1
+            else:
+                metrics = self.metrics.route(route.pattern)
+                metrics.messages += 1
+                metrics.payload_bytes.observe(size)
+                if stamp is not None:
+                    metrics.latency_seconds.observe(stamp.latency())
+                    metrics.sequence_gaps += \
+                        self._sequences.observe(stamp, msg.topic)
+
+        stats = self.phase_stats
+        if trace is not None:
+            trace.enter('decode')
+        if stats is not None:
+            stats.enter('decode')
+        start = time.perf_counter()
+        waiting = False
+        try:
+            if blob is not MISSING:
+                payload = blob
+            elif not data:
+                # E.g., a cleared retained message (removed from the
+                # mirror below).
+                payload = None
+            elif data[0] == codec.DELTA:
+                payload = self.deltas.decode(msg.topic, data[1:])
+                # ``None`` while waiting for a keyframe.
+                waiting = payload is None
+            elif data[0] == codec.SHARED_MEMORY:
+                payload = self._shared_memory().attach(data[1:])
+            else:
+                payload = codec.decode(data)
+        except (ValueError, struct.error):
+            if metrics is not None:
+                metrics.decode_errors += 1
+            logger.error('Invalid JSON payload on topic %s', msg.topic)
+            payload = None
+            invalid = True
+        decoded = time.perf_counter()
+        if stats is not None:
+            stats.exit()
+        if trace is not None:
+            trace.exit('decode')
+        if metrics is not None:
+            metrics.decode_seconds.observe(decoded - start)
+        if waiting:
+            return
+        if self.mirror is not None and not invalid and \
+                self.mirror.mirrors(msg.topic):
+            # Keep the last valid value.
+            self.mirror.update(msg.topic, payload, size)
+
+        if not route:
+            return
+        if trace is not None:
+            trace.enter('handler')
+            self.tracer.activate(trace)
+        if self.watchdog is not None:
+            self.watchdog.enter(route, msg.topic)
+        if stats is not None:
+            stats.enter('handler')
+        try:
+            route(payload, args)
+        except Exception:
+            if metrics is not None:
+                metrics.errors += 1
+            raise
+        finally:
+            if stats is not None:
+                stats.exit()
+            if self.watchdog is not None:
+                self.watchdog.exit()
+            if metrics is not None:
+                metrics.handler_seconds.observe(time.perf_counter() - decoded)
+            if trace is not None:
+                self.tracer.activate(None)
+                trace.exit('handler')
+
     ###########################################################################
     # Control API
     # ===========
-    def start(self) -> None:
+    def start(self, engine: MqttSelectorEngine = None) -> None:
+        """
+        Connect and run the MQTT loop.
+
+        If an ``engine`` (see
+        :class:`paho_mqtt_helpers.engine.MqttSelectorEngine`) is given, the
+        client is handed over to it and this method returns immediately;
+        otherwise the calling thread runs ``loop_forever()``.
+        """
         # Connect to MQTT broker.
-        self._connect()
+        connected = self._connect()
+        if engine is not None:
+            self._engine = engine
+            engine.add(self.mqtt_client)
+            if not connected:
+                engine.call_later(RECONNECT_DELAY, self._reconnect)
+            return
         # Start loop in background thread.
         signal.signal(signal.SIGINT, self.exit)
-        self.mqtt_client.loop_forever()
+        self.mqtt_client.loop_forever(timeout=self.transport.loop_timeout)
 
     def exit(self, a=None, b=None) -> None:
         self.should_exit = True
+        if self._metrics_task is not None:
+            self._metrics_task.stop()
+        if self.watchdog is not None:
+            self.watchdog.stop()
+        if self._phase_stats_task is not None:
+            self._phase_stats_task.stop()
+        if self._blobs_task is not None:
+            self._blobs_task.stop()
+        if self._blobs_clean_task is not None:
+            self._blobs_clean_task.stop()
+        if self._chunks_task is not None:
+            self._chunks_task.stop()
+        if self.recorder is not None:
+            # Stop recording before closing the log.
+            self.mqtt_client.on_message = self._unrecorded_on_message
+            self.recorder.close()
+        if self._shared_memory_store is not None:
+            self._shared_memory_store.close()
         self.mqtt_client.disconnect()
 
     def stop(self) -> None:
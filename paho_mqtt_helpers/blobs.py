@@ -0,0 +1,303 @@
+# coding: utf-8
+"""
+Content-addressed blobs for large payloads sent repeatedly.
+
+With :meth:`BaseMqttReactor.enable_blobs`, an encoded payload of at least
+``threshold`` bytes is stored once under its hash, and only a framed
+reference (see :data:`paho_mqtt_helpers.codec.BLOB`) is published::
+
+    0x05 | store (u1: 0 broker, 1 disk) | BLAKE2b-128 digest (16 bytes)
+
+Stores:
+
+- ``broker``: the blob is published once, retained, to
+  ``<base>/blobs/<hex digest>``.  A receiver missing the blob subscribes
+  to that topic, defers the referencing messages until the blob arrives
+  (at most ``timeout`` seconds), then unsubscribes.  Retained blobs are
+  never removed from the broker: clear them (publish an empty retained
+  message to their topic) once no receiver needs them.  Blobs must fit
+  in one message (retained messages cannot be chunked): with chunking
+  enabled, larger payloads are sent as is, chunked;
+- ``disk``: the blob is written to ``directory`` (same host only), and
+  receivers read it from there.  Senders rewrite the blobs they still
+  reference every ``republish_interval`` seconds and remove those not
+  rewritten for ``max_age`` seconds (see :meth:`BlobStore.clean`).
+
+Receivers keep decoded blobs in a bounded LRU cache, so a repeated payload
+is neither transferred nor decoded again.  Handlers receive the cached
+object itself and must not modify it.
+"""
+import collections
+import hashlib
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from typing import Any, Callable, Optional, Tuple
+
+from .codec import BLOB
+
+logger = logging.getLogger(__name__)
+
+DIGEST_SIZE = 16
+REFERENCE = struct.Struct(f'!B{DIGEST_SIZE}s')
+BROKER, DISK = 0, 1
+STORES = {'broker': BROKER, 'disk': DISK}
+DEFAULT_DIRECTORY = os.path.join(tempfile.gettempdir(), 'paho-mqtt-blobs')
+
+#: :meth:`BlobStore.lookup` result for blobs not cached yet.
+MISSING = object()
+
+
+def digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+class BlobStore:
+    """
+    Parameters
+    ----------
+    prefix : str
+        Topic prefix of broker blobs (e.g., ``'microdrop/blobs'``).
+    decode : callable
+        Decodes blob bytes (as sent) into a payload.
+    directory : str, optional
+        Directory of disk blobs.
+    cache_size, cache_bytes : int
+        Bounds of the receiver cache (entries, encoded bytes).
+    timeout : float
+        Seconds to wait for a broker blob before dropping the messages
+        referencing it.
+    republish_interval : float
+        Seconds after which a sender publishes a blob again (e.g., in case
+        the broker lost its retained messages).
+    max_age : float
+        Seconds after which :meth:`clean` removes a disk blob not written
+        again; must exceed ``republish_interval``.
+    """
+
+    def __init__(self, prefix: str, decode: Callable,
+                 directory: Optional[str] = None, cache_size: int = 128,
+                 cache_bytes: int = 256 << 20, timeout: float = 30.,
+                 republish_interval: float = 3600.,
+                 max_age: float = 7200.) -> None:
+        self.prefix = prefix
+        self.decode = decode
+        self.directory = directory or DEFAULT_DIRECTORY
+        self.cache_size = cache_size
+        self.cache_bytes = cache_bytes
+        self.timeout = timeout
+        self.republish_interval = republish_interval
+        self.max_age = max_age
+        #: Sender settings (see :meth:`BaseMqttReactor.enable_blobs`).
+        self.threshold = None
+        self.store = BROKER
+        #: Counters: references sent, blobs stored, cache hits/misses,
+        #: broker blobs not received in time, disk blobs removed.
+        self.references = 0
+        self.stored = 0
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.removed = 0
+        self._lock = threading.Lock()
+        # Digest -> time after which the blob is stored again.
+        self._stored = collections.OrderedDict()
+        # Digest -> (payload, size), least recently used first.
+        self._cache = collections.OrderedDict()
+        self._cached_bytes = 0
+        # Digest -> (deadline, [messages]) waiting for broker blobs.
+        self.pending = {}
+
+    def topic(self, key: bytes) -> str:
+        return f'{self.prefix}/{key.hex()}'
+
+    ###########################################################################
+    # Sender
+    # ======
+    def accepts(self, size: int, max_size: Optional[int] = None) -> bool:
+        """
+        ``True`` if a payload of ``size`` bytes is sent as a blob: at least
+        :attr:`threshold` bytes and, for broker blobs, at most ``max_size``
+        (e.g., the chunk size).
+        """
+        return self.threshold is not None and size >= self.threshold and \
+            (self.store == DISK or max_size is None or size <= max_size)
+
+    def reference(self, data: bytes) -> Tuple[bytes, Optional[str]]:
+        """
+        Framed reference to ``data``, and the topic to publish ``data`` to
+        (retained) if it must be stored on the broker, else ``None``.
+        """
+        key = digest(data)
+        now = time.monotonic()
+        with self._lock:
+            deadline = self._stored.get(key)
+            store = deadline is None or deadline <= now
+            if store:
+                self._stored[key] = now + self.republish_interval
+                if len(self._stored) > 4096:
+                    self._stored.popitem(last=False)
+            else:
+                self._stored.move_to_end(key)
+            self.references += 1
+        topic = None
+        if store:
+            if self.store == DISK:
+                self._write(key, data)
+            else:
+                topic = self.topic(key)
+            self.stored += 1
+        return bytes([BLOB]) + REFERENCE.pack(self.store, key), topic
+
+    def clean(self) -> int:
+        """
+        Remove the disk blobs (and leftover temporary files) in
+        :attr:`directory` not written for :attr:`max_age` seconds; returns
+        the number of files removed.
+
+        Called periodically by senders storing blobs on disk (see
+        :meth:`BaseMqttReactor.enable_blobs`).
+        """
+        cutoff = time.time() - self.max_age
+        removed = 0
+        try:
+            entries = os.scandir(self.directory)
+        except FileNotFoundError:
+            return 0
+        with entries:
+            for entry in entries:
+                name = entry.name.split('.', 1)[0]
+                if len(name) != 2 * DIGEST_SIZE or \
+                        name.strip('0123456789abcdef'):
+                    # Not a blob.
+                    continue
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    # Removed concurrently (e.g., by another sender).
+                    continue
+        self.removed += removed
+        return removed
+
+    def _write(self, key: bytes, data: bytes) -> None:
+        path = os.path.join(self.directory, key.hex())
+        try:
+            # Still in use: keep it from :meth:`clean`.
+            os.utime(path)
+            return
+        except FileNotFoundError:
+            pass
+        os.makedirs(self.directory, exist_ok=True)
+        # Write then rename, so readers never see a partial blob.
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'wb') as output:
+            output.write(data)
+        os.replace(temporary, path)
+
+    ###########################################################################
+    # Receiver
+    # ========
+    def lookup(self, data: bytes) -> Tuple[bytes, Any]:
+        """
+        ``(digest, payload)`` for a reference (without its frame byte);
+        the payload is :data:`MISSING` if a broker blob is not cached.
+
+        Raises
+        ------
+        ValueError
+            If a disk blob is missing or does not match its digest.
+        """
+        store, key = REFERENCE.unpack_from(data)
+        try:
+            payload = self._cache[key][0]
+        except KeyError:
+            pass
+        else:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return key, payload
+        self.misses += 1
+        if store != DISK:
+            return key, MISSING
+        try:
+            with open(os.path.join(self.directory, key.hex()), 'rb') as input_:
+                blob = input_.read()
+        except FileNotFoundError:
+            raise ValueError(f'Blob {key.hex()} not found in '
+                             f'{self.directory}.')
+        return key, self._add(key, blob)
+
+    def wait(self, key: bytes, msg) -> bool:
+        """
+        Defer ``msg`` until the blob ``key`` arrives; ``True`` if the blob
+        topic must be subscribed to (first waiting message).
+        """
+        with self._lock:
+            entry = self.pending.get(key)
+            if entry is not None:
+                entry[1].append(msg)
+                return False
+            self.pending[key] = (time.monotonic() + self.timeout, [msg])
+        return True
+
+    def is_blob_topic(self, topic: str) -> bool:
+        return topic.startswith(self.prefix) and \
+            topic[len(self.prefix):len(self.prefix) + 1] == '/'
+
+    def resolve(self, topic: str, blob: bytes) -> list:
+        """
+        Cache the broker blob received on ``topic``; returns the messages
+        waiting for it.
+
+        Raises
+        ------
+        ValueError
+            If the blob does not match its digest or cannot be decoded.
+        """
+        key = bytes.fromhex(topic[len(self.prefix) + 1:])
+        with self._lock:
+            _, messages = self.pending.pop(key, (None, []))
+        self._add(key, blob)
+        return messages
+
+    def _add(self, key: bytes, blob: bytes) -> Any:
+        if digest(blob) != key:
+            raise ValueError(f'Blob {key.hex()} does not match its digest.')
+        payload = self.decode(blob)
+        # E.g., a disk blob looked up again while its broker copy arrives.
+        _, size = self._cache.pop(key, (None, 0))
+        self._cached_bytes -= size
+        self._cache[key] = (payload, len(blob))
+        self._cached_bytes += len(blob)
+        while self._cache and (len(self._cache) > self.cache_size or
+                               self._cached_bytes > self.cache_bytes):
+            _, (_, size) = self._cache.popitem(last=False)
+            self._cached_bytes -= size
+        return payload
+
+    def expire(self) -> list:
+        """
+        Drop the messages waiting longer than ``timeout`` for their blob;
+        returns the digests of the blobs given up on.
+
+        Called periodically (see :meth:`BaseMqttReactor.enable_blobs`) while
+        messages are waiting.
+        """
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for key, (deadline, messages) in list(self.pending.items()):
+                if deadline <= now:
+                    del self.pending[key]
+                    expired.append((key, len(messages)))
+            self.expired += len(expired)
+        for key, count in expired:
+            logger.error('Blob %s not received; dropping %d messages.',
+                         key.hex(), count)
+        return [key for key, _ in expired]
@@ -0,0 +1,507 @@
+# coding: utf-8
+"""
+Small in-process MQTT 3.1.1/5 broker for benchmarks and tests.
+
+:class:`FakeBroker` is a pure-Python :mod:`asyncio` broker good enough to
+run reactors hermetically on one machine.  It supports:
+
+- ``CONNECT`` (MQTT 3.1, 3.1.1 and 5), clean and persistent sessions
+  (``session_present`` on resume, QoS 1 messages queued while offline);
+- ``SUBSCRIBE``/``UNSUBSCRIBE`` with ``+``/``#`` wildcards and shared
+  subscriptions (``$share/<group>/<filter>``, round robin within a group);
+- ``PUBLISH`` at QoS 0 and 1 (QoS 2 publishes are accepted and delivered at
+  QoS 1 at most), MQTT 5 publish properties are forwarded to MQTT 5
+  subscribers;
+- retained messages.
+
+Not supported: authentication, will messages, topic aliases, message
+expiry and session expiry timers (any non-zero expiry keeps the session
+until the broker stops).
+
+Example
+-------
+
+>>> with FakeBroker() as broker:
+...     reactor = MyReactor(port=broker.port)
+"""
+import asyncio
+import collections
+import itertools
+import logging
+import struct
+import threading
+import uuid
+
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP, SUBSCRIBE, \
+    SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = range(1, 15)
+
+#: Size of each MQTT 5 property value, by property identifier (``None``:
+#: variable byte integer, ``'s'``: length-prefixed, ``'p'``: string pair).
+_PROPERTY_SIZES = {0x01: 1, 0x02: 4, 0x03: 's', 0x08: 's', 0x09: 's',
+                   0x0B: None, 0x11: 4, 0x12: 's', 0x13: 2, 0x15: 's',
+                   0x16: 's', 0x17: 1, 0x18: 4, 0x19: 1, 0x1A: 's',
+                   0x1C: 's', 0x1F: 's', 0x21: 2, 0x22: 2, 0x23: 2,
+                   0x24: 1, 0x25: 1, 0x26: 'p', 0x27: 4, 0x28: 1, 0x29: 1,
+                   0x2A: 1}
+_TOPIC_ALIAS = 0x23
+_SESSION_EXPIRY = 0x11
+_MAX_QUEUED = 10000
+
+
+def encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte, value = value % 128, value // 128
+        out.append(byte | (0x80 if value else 0))
+        if not value:
+            return bytes(out)
+
+
+def decode_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    value, multiplier = 0, 1
+    while True:
+        byte = data[pos]
+        pos += 1
+        value += (byte & 0x7f) * multiplier
+        if not byte & 0x80:
+            return value, pos
+        multiplier *= 128
+
+
+def _encode_str(value: str) -> bytes:
+    data = value.encode('utf-8')
+    return struct.pack('!H', len(data)) + data
+
+
+def _decode_str(data: bytes, pos: int) -> Tuple[bytes, int]:
+    length = struct.unpack_from('!H', data, pos)[0]
+    return data[pos + 2:pos + 2 + length], pos + 2 + length
+
+
+def _packet(kind: int, body: bytes, flags: int = 0) -> bytes:
+    return bytes([kind << 4 | flags]) + encode_varint(len(body)) + body
+
+
+def split_properties(data: bytes, pos: int) -> Tuple[Dict[int, list], int]:
+    """
+    Parse an MQTT 5 property block starting at ``pos``.
+
+    Returns ``({identifier: [raw property bytes, ...]}, end position)``.
+    """
+    length, pos = decode_varint(data, pos)
+    end = pos + length
+    properties = collections.defaultdict(list)
+    while pos < end:
+        start = pos
+        identifier, pos = decode_varint(data, pos)
+        size = _PROPERTY_SIZES[identifier]
+        if size is None:
+            _, pos = decode_varint(data, pos)
+        elif size == 's':
+            pos += 2 + struct.unpack_from('!H', data, pos)[0]
+        elif size == 'p':
+            for _ in range(2):
+                pos += 2 + struct.unpack_from('!H', data, pos)[0]
+        else:
+            pos += size
+        properties[identifier].append(data[start:pos])
+    return properties, end
+
+
+def topic_matches(filter_: str, topic: str) -> bool:
+    """``True`` if ``topic`` matches the subscription ``filter_``."""
+    if topic.startswith('$') and filter_[:1] in ('+', '#'):
+        return False
+    f_parts, t_parts = filter_.split('/'), topic.split('/')
+    for i, part in enumerate(f_parts):
+        if part == '#':
+            return True
+        if i >= len(t_parts) or (part != '+' and part != t_parts[i]):
+            return False
+    return len(f_parts) == len(t_parts)
+
+
+class _Message:
+    __slots__ = ('topic', 'payload', 'qos', 'retain', 'properties')
+
+    def __init__(self, topic: str, payload: bytes, qos: int, retain: bool,
+                 properties: bytes) -> None:
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        #: Raw MQTT 5 properties (without the length prefix).
+        self.properties = properties
+
+
+class _Session:
+    def __init__(self, client_id: str) -> None:
+        self.client_id = client_id
+        self.persistent = False
+        self.version = 4
+        self.writer = None
+        #: QoS 1 messages waiting for the client to (re)connect.
+        self.queue = collections.deque(maxlen=_MAX_QUEUED)
+        #: Sent QoS 1 messages waiting for ``PUBACK``, by packet ID.
+        self.inflight = collections.OrderedDict()
+        self.filters = {}
+        self._packet_ids = itertools.cycle(range(1, 65536))
+
+    def next_packet_id(self) -> int:
+        while True:
+            packet_id = next(self._packet_ids)
+            if packet_id not in self.inflight:
+                return packet_id
+
+    def send(self, message: _Message, qos: int, retain: bool = False,
+             dup: bool = False) -> None:
+        if self.writer is None:
+            if qos:
+                self.queue.append((message, qos))
+            return
+        body = bytearray(_encode_str(message.topic))
+        if qos:
+            packet_id = self.next_packet_id()
+            self.inflight[packet_id] = message
+            body += struct.pack('!H', packet_id)
+        if self.version == 5:
+            body += encode_varint(len(message.properties))
+            body += message.properties
+        body += message.payload
+        flags = qos << 1 | (0x08 if dup else 0) | (0x01 if retain else 0)
+        self.writer.write(_packet(PUBLISH, bytes(body), flags))
+
+
+class FakeBroker:
+    """
+    In-process MQTT broker.
+
+    Parameters
+    ----------
+    host : str
+        TCP interface to listen on.
+    port : int
+        TCP port; ``0`` picks a free port (see :attr:`port` once started).
+    path : str, optional
+        Also listen on this Unix domain socket.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0,
+                 path: Optional[str] = None) -> None:
+        self.host = host
+        self.port = port
+        self.path = path
+        self.sessions = {}
+        self.retained = {}
+        #: ``{filter: {client_id: qos}}`` for plain subscriptions, split so
+        #: filters without wildcards are a single dictionary lookup.
+        self._subscriptions = collections.defaultdict(dict)
+        self._wildcards = collections.defaultdict(dict)
+        #: ``{(group, filter): {client_id: qos}}`` for shared subscriptions.
+        self._shared = collections.defaultdict(dict)
+        self._shared_next = collections.Counter()
+        self.stats = collections.Counter()
+        self._servers = []
+        self._loop = None
+        self._thread = None
+
+    ###########################################################################
+    # Control API
+    # ===========
+    async def start_serving(self) -> None:
+        """Start listening on the running event loop."""
+        server = await asyncio.start_server(self._handle, self.host,
+                                            self.port, backlog=1024)
+        self.port = server.sockets[0].getsockname()[1]
+        self._servers.append(server)
+        if self.path:
+            self._servers.append(await asyncio.start_unix_server(
+                self._handle, self.path))
+
+    async def close(self) -> None:
+        for server in self._servers:
+            server.close()
+        for session in self.sessions.values():
+            if session.writer is not None:
+                session.writer.close()
+        for server in self._servers:
+            await server.wait_closed()
+        self._servers = []
+
+    def start(self) -> 'FakeBroker':
+        """Run the broker on a background thread."""
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.start_serving())
+            started.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name='FakeBroker',
+                                        daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self) -> None:
+        """Stop a broker started with :meth:`start`."""
+        async def shutdown():
+            await self.close()
+            tasks = [task for task in asyncio.all_tasks()
+                     if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._loop.stop()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop)
+        self._thread.join()
+
+    def __enter__(self) -> 'FakeBroker':
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    ###########################################################################
+    # Routing
+    # =======
+    def publish(self, message: _Message) -> None:
+        """Deliver ``message`` to subscribers and update retained state."""
+        self.stats['publish_in'] += 1
+        if message.retain:
+            if message.payload:
+                self.retained[message.topic] = message
+            else:
+                self.retained.pop(message.topic, None)
+        targets = dict(self._subscriptions.get(message.topic, {}))
+        for filter_, clients in self._wildcards.items():
+            if topic_matches(filter_, message.topic):
+                for client_id, qos in clients.items():
+                    targets[client_id] = max(qos, targets.get(client_id, 0))
+        for key, clients in self._shared.items():
+            if clients and topic_matches(key[1], message.topic):
+                members = sorted(clients)
+                # Prefer connected members, round robin within the group.
+                online = [c for c in members
+                          if self.sessions[c].writer is not None] or members
+                client_id = online[self._shared_next[key] % len(online)]
+                self._shared_next[key] += 1
+                targets[client_id] = max(clients[client_id],
+                                         targets.get(client_id, 0))
+        for client_id, qos in targets.items():
+            self.stats['publish_out'] += 1
+            self.sessions[client_id].send(message, min(qos, message.qos))
+
+    def _subscribe(self, session: _Session, filter_: str, qos: int) -> None:
+        session.filters[filter_] = qos
+        if filter_.startswith('$share/'):
+            _, group, real_filter = filter_.split('/', 2)
+            self._shared[(group, real_filter)][session.client_id] = qos
+            return
+        self._table(filter_)[filter_][session.client_id] = qos
+        for topic, message in list(self.retained.items()):
+            if topic_matches(filter_, topic):
+                session.send(message, min(qos, message.qos), retain=True)
+
+    def _table(self, filter_: str) -> dict:
+        if '+' in filter_ or '#' in filter_:
+            return self._wildcards
+        return self._subscriptions
+
+    def _unsubscribe(self, session: _Session, filter_: str) -> None:
+        session.filters.pop(filter_, None)
+        if filter_.startswith('$share/'):
+            _, group, real_filter = filter_.split('/', 2)
+            table, key = self._shared, (group, real_filter)
+        else:
+            table, key = self._table(filter_), filter_
+        clients = table.get(key)
+        if clients is not None:
+            clients.pop(session.client_id, None)
+            if not clients:
+                del table[key]
+
+    def _drop_session(self, session: _Session) -> None:
+        for filter_ in list(session.filters):
+            self._unsubscribe(session, filter_)
+        self.sessions.pop(session.client_id, None)
+
+    ###########################################################################
+    # Connection handling
+    # ===================
+    async def _read_packet(self, reader) -> Tuple[int, bytes]:
+        header = (await reader.readexactly(1))[0]
+        length, multiplier = 0, 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7f) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header, await reader.readexactly(length)
+
+    def _connect(self, body: bytes, writer) -> _Session:
+        _, pos = _decode_str(body, 0)
+        version, flags = body[pos], body[pos + 1]
+        pos += 4  # Level, flags, keepalive.
+        clean = bool(flags & 0x02)
+        persistent = not clean
+        if version == 5:
+            properties, pos = split_properties(body, pos)
+            expiry = properties.get(_SESSION_EXPIRY)
+            # MQTT 5: session ends on disconnect unless an expiry is set.
+            persistent = bool(expiry and struct.unpack('!I', expiry[0][1:])[0])
+        client_id, pos = _decode_str(body, pos)
+        client_id = client_id.decode('utf-8') or f'fake-{uuid.uuid4().hex}'
+
+        session = self.sessions.get(client_id)
+        if session is not None and session.writer is not None:
+            # Session takeover: drop the previous connection.
+            session.writer.close()
+            session.writer = None
+        if session is not None and clean:
+            self._drop_session(session)
+            session = None
+        session_present = session is not None
+        if session is None:
+            session = self.sessions[client_id] = _Session(client_id)
+        session.persistent = persistent
+        session.version = version
+
+        ack = bytes([1 if session_present else 0, 0])
+        if version == 5:
+            ack += b'\x00'
+        writer.write(_packet(CONNACK, ack))
+        session.writer = writer
+        if session_present:
+            # Retransmit unacknowledged messages, then flush the queue.
+            inflight = list(session.inflight.values())
+            session.inflight.clear()
+            for message in inflight:
+                session.send(message, 1, dup=True)
+            while session.queue:
+                session.send(*session.queue.popleft())
+        return session
+
+    async def _handle(self, reader, writer) -> None:
+        session = None
+        try:
+            header, body = await self._read_packet(reader)
+            if header >> 4 != CONNECT:
+                return
+            session = self._connect(body, writer)
+            while True:
+                await writer.drain()
+                header, body = await self._read_packet(reader)
+                kind = header >> 4
+                if kind == PUBLISH:
+                    self._on_publish(session, header, body)
+                elif kind == PUBACK:
+                    session.inflight.pop(
+                        struct.unpack_from('!H', body)[0], None)
+                elif kind == PUBREL:
+                    writer.write(_packet(PUBCOMP, body[:2]))
+                elif kind == SUBSCRIBE:
+                    self._on_subscribe(session, body)
+                elif kind == UNSUBSCRIBE:
+                    self._on_unsubscribe(session, body)
+                elif kind == PINGREQ:
+                    writer.write(_packet(PINGRESP, b''))
+                elif kind == DISCONNECT:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.CancelledError,
+                ConnectionError):
+            pass
+        except Exception:
+            logger.exception('Closing connection after protocol error.')
+        finally:
+            if session is not None and session.writer is writer:
+                session.writer = None
+                if not session.persistent:
+                    self._drop_session(session)
+            writer.close()
+
+    def _on_publish(self, session: _Session, header: int,
+                    body: bytes) -> None:
+        qos = (header >> 1) & 0x03
+        topic, pos = _decode_str(body, 0)
+        packet_id = None
+        if qos:
+            packet_id = body[pos:pos + 2]
+            pos += 2
+        properties = b''
+        if session.version == 5:
+            props, end = split_properties(body, pos)
+            properties = b''.join(raw for identifier, values in props.items()
+                                  if identifier != _TOPIC_ALIAS
+                                  for raw in values)
+            pos = end
+        self.publish(_Message(topic.decode('utf-8'), body[pos:],
+                              min(qos, 1), bool(header & 0x01), properties))
+        if qos == 1:
+            session.writer.write(_packet(PUBACK, packet_id))
+        elif qos == 2:
+            session.writer.write(_packet(PUBREC, packet_id))
+
+    def _on_subscribe(self, session: _Session, body: bytes) -> None:
+        packet_id, pos = body[:2], 2
+        if session.version == 5:
+            _, pos = split_properties(body, pos)
+        requests = []
+        while pos < len(body):
+            filter_, pos = _decode_str(body, pos)
+            requests.append((filter_.decode('utf-8'), min(body[pos] & 0x03,
+                                                          1)))
+            pos += 1
+        ack = packet_id + (b'\x00' if session.version == 5 else b'') + \
+            bytes(qos for _, qos in requests)
+        session.writer.write(_packet(SUBACK, ack))
+        for filter_, qos in requests:
+            self._subscribe(session, filter_, qos)
+
+    def _on_unsubscribe(self, session: _Session, body: bytes) -> None:
+        packet_id, pos = body[:2], 2
+        if session.version == 5:
+            _, pos = split_properties(body, pos)
+        count = 0
+        while pos < len(body):
+            filter_, pos = _decode_str(body, pos)
+            self._unsubscribe(session, filter_.decode('utf-8'))
+            count += 1
+        ack = packet_id
+        if session.version == 5:
+            ack += b'\x00' + bytes(count)
+        session.writer.write(_packet(UNSUBACK, ack, 0))
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run a FakeBroker.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--path', help='Also listen on this Unix socket.')
+    args = parser.parse_args()
+
+    async def serve():
+        broker = FakeBroker(args.host, args.port, args.path)
+        await broker.start_serving()
+        print(f'FakeBroker listening on {broker.host}:{broker.port}')
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
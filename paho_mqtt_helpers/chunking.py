@@ -0,0 +1,281 @@
+# coding: utf-8
+"""
+Chunked transfer of payloads larger than broker limits.
+
+:meth:`BaseMqttReactor.enable_chunking` splits payloads larger than
+``chunk_size`` into chunks framed (see
+:data:`paho_mqtt_helpers.codec.CHUNK`) as::
+
+    0x03 | transfer id (u8) | offset (u8) | total size (u8) | data
+
+:class:`ChunkSender` keeps at most ``window`` chunks of a transfer queued in
+the client and publishes the next one when paho reports a chunk published,
+so other messages sent in the meantime are interleaved with the chunks
+instead of waiting behind the whole payload.
+
+On the receiving side, :class:`Reassembler` writes the chunks of each
+transfer into one buffer preallocated from the total size, tracks the byte
+ranges received (so duplicate or overlapping chunks cannot complete a
+transfer early), bounds the memory held by incomplete transfers and drops
+transfers that stall.
+"""
+import bisect
+import collections
+import logging
+import random
+import struct
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from typing import Optional
+
+from .codec import CHUNK
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct('!QQQ')
+
+
+class _OutgoingTransfer:
+    __slots__ = ('topic', 'data', 'qos', 'properties', 'header', 'offset')
+
+    def __init__(self, topic: str, data: bytes, qos: int, properties,
+                 transfer_id: int) -> None:
+        self.topic = topic
+        self.data = data
+        self.qos = qos
+        self.properties = properties
+        self.header = (transfer_id, len(data))
+        self.offset = 0
+
+
+class ChunkSender:
+    """
+    Parameters
+    ----------
+    client : paho.mqtt.client.Client
+    chunk_size : int
+        Maximum chunk payload size (bytes), below the broker message limit.
+    window : int
+        Chunks per transfer queued in the client at any time.
+    """
+
+    def __init__(self, client: mqtt.Client, chunk_size: int = 256 << 10,
+                 window: int = 4) -> None:
+        self.client = client
+        self.chunk_size = chunk_size
+        self.window = window
+        #: Transfers started/abandoned (client disconnected at QoS 0).
+        self.transfers = 0
+        self.abandoned = 0
+        self._next_id = random.getrandbits(64)
+        self._lock = threading.Lock()
+        # Message ID -> transfer of the chunk waiting for ``on_publish``.
+        self._inflight = {}
+        # Message IDs reported published before ``publish()`` returned
+        # (paho may write and report QoS 0 messages synchronously).
+        self._early = set()
+
+    def send(self, topic: str, data: bytes, qos: int = 0,
+             properties=None) -> int:
+        """Start sending ``data`` in chunks; returns the transfer ID."""
+        with self._lock:
+            transfer_id = self._next_id
+            self._next_id = (self._next_id + 1) & 0xffffffffffffffff
+            self.transfers += 1
+        transfer = _OutgoingTransfer(topic, data, qos, properties,
+                                     transfer_id)
+        for _ in range(self.window):
+            if not self._publish_next(transfer):
+                break
+        return transfer_id
+
+    def on_publish(self, client, userdata, mid) -> None:
+        with self._lock:
+            transfer = self._inflight.pop(mid, None)
+            if transfer is None:
+                if len(self._early) >= 4096:
+                    # IDs of other messages (e.g., unchunked publishes).
+                    self._early.clear()
+                self._early.add(mid)
+                return
+        self._publish_next(transfer)
+
+    @property
+    def pending(self) -> int:
+        """Chunks published but not yet reported published."""
+        return len(self._inflight)
+
+    def _publish_next(self, transfer: _OutgoingTransfer) -> bool:
+        """Publish the next chunk of ``transfer``, if any is left."""
+        while True:
+            with self._lock:
+                offset = transfer.offset
+                if offset >= len(transfer.data):
+                    return False
+                transfer.offset = offset + self.chunk_size
+            chunk = bytes([CHUNK]) + HEADER.pack(transfer.header[0], offset,
+                                                 transfer.header[1]) + \
+                transfer.data[offset:offset + self.chunk_size]
+            # Publish without holding the lock: paho calls ``on_publish``
+            # with its own locks held.
+            info = self.client.publish(transfer.topic, chunk,
+                                       qos=transfer.qos,
+                                       properties=transfer.properties)
+            if info.rc == mqtt.MQTT_ERR_NO_CONN and transfer.qos == 0:
+                logger.warning('Chunked transfer on %s abandoned: not '
+                               'connected.', transfer.topic)
+                with self._lock:
+                    transfer.offset = len(transfer.data)
+                    self.abandoned += 1
+                return False
+            with self._lock:
+                if info.mid not in self._early:
+                    self._inflight[info.mid] = transfer
+                    return True
+                self._early.discard(info.mid)
+            # Already published: continue with the next chunk.
+
+
+class _IncomingTransfer:
+    __slots__ = ('buffer', 'ranges', 'received', 'deadline')
+
+    def __init__(self, total: int, deadline: float) -> None:
+        self.buffer = bytearray(total)
+        # Sorted, disjoint ``(start, end)`` byte ranges received.
+        self.ranges = []
+        self.received = 0
+        self.deadline = deadline
+
+    def add_range(self, start: int, end: int) -> int:
+        """Mark ``[start:end]`` received; returns the bytes not seen yet."""
+        ranges = self.ranges
+        i = bisect.bisect_left(ranges, (start, ))
+        if i > 0 and ranges[i - 1][1] >= start:
+            i -= 1
+        j = i
+        merged_start, merged_end, seen = start, end, 0
+        # Merge the ranges overlapping or adjacent to ``[start:end]``.
+        while j < len(ranges) and ranges[j][0] <= end:
+            range_start, range_end = ranges[j]
+            seen += range_end - range_start
+            merged_start = min(merged_start, range_start)
+            merged_end = max(merged_end, range_end)
+            j += 1
+        ranges[i:j] = [(merged_start, merged_end)]
+        new = merged_end - merged_start - seen
+        self.received += new
+        return new
+
+
+class Reassembler:
+    """
+    Parameters
+    ----------
+    max_bytes : int
+        Total size of the buffers of incomplete transfers.  Transfers that
+        do not fit are dropped.
+    timeout : float
+        Seconds without a chunk after which an incomplete transfer is
+        dropped (see :meth:`expire`).
+    """
+
+    def __init__(self, max_bytes: int = 256 << 20,
+                 timeout: float = 60.) -> None:
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        #: Bytes held by incomplete transfers.
+        self.in_use = 0
+        #: Transfers completed, expired and rejected (too large).
+        self.completed = 0
+        self.expired = 0
+        self.rejected = 0
+        self._transfers = {}
+        # Rejected transfers -> deadline, to ignore their other chunks.
+        self._rejected = collections.OrderedDict()
+        self._next_expiry = 0.
+        # :meth:`expire` may be called from another thread.
+        self._lock = threading.Lock()
+
+    def add(self, topic: str, data: bytes) -> Optional[bytearray]:
+        """
+        Add a chunk (without its frame byte) received on ``topic``.
+
+        Returns the complete payload once all chunks of the transfer are
+        in, otherwise ``None``.
+
+        Raises
+        ------
+        ValueError
+            If the chunk does not fit in its transfer.
+        """
+        transfer_id, offset, total = HEADER.unpack_from(data)
+        body = memoryview(data)[HEADER.size:]
+        end = offset + len(body)
+        if end > total:
+            raise ValueError(f'Chunk [{offset}:{end}] beyond the total size '
+                             f'({total}).')
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_expiry:
+                self._expire(now)
+            return self._add(topic, transfer_id, offset, end, total, body,
+                             now)
+
+    def expire(self) -> None:
+        """
+        Drop the transfers without a chunk for ``timeout`` seconds.
+
+        Also done as chunks arrive; called periodically by the reactor
+        so stalled transfers are released when no chunk arrives at all.
+        """
+        with self._lock:
+            self._expire(time.monotonic())
+
+    def _add(self, topic: str, transfer_id: int, offset: int, end: int,
+             total: int, body: memoryview,
+             now: float) -> Optional[bytearray]:
+        key = (topic, transfer_id)
+        transfer = self._transfers.get(key)
+        if transfer is None:
+            if key in self._rejected:
+                return None
+            if self.in_use + total > self.max_bytes:
+                logger.warning('Dropping chunked transfer on %s (%d bytes): '
+                               'reassembly memory limit reached.', topic,
+                               total)
+                self.rejected += 1
+                self._rejected[key] = now + self.timeout
+                return None
+            transfer = self._transfers[key] = \
+                _IncomingTransfer(total, now + self.timeout)
+            self.in_use += total
+        if end > offset and not transfer.add_range(offset, end):
+            # Redelivered (QoS 1) or duplicate chunk.
+            return None
+        transfer.buffer[offset:end] = body
+        transfer.deadline = now + self.timeout
+        if transfer.received < total:
+            return None
+        del self._transfers[key]
+        self.in_use -= total
+        self.completed += 1
+        return transfer.buffer
+
+    def _expire(self, now: float) -> None:
+        for key, transfer in list(self._transfers.items()):
+            if transfer.deadline <= now:
+                logger.warning('Dropping incomplete chunked transfer on %s '
+                               '(%d/%d bytes): timed out.', key[0],
+                               transfer.received, len(transfer.buffer))
+                del self._transfers[key]
+                self.in_use -= len(transfer.buffer)
+                self.expired += 1
+        while self._rejected:
+            key, deadline = next(iter(self._rejected.items()))
+            if deadline > now:
+                break
+            del self._rejected[key]
+        self._next_expiry = now + min(self.timeout, 1.)
@@ -0,0 +1,173 @@
+# coding: utf-8
+"""
+JSON payload encoding/decoding with lazily loaded pandas support.
+
+:mod:`pandas_helpers` (and therefore :mod:`pandas`) is only imported the
+first time a pandas object is encoded or a payload that may contain one is
+decoded, so reactors handling plain JSON start without paying for pandas.
+"""
+import collections
+import json
+import threading
+
+from typing import Any, Union
+
+_pandas_helpers = None
+
+# Frame bytes.  JSON text never starts with a byte below ``0x09``, so a
+# payload starting with one of these carries a binary header (see
+# :func:`is_framed`).
+#: Payload prefixed with an :mod:`~paho_mqtt_helpers.envelope` header.
+ENVELOPE = 0x01
+#: :mod:`~paho_mqtt_helpers.compression` header and compressed payload.
+COMPRESSED = 0x02
+#: One :mod:`~paho_mqtt_helpers.chunking` chunk of a larger payload.
+CHUNK = 0x03
+#: :mod:`~paho_mqtt_helpers.sharedmem` descriptor of a shared memory object.
+SHARED_MEMORY = 0x04
+#: :mod:`~paho_mqtt_helpers.blobs` reference to a content-addressed blob.
+BLOB = 0x05
+#: :mod:`~paho_mqtt_helpers.delta` keyframe or delta of a state dictionary.
+DELTA = 0x06
+
+#: :func:`pandas_object_hook` rebuilds a pandas object from the class name
+#: its encoding carries, so payloads without any of these are decoded
+#: without the hook.
+PANDAS_MARKERS = (b'DataFrame', b'Series')
+
+
+def _load_pandas_helpers():
+    global _pandas_helpers
+    if _pandas_helpers is None:
+        import pandas_helpers
+        _pandas_helpers = pandas_helpers
+    return _pandas_helpers
+
+
+class PandasJsonEncoder(json.JSONEncoder):
+    """
+    :class:`pandas_helpers.PandasJsonEncoder` that only imports pandas when
+    it meets an object the standard encoder cannot handle.
+    """
+
+    _encoder = None
+
+    def default(self, object_):
+        if self._encoder is None:
+            self._encoder = _load_pandas_helpers().PandasJsonEncoder()
+        return self._encoder.default(object_)
+
+
+def pandas_object_hook(obj: dict) -> Any:
+    """Lazily loaded :func:`pandas_helpers.pandas_object_hook`."""
+    return _load_pandas_helpers().pandas_object_hook(obj)
+
+
+def may_contain_pandas(payload: Union[bytes, str]) -> bool:
+    """``True`` if ``payload`` contains one of :data:`PANDAS_MARKERS`."""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    return any(marker in payload for marker in PANDAS_MARKERS)
+
+
+def is_framed(payload: bytes) -> bool:
+    """``True`` if ``payload`` starts with a frame byte (e.g., COMPRESSED)."""
+    return bool(payload) and payload[0] < 0x09
+
+
+def encode(msg: Any) -> str:
+    return json.dumps(msg, cls=PandasJsonEncoder)
+
+
+class Encoded(bytes):
+    """
+    Payload encoded once by :func:`pre_encode`; ``sendMessage`` publishes
+    it as is.
+    """
+    __slots__ = ()
+
+
+def pre_encode(msg: Any) -> Encoded:
+    """
+    Encode ``msg`` once for repeated publishing, e.g., a constant command
+    sent with ``sendMessage(topic, PING)``.
+    """
+    return Encoded(encode(msg).encode('utf-8'))
+
+
+# Types of the messages :class:`EncodeCache` keys by value.
+_VALUE_KEYED = (str, bytes, int, float)
+
+
+class EncodeCache:
+    """
+    Bounded cache of encoded payloads, for ``sendMessage(..., cache=True)``.
+
+    Strings, bytes, integers and floats (exact types) are keyed by value;
+    other messages (e.g., a DataFrame sent to several topics, or a tuple,
+    which may hold mutable items) by identity, holding a reference so the
+    identity stays valid.  Cached messages must not be modified.
+
+    Parameters
+    ----------
+    max_entries : int
+    max_bytes : int
+        Total size of the cached payloads.
+    """
+
+    def __init__(self, max_entries: int = 128,
+                 max_bytes: int = 64 << 20) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Key -> (message, encoded), least recently used first.
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def encode(self, msg: Any) -> bytes:
+        # Subclasses may hash and compare other than by value.
+        key = (type(msg), msg) if type(msg) in _VALUE_KEYED else id(msg)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] is msg or
+                                      not isinstance(key, int)):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+        encoded = encode(msg).encode('utf-8')
+        with self._lock:
+            self.misses += 1
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous[1])
+            self._entries[key] = (msg, encoded)
+            self._bytes += len(encoded)
+            while self._entries and (len(self._entries) > self.max_entries or
+                                     self._bytes > self.max_bytes):
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+        return encoded
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+def decode(payload: Union[bytes, str]) -> Any:
+    """
+    Decode a JSON payload, restoring pandas objects if present.
+
+    Raises
+    ------
+    ValueError
+        If ``payload`` is not valid JSON.
+    """
+    if may_contain_pandas(payload):
+        return json.loads(payload, object_hook=pandas_object_hook)
+    return json.loads(payload)
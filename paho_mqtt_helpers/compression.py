@@ -0,0 +1,346 @@
+# coding: utf-8
+"""
+Optional compression of large payloads.
+
+:meth:`BaseMqttReactor.enable_compression` compresses encoded payloads of at
+least ``threshold`` bytes.  Compressed payloads are framed (see
+:data:`paho_mqtt_helpers.codec.COMPRESSED`) as::
+
+    0x02 | codec id (u1) | dictionary id (u4, 0 for none) | data
+
+so receivers decompress transparently, whatever the protocol version.
+``zlib`` is always available; ``zstd`` and ``lz4`` need the
+:mod:`zstandard` and :mod:`lz4` packages.
+
+Receivers refuse payloads decompressing to more than
+:attr:`Decompressor.max_size` bytes (decompression bombs).
+
+For small, repetitive JSON messages (e.g., device state), compression only
+pays off with a dictionary shared by sender and receiver (see
+:func:`build_dictionary`): ``zlib`` uses it as a preset dictionary and
+``zstd`` as a trained dictionary.
+"""
+import struct
+import zlib
+
+from typing import Iterable, Optional
+
+from .codec import COMPRESSED
+
+HEADER = struct.Struct('!BI')
+CODECS = {'zlib': 0, 'zstd': 1, 'lz4': 2}
+_CODEC_NAMES = {id_: name for name, id_ in CODECS.items()}
+#: Default maximum decompressed size (the maximum MQTT payload size).
+MAX_SIZE = 256 << 20
+
+_modules = {}
+
+
+def _module(name: str):
+    """Import the module implementing codec ``name`` (cached)."""
+    try:
+        return _modules[name]
+    except KeyError:
+        pass
+    try:
+        if name == 'zstd':
+            import zstandard as module
+        elif name == 'lz4':
+            import lz4.frame as module
+        else:
+            module = zlib
+    except ImportError:
+        raise ValueError(f'{name} compression requires the '
+                         f"{'zstandard' if name == 'zstd' else name} "
+                         'package.')
+    _modules[name] = module
+    return module
+
+
+def available() -> list:
+    """Names of the codecs that can be used here."""
+    names = []
+    for name in CODECS:
+        try:
+            _module(name)
+        except ValueError:
+            continue
+        names.append(name)
+    return names
+
+
+def dictionary_id(dictionary: bytes) -> int:
+    # 0 means "no dictionary".
+    return zlib.crc32(dictionary) or 1
+
+
+def build_dictionary(samples: Iterable[bytes], size: int = 16384,
+                     codec: str = 'zlib') -> bytes:
+    """
+    Build a shared dictionary from sample payloads.
+
+    With ``zstd`` the dictionary is trained from the samples; otherwise it is
+    the concatenation of the most recent samples (``zlib`` favours strings
+    near the end of a preset dictionary).
+    """
+    samples = list(samples)
+    if codec == 'zstd':
+        return _module('zstd').train_dictionary(size, samples).as_bytes()
+    if codec == 'lz4':
+        raise ValueError('lz4 does not support dictionaries.')
+    dictionary = b''
+    for sample in reversed(samples):
+        if len(dictionary) + len(sample) > size:
+            break
+        dictionary = sample + dictionary
+    return dictionary
+
+
+class Compressor:
+    """
+    Parameters
+    ----------
+    codec : str
+        ``'zlib'``, ``'zstd'`` or ``'lz4'``.
+    threshold : int
+        Payloads smaller than this (bytes) are sent as they are.
+    level : int, optional
+        Codec compression level (codec default if not set).
+    dictionary : bytes, optional
+        Shared dictionary (``zlib`` and ``zstd`` only); receivers must
+        register it with :meth:`Decompressor.add_dictionary`.
+
+    Raises
+    ------
+    ValueError
+        If the codec is unknown or not installed.
+    """
+
+    def __init__(self, codec: str = 'zlib', threshold: int = 1024,
+                 level: Optional[int] = None,
+                 dictionary: Optional[bytes] = None) -> None:
+        if codec not in CODECS:
+            raise ValueError(f'Unknown compression codec: {codec!r}')
+        if dictionary is not None and codec == 'lz4':
+            raise ValueError('lz4 does not support dictionaries.')
+        self.codec = codec
+        self.threshold = threshold
+        self.level = level
+        self.dictionary = dictionary
+        #: Payloads compressed and bytes in/out.
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        module = _module(codec)
+        self._header = bytes([COMPRESSED]) + HEADER.pack(
+            CODECS[codec],
+            dictionary_id(dictionary) if dictionary is not None else 0)
+        if codec == 'zstd':
+            kwargs = {} if level is None else {'level': level}
+            if dictionary is not None:
+                kwargs['dict_data'] = module.ZstdCompressionDict(dictionary)
+            self._compress = module.ZstdCompressor(**kwargs).compress
+        elif codec == 'lz4':
+            kwargs = {} if level is None else {'compression_level': level}
+            self._compress = lambda data: module.compress(data, **kwargs)
+        elif dictionary is not None:
+            level = -1 if level is None else level
+
+            def compress(data):
+                compressor = zlib.compressobj(level, zdict=dictionary)
+                return compressor.compress(data) + compressor.flush()
+            self._compress = compress
+        else:
+            self._compress = lambda data: zlib.compress(
+                data, -1 if level is None else level)
+
+    def compress(self, data: bytes) -> bytes:
+        """
+        Framed compressed ``data``, or ``data`` itself if it is below the
+        threshold or does not shrink.
+        """
+        if len(data) < self.threshold:
+            return data
+        compressed = self._compress(data)
+        framed_size = len(self._header) + len(compressed)
+        if framed_size >= len(data):
+            return data
+        self.compressed += 1
+        self.bytes_in += len(data)
+        self.bytes_out += framed_size
+        return self._header + compressed
+
+
+class Decompressor:
+    """
+    Decompress framed payloads, with any registered dictionaries.
+
+    Parameters
+    ----------
+    max_size : int, optional
+        Maximum decompressed size (bytes) of a payload, or ``None`` for no
+        limit.
+    """
+
+    def __init__(self, max_size: Optional[int] = MAX_SIZE) -> None:
+        self.max_size = max_size
+        self._dictionaries = {}
+        self._zstd = {}
+
+    def add_dictionary(self, dictionary: bytes) -> int:
+        """Register a shared dictionary; returns its ID."""
+        id_ = dictionary_id(dictionary)
+        self._dictionaries[id_] = dictionary
+        return id_
+
+    def decompress(self, data: bytes) -> bytes:
+        """
+        Decompress ``data`` (a framed payload without its frame byte).
+
+        Raises
+        ------
+        ValueError
+            If the codec or dictionary is unknown, the data is corrupt, or
+            it decompresses to more than :attr:`max_size` bytes.
+        """
+        name, dictionary_id_, dictionary = self._header(data)
+        body = data[HEADER.size:]
+        module = _module(name)
+        # One byte more than allowed tells too large payloads apart.
+        limit = None if self.max_size is None else self.max_size + 1
+        try:
+            if name == 'zstd':
+                if limit is not None and \
+                        module.frame_content_size(body) >= limit:
+                    result = None
+                else:
+                    # ``max_output_size`` bounds frames of unknown size.
+                    result = self._zstd_decompressor(
+                        dictionary_id_, dictionary).decompress(
+                            body, max_output_size=limit or 0)
+            elif name == 'lz4':
+                decompressor = module.LZ4FrameDecompressor()
+                result = decompressor.decompress(
+                    body, -1 if limit is None else limit)
+                if not decompressor.eof and len(result) != limit:
+                    raise ValueError('truncated frame')
+            else:
+                decompressor = zlib.decompressobj() if dictionary is None \
+                    else zlib.decompressobj(zdict=dictionary)
+                result = decompressor.decompress(body, limit or 0)
+                if not decompressor.unconsumed_tail:
+                    result += decompressor.flush()
+                    if not decompressor.eof:
+                        raise zlib.error('incomplete or truncated stream')
+        except Exception as exception:
+            # Each codec has its own error type.
+            raise ValueError(f'Corrupt {name} payload: {exception}')
+        if result is None or limit is not None and len(result) >= limit:
+            raise ValueError(f'{name} payload decompresses to more than '
+                             f'{self.max_size} bytes.')
+        return result
+
+    def decompressobj(self, data: bytes) -> tuple:
+        """
+        Incremental decompressor for a compressed payload starting with
+        ``data`` (without the frame byte).
+
+        Returns ``(decompressor, header size)``, where ``decompressor``
+        has ``decompress(data)`` and ``flush()`` methods to feed
+        ``data[header size:]`` and the rest of the payload to.  They raise
+        :class:`ValueError` if the data is corrupt or the payload
+        decompresses to more than :attr:`max_size` bytes in total.
+
+        Raises
+        ------
+        ValueError
+            If the codec or dictionary is unknown.
+        """
+        name, dictionary_id_, dictionary = self._header(data)
+        if name == 'zstd':
+            decompressor = self._zstd_decompressor(
+                dictionary_id_, dictionary).decompressobj()
+        elif name == 'lz4':
+            decompressor = _module('lz4').LZ4FrameDecompressor()
+        elif dictionary is not None:
+            decompressor = zlib.decompressobj(zdict=dictionary)
+        else:
+            decompressor = zlib.decompressobj()
+        return _Incremental(name, decompressor, self.max_size), HEADER.size
+
+    def _header(self, data: bytes) -> tuple:
+        """``(codec name, dictionary ID, dictionary)`` of ``data``."""
+        codec_id, dictionary_id_ = HEADER.unpack_from(data)
+        name = _CODEC_NAMES.get(codec_id)
+        if name is None:
+            raise ValueError(f'Unknown compression codec ID: {codec_id}')
+        dictionary = None
+        if dictionary_id_:
+            dictionary = self._dictionaries.get(dictionary_id_)
+            if dictionary is None:
+                raise ValueError(f'Unknown compression dictionary: '
+                                 f'{dictionary_id_:#010x}')
+        return name, dictionary_id_, dictionary
+
+    def _zstd_decompressor(self, id_: int, dictionary: Optional[bytes]):
+        try:
+            return self._zstd[id_]
+        except KeyError:
+            module = _module('zstd')
+            kwargs = {} if dictionary is None else \
+                {'dict_data': module.ZstdCompressionDict(dictionary)}
+            self._zstd[id_] = decompressor = \
+                module.ZstdDecompressor(**kwargs)
+            return decompressor
+
+
+class _Incremental:
+    """Codec decompressor capped to ``max_size`` bytes over all calls."""
+
+    def __init__(self, name: str, decompressor,
+                 max_size: Optional[int]) -> None:
+        self.name = name
+        self.max_size = max_size
+        #: Bytes decompressed so far.
+        self.size = 0
+        self._decompressor = decompressor
+
+    def decompress(self, data: bytes) -> bytes:
+        # As in :meth:`Decompressor.decompress`, one byte more than allowed
+        # tells too large payloads apart, without inflating them further.
+        limit = None if self.max_size is None else \
+            self.max_size - self.size + 1
+        try:
+            if self.name == 'zlib':
+                result = self._decompressor.decompress(data, limit or 0)
+            elif self.name == 'lz4':
+                result = self._decompressor.decompress(
+                    data, -1 if limit is None else limit)
+            else:
+                # Only checked afterwards: zstd has no output bound here.
+                result = self._decompressor.decompress(data)
+        except Exception as exception:
+            raise ValueError(f'Corrupt {self.name} payload: {exception}')
+        return self._count(result)
+
+    def flush(self) -> bytes:
+        """Remaining output, once the whole payload was fed."""
+        if self.name == 'zlib':
+            try:
+                result = self._decompressor.flush()
+            except zlib.error as exception:
+                raise ValueError(f'Corrupt zlib payload: {exception}')
+            result = self._count(result)
+        else:
+            result = b''
+        if not getattr(self._decompressor, 'eof', True):
+            raise ValueError(f'Corrupt {self.name} payload: incomplete or '
+                             'truncated stream')
+        return result
+
+    def _count(self, result: bytes) -> bytes:
+        self.size += len(result)
+        if self.max_size is not None and self.size > self.max_size:
+            raise ValueError(f'{self.name} payload decompresses to more '
+                             f'than {self.max_size} bytes.')
+        return result
@@ -0,0 +1,75 @@
+# coding: utf-8
+"""
+Suppression of identical consecutive publishes.
+
+With :meth:`BaseMqttReactor.enable_dedup`, ``sendMessage`` hashes each
+encoded payload and skips publishing it if it is identical to the previous
+payload published on the same topic (with the same ``retain`` and ``qos``),
+e.g., heartbeats or unchanged states.  With ``max_interval``, an identical
+payload is published anyway once ``max_interval`` seconds have passed
+since the last publish on the topic, so receivers still see the sender is
+alive.
+"""
+import hashlib
+import threading
+import time
+
+from typing import Optional, Union
+
+
+class PublishDeduplicator:
+    """
+    Parameters
+    ----------
+    max_interval : float, optional
+        Maximum seconds during which identical payloads are suppressed.
+    max_topics : int
+        Topics remembered; the table is cleared when it grows larger.
+    """
+
+    def __init__(self, max_interval: Optional[float] = None,
+                 max_topics: int = 65536) -> None:
+        self.max_interval = max_interval
+        self.max_topics = max_topics
+        #: Publishes suppressed, and their payload bytes.
+        self.suppressed = 0
+        self.suppressed_bytes = 0
+        self._lock = threading.Lock()
+        # Topic -> (digest, time published).
+        self._last = {}
+
+    def suppress(self, topic: str, message: Union[bytes, str],
+                 retain: bool = False, qos: int = 0) -> bool:
+        """
+        ``True`` if ``message`` must not be published (identical to the
+        previous publish on ``topic``); otherwise remembers it.
+        """
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        digest = hashlib.blake2b(message, digest_size=16,
+                                 person=bytes([retain, qos])).digest()
+        now = time.monotonic()
+        with self._lock:
+            last = self._last.get(topic)
+            if last is not None and last[0] == digest and \
+                    (self.max_interval is None or
+                     now - last[1] < self.max_interval):
+                self.suppressed += 1
+                self.suppressed_bytes += len(message)
+                return True
+            if last is None and len(self._last) >= self.max_topics:
+                self._last.clear()
+            self._last[topic] = (digest, now)
+        return False
+
+    def forget(self, topic: str = None) -> None:
+        """Publish the next message on ``topic`` (or any topic) anyway."""
+        with self._lock:
+            if topic is None:
+                self._last.clear()
+            else:
+                self._last.pop(topic, None)
+
+    def to_dict(self) -> dict:
+        return {'suppressed': self.suppressed,
+                'suppressed_bytes': self.suppressed_bytes}
@@ -0,0 +1,297 @@
+# coding: utf-8
+"""
+Delta encoding of state dictionaries published repeatedly.
+
+``sendMessage(topic, state, delta=True)`` (see
+:meth:`BaseMqttReactor.enable_deltas`) publishes a full *keyframe* of
+``state`` first, then only the changes since the previous publish on the
+same topic, as JSON-patch style operations, framed (see
+:data:`paho_mqtt_helpers.codec.DELTA`) as::
+
+    0x06 | kind (u1: 0 keyframe, 1 delta) | sender (u4) | sequence (u8) | JSON
+
+    [{"op": "replace", "path": "/device/voltage", "value": 100},
+     {"op": "remove", "path": "/electrodes/~1e12"}, ...]
+
+Nested dictionaries are diffed key by key; any other changed value (list,
+DataFrame, ...) is replaced as a whole.  The sender diffs against a copy
+of the previous state (values included), so values modified in place
+between publishes are detected too.  A keyframe is sent every
+``keyframe_interval`` publishes.
+
+Receivers rebuild the full state before calling the handler.  Patched
+states share unchanged nested dictionaries with the previous state, so
+handlers must not modify them.  A delta that does not follow the last
+message received from the same sender (lost message, sender restart, late
+subscriber) is dropped, and a keyframe is requested on
+``<base>/delta/keyframe``.
+"""
+import copy
+import os
+import struct
+import threading
+import time
+
+from typing import Any, Callable, Optional
+
+from . import codec
+
+HEADER = struct.Struct('!BIQ')
+KEYFRAME, DELTA = 0, 1
+OPERATIONS = ('add', 'replace', 'remove')
+# Values shared (not copied) by state snapshots.
+_IMMUTABLE = (str, int, float, bool, bytes, type(None))
+
+
+def _escape(key) -> str:
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+
+def _unescape(token: str) -> str:
+    return token.replace('~1', '/').replace('~0', '~')
+
+
+def _equal(a: Any, b: Any) -> bool:
+    if a is b:
+        return True
+    if type(a) is not type(b):
+        return False
+    equals = getattr(a, 'equals', None)
+    try:
+        if equals is not None:
+            # pandas objects.
+            return bool(equals(b))
+        return bool(a == b)
+    except (TypeError, ValueError):
+        pass
+    try:
+        # Arrays compare element-wise.
+        return a.shape == b.shape and bool((a == b).all())
+    except Exception:
+        return False
+
+
+def _snapshot(state: Any) -> Any:
+    """
+    Deep copy of ``state``, sharing only immutable values, so that values
+    modified in place after a publish are diffed against their old value.
+    """
+    if isinstance(state, dict):
+        return {key: _snapshot(value) for key, value in state.items()}
+    if isinstance(state, list):
+        return [_snapshot(value) for value in state]
+    if isinstance(state, _IMMUTABLE):
+        return state
+    return copy.deepcopy(state)
+
+
+def diff(old: dict, new: dict, path: str = '') -> list:
+    """Operations turning ``old`` into ``new``."""
+    operations = []
+    for key in old:
+        if key not in new:
+            operations.append({'op': 'remove',
+                               'path': f'{path}/{_escape(key)}'})
+    for key, value in new.items():
+        key_path = f'{path}/{_escape(key)}'
+        if key not in old:
+            operations.append({'op': 'add', 'path': key_path,
+                               'value': value})
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            operations.extend(diff(old[key], value, key_path))
+        elif not _equal(old[key], value):
+            operations.append({'op': 'replace', 'path': key_path,
+                               'value': value})
+    return operations
+
+
+def patch(state: dict, operations: list) -> dict:
+    """
+    Apply ``operations`` to a copy of ``state``; only the dictionaries on
+    the patched paths are copied.
+
+    Raises
+    ------
+    ValueError
+        If ``operations`` is not a list of valid operations, or an
+        operation does not apply to ``state``.
+    """
+    if not isinstance(operations, list):
+        raise ValueError('Invalid delta: not a list of operations.')
+    result = dict(state)
+    copied = {id(result)}
+    for operation in operations:
+        if not isinstance(operation, dict) or \
+                operation.get('op') not in OPERATIONS or \
+                not isinstance(operation.get('path'), str) or \
+                not operation['path'].startswith('/') or \
+                (operation['op'] != 'remove' and 'value' not in operation):
+            raise ValueError(f'Invalid delta operation: {operation!r}')
+        *parents, key = [_unescape(token) for token in
+                         operation['path'].split('/')[1:]]
+        node = result
+        for parent in parents:
+            child = node.get(parent)
+            if not isinstance(child, dict):
+                raise ValueError(f'Invalid delta path: {operation["path"]}')
+            if id(child) not in copied:
+                child = node[parent] = dict(child)
+                copied.add(id(child))
+            node = child
+        if operation['op'] == 'remove':
+            node.pop(key, None)
+        else:
+            node[key] = operation['value']
+    return result
+
+
+class _Sent:
+    __slots__ = ('state', 'sequence', 'since_keyframe', 'keyframe_time',
+                 'retain', 'qos')
+
+    def __init__(self) -> None:
+        self.state = None
+        self.sequence = 0
+        self.since_keyframe = 0
+        self.keyframe_time = 0.
+        self.retain = False
+        self.qos = 0
+
+
+class _Received:
+    __slots__ = ('sender', 'sequence', 'state', 'requested')
+
+    def __init__(self) -> None:
+        self.sender = None
+        self.sequence = None
+        self.state = None
+        self.requested = 0.
+
+
+class DeltaCodec:
+    """
+    Parameters
+    ----------
+    request_keyframe : callable
+        ``request_keyframe(topic)`` asks the senders on ``topic`` for a
+        keyframe.
+    request_interval : float
+        Minimum seconds between keyframe requests (received) or keyframes
+        sent on request, per topic.
+    """
+
+    def __init__(self, request_keyframe: Callable,
+                 request_interval: float = 1.) -> None:
+        self.request_keyframe = request_keyframe
+        self.request_interval = request_interval
+        #: Publishes between keyframes (see
+        #: :meth:`BaseMqttReactor.enable_deltas`).
+        self.keyframe_interval = None
+        #: Counters: keyframes and deltas sent, deltas received and dropped.
+        self.keyframes = 0
+        self.deltas = 0
+        self.applied = 0
+        self.dropped = 0
+        self.sender = int.from_bytes(os.urandom(4), 'big')
+        self._lock = threading.Lock()
+        self._sent = {}
+        self._received = {}
+
+    ###########################################################################
+    # Sender
+    # ======
+    def encode(self, topic: str, state: dict, retain: bool = False,
+               qos: int = 0) -> bytes:
+        """
+        Framed keyframe or delta of ``state`` (a dictionary) on ``topic``.
+
+        Raises
+        ------
+        ValueError
+            If delta encoding is not enabled or ``state`` is not a
+            dictionary.
+        """
+        if self.keyframe_interval is None:
+            raise ValueError('Delta encoding is not enabled (see '
+                             'enable_deltas()).')
+        if not isinstance(state, dict):
+            raise ValueError('Only dictionaries can be delta encoded.')
+        with self._lock:
+            sent = self._sent.setdefault(topic, _Sent())
+            keyframe = sent.state is None or \
+                sent.since_keyframe >= self.keyframe_interval
+            operations = None if keyframe else diff(sent.state, state)
+            sent.state = _snapshot(state)
+            sent.sequence += 1
+            sent.retain, sent.qos = retain, qos
+            if keyframe:
+                sent.since_keyframe = 0
+                sent.keyframe_time = time.monotonic()
+                self.keyframes += 1
+            else:
+                sent.since_keyframe += 1
+                self.deltas += 1
+            header = bytes([codec.DELTA]) + \
+                HEADER.pack(DELTA if operations is not None else KEYFRAME,
+                            self.sender, sent.sequence)
+        body = codec.encode(state if operations is None else operations)
+        return header + body.encode('utf-8')
+
+    def keyframe_request(self, topic: str) -> Optional[tuple]:
+        """
+        ``(state, retain, qos)`` to publish again, as a keyframe, in
+        answer to a request, or ``None`` (not sent here, or answered
+        recently).
+        """
+        with self._lock:
+            sent = self._sent.get(topic)
+            if sent is None or time.monotonic() - sent.keyframe_time < \
+                    self.request_interval:
+                return None
+            # The next publish on ``topic`` is a keyframe.
+            sent.since_keyframe = self.keyframe_interval
+            return sent.state, sent.retain, sent.qos
+
+    ###########################################################################
+    # Receiver
+    # ========
+    def decode(self, topic: str, data: bytes) -> Optional[dict]:
+        """
+        Full state for a keyframe or delta (without its frame byte)
+        received on ``topic``, or ``None`` if a delta was dropped.
+
+        Raises
+        ------
+        ValueError
+            If the payload is invalid.
+        """
+        if len(data) < HEADER.size:
+            raise ValueError('Invalid delta header.')
+        kind, sender, sequence = HEADER.unpack_from(data)
+        if kind not in (KEYFRAME, DELTA):
+            raise ValueError(f'Invalid delta kind: {kind}')
+        body = codec.decode(data[HEADER.size:])
+        received = self._received.get(topic)
+        if received is None:
+            received = self._received[topic] = _Received()
+        if kind == KEYFRAME and not isinstance(body, dict):
+            raise ValueError('Invalid delta keyframe.')
+        if received.sender == sender and received.sequence >= sequence:
+            # Redelivered (QoS 1) or older message, keyframes included.
+            return None
+        if kind == KEYFRAME:
+            state = body
+        elif received.sender == sender and \
+                received.sequence + 1 == sequence:
+            state = patch(received.state, body)
+            self.applied += 1
+        else:
+            self.dropped += 1
+            now = time.monotonic()
+            if now - received.requested >= self.request_interval:
+                received.requested = now
+                self.request_keyframe(topic)
+            return None
+        received.sender, received.sequence = sender, sequence
+        received.state = state
+        return state
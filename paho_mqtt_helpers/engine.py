@@ -0,0 +1,317 @@
+# coding: utf-8
+"""
+Drive many :class:`paho.mqtt.client.Client` instances from a single thread.
+
+Each client started through :meth:`BaseMqttReactor.start` normally blocks a
+thread in ``loop_forever()``.  :class:`MqttSelectorEngine` instead registers
+every client socket with one :mod:`selectors` loop and uses paho's external
+loop hooks (``socket()``, ``loop_read()``, ``loop_write()`` and
+``loop_misc()``).  Keepalive housekeeping is scheduled on a hashed
+:class:`TimerWheel`, so the cost of a loop iteration does not grow with the
+number of idle clients.
+"""
+import logging
+import math
+import selectors
+import socket
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Timer:
+    """Handle returned by :meth:`TimerWheel.schedule`."""
+    __slots__ = ('callback', 'deadline', 'rounds', 'slot', 'cancelled')
+
+    def __init__(self, callback: Callable, deadline: float) -> None:
+        self.callback = callback
+        self.deadline = deadline
+        self.rounds = 0
+        self.slot = 0
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel with a fixed ``tick`` resolution.
+
+    Scheduling and cancelling are O(1); :meth:`advance` only visits the slots
+    whose tick has elapsed.
+    """
+
+    def __init__(self, tick: float = 0.1, slots: int = 512) -> None:
+        self.tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._current = 0
+        self._next_tick = time.monotonic() + tick
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def schedule(self, delay: float, callback: Callable) -> Timer:
+        """Call ``callback()`` after ``delay`` seconds."""
+        now = time.monotonic()
+        if not self._count and self._next_tick < now:
+            # Wheel was idle; resynchronise instead of replaying missed ticks.
+            self._next_tick = now + self.tick
+        timer = Timer(callback, now + delay)
+        # The current slot fires at ``self._next_tick``.
+        ticks = max(int(math.ceil((now + delay - self._next_tick) /
+                                  self.tick)), 0)
+        timer.rounds, offset = divmod(ticks, len(self._slots))
+        timer.slot = (self._current + offset) % len(self._slots)
+        self._slots[timer.slot].append(timer)
+        self._count += 1
+        return timer
+
+    def timeout(self) -> Optional[float]:
+        """Seconds until the next tick, or ``None`` if nothing is scheduled."""
+        if not self._count:
+            return None
+        return max(self._next_tick - time.monotonic(), 0)
+
+    def advance(self, now: Optional[float] = None) -> int:
+        """Fire every timer due at ``now``; returns the number fired."""
+        if now is None:
+            now = time.monotonic()
+        fired = 0
+        while self._next_tick <= now and self._count:
+            index = self._current
+            due = self._slots[index]
+            self._slots[index] = []
+            # Move on before firing so callbacks schedule relative to the
+            # next tick.
+            self._current = (index + 1) % len(self._slots)
+            self._next_tick += self.tick
+            for timer in due:
+                if timer.cancelled:
+                    self._count -= 1
+                elif timer.rounds > 0:
+                    timer.rounds -= 1
+                    self._slots[index].append(timer)
+                else:
+                    self._count -= 1
+                    fired += 1
+                    try:
+                        timer.callback()
+                    except Exception:
+                        logger.exception('Error in timer callback.')
+        return fired
+
+
+class MqttSelectorEngine:
+    """
+    Run the network loop of many MQTT clients on one thread.
+
+    Example
+    -------
+
+    >>> engine = MqttSelectorEngine()
+    >>> for reactor in reactors:
+    ...     reactor.start(engine=engine)
+    >>> engine.run_forever()
+    """
+
+    def __init__(self, misc_interval: float = 1.0, tick: float = 0.1) -> None:
+        self.misc_interval = misc_interval
+        self.wheel = TimerWheel(tick=tick)
+        self._selector = selectors.DefaultSelector()
+        self._clients = {}
+        self._lock = threading.RLock()
+        self._running = False
+        # Self-pipe so other threads (e.g., ``publish()`` callers) can wake
+        # up a blocking ``select()``.
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    ###########################################################################
+    # Client management
+    # =================
+    def add(self, client: mqtt.Client) -> None:
+        """Take over the network loop of ``client``."""
+        with self._lock:
+            if client in self._clients:
+                return
+            client.on_socket_open = self._on_socket_open
+            client.on_socket_close = self._on_socket_close
+            client.on_socket_register_write = self._on_socket_register_write
+            client.on_socket_unregister_write = \
+                self._on_socket_unregister_write
+            # Spread keepalive housekeeping across the wheel.
+            delay = self.misc_interval * (len(self._clients) % 64) / 64
+            self._clients[client] = self.wheel.schedule(
+                delay, lambda: self._misc(client))
+            sock = client.socket()
+            if sock is not None:
+                self._register(client, sock)
+                if client.want_write():
+                    self._on_socket_register_write(client, None, sock)
+        self._wake()
+
+    def remove(self, client: mqtt.Client) -> None:
+        """Stop driving ``client`` (its socket is left open)."""
+        with self._lock:
+            timer = self._clients.pop(client, None)
+            if timer is None:
+                return
+            timer.cancel()
+            sock = client.socket()
+            if sock is not None:
+                self._unregister(sock)
+            client.on_socket_open = None
+            client.on_socket_close = None
+            client.on_socket_register_write = None
+            client.on_socket_unregister_write = None
+
+    def call_later(self, delay: float, callback: Callable) -> Timer:
+        """Run ``callback()`` on the engine thread after ``delay`` seconds."""
+        with self._lock:
+            timer = self.wheel.schedule(delay, callback)
+        self._wake()
+        return timer
+
+    ###########################################################################
+    # Loop
+    # ====
+    def run_once(self, timeout: Optional[float] = None) -> None:
+        wheel_timeout = self.wheel.timeout()
+        if wheel_timeout is not None:
+            timeout = wheel_timeout if timeout is None \
+                else min(timeout, wheel_timeout)
+        for key, events in self._selector.select(timeout):
+            client = key.data
+            if client is None:
+                self._drain_wake()
+                # Publishes from other threads may have raced with the write
+                # interest of a client (see ``_update_write``).
+                for client in list(self._clients):
+                    self._update_write(client)
+                continue
+            if events & selectors.EVENT_READ:
+                rc = client.loop_read()
+                if rc != mqtt.MQTT_ERR_SUCCESS:
+                    continue
+            if events & selectors.EVENT_WRITE:
+                client.loop_write()
+            self._update_write(client)
+        with self._lock:
+            self.wheel.advance()
+
+    def run_forever(self) -> None:
+        self._running = True
+        try:
+            while self._running:
+                self.run_once()
+        finally:
+            self._running = False
+
+    def stop(self) -> None:
+        """Ask :meth:`run_forever` to return (callable from any thread)."""
+        self._running = False
+        self._wake()
+
+    def close(self) -> None:
+        for client in list(self._clients):
+            self.remove(client)
+        self._selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    ###########################################################################
+    # Private methods
+    # ===============
+    def _misc(self, client: mqtt.Client) -> None:
+        if client not in self._clients:
+            return
+        client.loop_misc()
+        self._update_write(client)
+        self._clients[client] = self.wheel.schedule(
+            self.misc_interval, lambda: self._misc(client))
+
+    def _update_write(self, client: mqtt.Client) -> None:
+        """
+        Set the write interest of ``client`` from ``want_write()``.
+
+        paho checks ``want_write()`` and calls ``on_socket_unregister_write``
+        without a lock, so a ``publish()`` from another thread in between
+        would otherwise leave its packet queued with no write interest.
+        Called on the engine thread only (``want_write()`` peeks at the
+        queue the engine thread consumes).
+        """
+        with self._lock:
+            sock = client.socket()
+            if sock is None or client not in self._clients:
+                return
+            events = selectors.EVENT_READ
+            if client.want_write():
+                events |= selectors.EVENT_WRITE
+            try:
+                if self._selector.get_key(sock).events != events:
+                    self._selector.modify(sock, events, client)
+            except (KeyError, ValueError):
+                pass
+
+    def _register(self, client: mqtt.Client, sock) -> None:
+        try:
+            self._selector.register(sock, selectors.EVENT_READ, client)
+        except KeyError:
+            self._selector.modify(sock, selectors.EVENT_READ, client)
+
+    def _unregister(self, sock) -> None:
+        try:
+            self._selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def _wake(self) -> None:
+        try:
+            self._wake_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def _drain_wake(self) -> None:
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    ###########################################################################
+    # paho socket callbacks
+    # =====================
+    def _on_socket_open(self, client, userdata, sock) -> None:
+        with self._lock:
+            self._register(client, sock)
+        self._wake()
+
+    def _on_socket_close(self, client, userdata, sock) -> None:
+        with self._lock:
+            self._unregister(sock)
+
+    def _on_socket_register_write(self, client, userdata, sock) -> None:
+        with self._lock:
+            try:
+                self._selector.modify(
+                    sock, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+            except (KeyError, ValueError):
+                return
+        self._wake()
+
+    def _on_socket_unregister_write(self, client, userdata, sock) -> None:
+        # Called by ``loop_write()`` on the engine thread; a packet may have
+        # been queued since paho checked ``want_write()``.
+        self._update_write(client)
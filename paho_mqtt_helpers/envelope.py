@@ -0,0 +1,127 @@
+# coding: utf-8
+"""
+Timestamped message envelopes for end-to-end latency measurement.
+
+:meth:`BaseMqttReactor.sendMessage` stamps each message with the sender's
+monotonic and wall clock send times plus a per-topic sequence number.  With
+MQTT 5 the envelope travels as the ``x-env`` user property; otherwise it is
+prepended to the payload as a compact binary header (see
+:data:`paho_mqtt_helpers.codec.ENVELOPE`).
+
+On receipt, latency uses the monotonic clock when sender and receiver run
+under the same kernel boot (``CLOCK_MONOTONIC`` is system-wide, including
+across containers) and the wall clock otherwise.
+"""
+import collections
+import struct
+import time
+import zlib
+
+from typing import Optional, Tuple
+
+#: User property name used with MQTT 5.
+PROPERTY = 'x-env'
+#: Binary header after the frame byte: host, sender, sequence number,
+#: monotonic send time (ns), wall clock send time (s).
+HEADER = struct.Struct('!IIIQd')
+
+#: Linux boot ID, shared by all processes (and containers) that share a
+#: ``CLOCK_MONOTONIC``; host names are neither unique nor per-kernel.
+BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+
+
+def _host_id() -> int:
+    """CRC32 of the boot ID, or ``0`` (unknown: compare wall clocks)."""
+    try:
+        with open(BOOT_ID_PATH, 'rb') as input_:
+            boot_id = input_.read().strip()
+    except OSError:
+        return 0
+    return (zlib.crc32(boot_id) or 1) if boot_id else 0
+
+
+HOST_ID = _host_id()
+
+
+class Envelope(collections.namedtuple('Envelope', 'host sender seq '
+                                                  'monotonic_ns wall')):
+    __slots__ = ()
+
+    def to_bytes(self) -> bytes:
+        return HEADER.pack(*self)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'Envelope':
+        return cls(*HEADER.unpack_from(data))
+
+    def to_property(self) -> str:
+        return f'{self.host}:{self.sender}:{self.seq}:{self.monotonic_ns}:' \
+               f'{self.wall!r}'
+
+    @classmethod
+    def from_property(cls, value: str) -> 'Envelope':
+        host, sender, seq, monotonic_ns, wall = value.split(':')
+        return cls(int(host), int(sender), int(seq), int(monotonic_ns),
+                   float(wall))
+
+    def latency(self) -> float:
+        """Seconds since the message was sent."""
+        if HOST_ID and self.host == HOST_ID:
+            return (time.monotonic_ns() - self.monotonic_ns) * 1e-9
+        return time.time() - self.wall
+
+
+class EnvelopeStamper:
+    """Create envelopes for one sender (per-topic sequence numbers)."""
+
+    def __init__(self, sender: str) -> None:
+        self.sender = zlib.crc32(sender.encode('utf-8'))
+        self._sequences = collections.defaultdict(int)
+
+    def stamp(self, topic: str) -> Envelope:
+        self._sequences[topic] = seq = (self._sequences[topic] + 1) & \
+            0xffffffff
+        return Envelope(HOST_ID, self.sender, seq, time.monotonic_ns(),
+                        time.time())
+
+
+class SequenceTracker:
+    """
+    Detect gaps in per-(sender, topic) sequence numbers.
+
+    Parameters
+    ----------
+    capacity : int
+        Number of (sender, topic) pairs remembered; the least recently seen
+        pair is forgotten first (its next message counts as a first one).
+    """
+
+    def __init__(self, capacity: int = 10000) -> None:
+        self.capacity = capacity
+        self._last = collections.OrderedDict()
+
+    def observe(self, envelope: Envelope, topic: str) -> int:
+        """Return the number of messages missing before ``envelope``."""
+        key = (envelope.sender, topic)
+        last = self._last.pop(key, None)
+        self._last[key] = envelope.seq
+        if len(self._last) > self.capacity:
+            self._last.popitem(last=False)
+        if last is None or envelope.seq <= last:
+            # First message, sender restart or reordering.
+            return 0
+        return envelope.seq - last - 1
+
+
+def from_message(msg) -> Optional[Envelope]:
+    """Envelope carried as an MQTT 5 user property, if any."""
+    properties = getattr(msg, 'properties', None)
+    for name, value in getattr(properties, 'UserProperty', None) or ():
+        if name == PROPERTY:
+            return Envelope.from_property(value)
+    return None
+
+
+def split(data: bytes) -> Tuple[Envelope, bytes]:
+    """Split a framed payload (without the frame byte) into envelope, body."""
+    return Envelope.from_bytes(data), data[HEADER.size:]
@@ -0,0 +1,301 @@
+# coding: utf-8
+"""
+Ping/pong load test for MQTT brokers and reactors.
+
+Usage::
+
+    python -m paho_mqtt_helpers.loadtest --local --clients 10 --rate 5000
+    python -m paho_mqtt_helpers.loadtest --host broker --qos 1 \\
+        --payload-size 1024 --clients 100 --duration 30 --json
+
+An :class:`EchoReactor` answers every ping on
+``<base>/loadtest-echo/ping/<client>`` with the same payload on
+``<base>/<client>/pong``.  Each :class:`PingReactor` records the round-trip
+latency of its pongs, i.e., publish -> broker -> echo handler -> broker ->
+ping handler.  Two load patterns are available:
+
+- open loop (``--rate N``): pings are sent at ``N`` messages per second in
+  total, spread evenly over the clients, whether or not pongs come back;
+- closed loop (``--rate 0``): each client keeps ``--window`` pings in
+  flight, so throughput is whatever the broker and reactors sustain.
+
+The echo and ping reactors each run on their own
+:class:`~paho_mqtt_helpers.engine.MqttSelectorEngine` thread.  Use
+``--role echo`` and ``--role ping`` to run them on different machines.
+``--local`` starts an in-process :class:`~paho_mqtt_helpers.broker.FakeBroker`
+instead of connecting to ``--host``/``--port``.
+"""
+import argparse
+import json
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from typing import List
+
+from . import BaseMqttReactor
+from .engine import MqttSelectorEngine
+
+ECHO_NAME = 'loadtest-echo'
+
+
+class _LoadTestReactor(BaseMqttReactor):
+    """Reactor with an explicit plugin name and a subscription barrier."""
+
+    def __init__(self, name: str, qos: int = 0, **kwargs) -> None:
+        # Several instances share this module, so the plugin name (and thus
+        # topics and client ID) must not be derived from the class location.
+        self._plugin_name = name
+        self.qos = qos
+        #: Set once the broker acknowledged every subscription.
+        self.ready = threading.Event()
+        self._acknowledged = 0
+        super().__init__(**kwargs)
+        self.subscription_qos = qos
+        self.mqtt_client.on_subscribe = self._on_subscribe
+
+    def _on_subscribe(self, *args) -> None:
+        self._acknowledged += 1
+        if self._acknowledged >= len(self.subscriptions):
+            self.ready.set()
+
+
+class EchoReactor(_LoadTestReactor):
+    """Reply to each ping with the same payload."""
+
+    def __init__(self, **kwargs) -> None:
+        self.echoed = 0
+        super().__init__(ECHO_NAME, **kwargs)
+
+    def listen(self) -> None:
+        self.addGetRoute(self.plugin_topic('ping', '{client}'), self.on_ping)
+
+    def on_ping(self, payload, args) -> None:
+        self.echoed += 1
+        self.sendMessage('/'.join((self.base, args['client'], 'pong')),
+                         payload, qos=self.qos)
+
+
+class PingReactor(_LoadTestReactor):
+    """
+    Send pings and record round-trip latencies.
+
+    Parameters
+    ----------
+    index : int
+        Client number (part of the plugin name).
+    payload_size : int
+        Padding added to each ping (bytes).
+    window : int
+        Pings kept in flight in closed-loop mode (see :meth:`start_closed`).
+    """
+
+    def __init__(self, index: int, payload_size: int = 64, window: int = 1,
+                 **kwargs) -> None:
+        self.window = window
+        self.data = 'x' * payload_size
+        #: Pings sent/pongs received while recording.
+        self.sent = 0
+        self.received = 0
+        #: Round-trip latencies (seconds) of pongs received while recording.
+        self.latencies = []
+        self.recording = False
+        self.closed_loop = False
+        self._seq = 0
+        super().__init__(f'loadtest-ping-{index}', **kwargs)
+        self.ping_topic = '/'.join((self.base, ECHO_NAME, 'ping',
+                                    self.url_safe_plugin_name))
+
+    def listen(self) -> None:
+        self.addGetRoute(self.plugin_topic('pong'), self.on_pong)
+
+    def ping(self) -> None:
+        self._seq += 1
+        recorded = self.recording
+        if recorded:
+            self.sent += 1
+        self.sendMessage(self.ping_topic,
+                         {'seq': self._seq, 'sent': time.perf_counter(),
+                          'recorded': recorded, 'data': self.data},
+                         qos=self.qos)
+
+    def start_closed(self) -> None:
+        """Start closed-loop mode: every pong triggers the next ping."""
+        self.closed_loop = True
+        for _ in range(self.window):
+            self.ping()
+
+    def on_pong(self, payload, args) -> None:
+        latency = time.perf_counter() - payload['sent']
+        if payload['recorded'] and self.recording:
+            self.received += 1
+            self.latencies.append(latency)
+        if self.closed_loop:
+            self.ping()
+
+
+###############################################################################
+# Runner
+# ======
+def percentile(samples: List[float], q: float) -> float:
+    """``q``-th quantile of sorted ``samples`` (nearest rank)."""
+    if not samples:
+        return float('nan')
+    return samples[min(int(len(samples) * q), len(samples) - 1)]
+
+
+def report(pingers: List[PingReactor], seconds: float) -> dict:
+    latencies = sorted(latency for pinger in pingers
+                       for latency in pinger.latencies)
+    sent = sum(pinger.sent for pinger in pingers)
+    received = sum(pinger.received for pinger in pingers)
+    return {'seconds': seconds, 'sent': sent, 'received': received,
+            'lost': sent - received,
+            'throughput_msgs_per_s': received / seconds,
+            'p50_ms': percentile(latencies, .5) * 1e3,
+            'p99_ms': percentile(latencies, .99) * 1e3,
+            'p999_ms': percentile(latencies, .999) * 1e3,
+            'max_ms': latencies[-1] * 1e3 if latencies else float('nan')}
+
+
+def _run_engine(reactors) -> tuple:
+    engine = MqttSelectorEngine()
+    for reactor in reactors:
+        reactor.start(engine=engine)
+    thread = threading.Thread(target=engine.run_forever,
+                              name='MqttSelectorEngine', daemon=True)
+    thread.start()
+    return engine, thread
+
+
+def _stop_engine(reactors, engine: MqttSelectorEngine,
+                 thread: threading.Thread) -> None:
+    for reactor in reactors:
+        reactor.exit()
+    # Let the engine flush the disconnects.
+    time.sleep(.1)
+    engine.stop()
+    thread.join()
+    engine.close()
+
+
+def _send_open_loop(pingers: List[PingReactor], rate: float,
+                    until: float) -> None:
+    start = time.perf_counter()
+    i = 0
+    while True:
+        deadline = start + i / rate
+        if deadline >= until:
+            return
+        delay = deadline - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        pingers[i % len(pingers)].ping()
+        i += 1
+
+
+def run(host: str = 'localhost', port: int = 1883, clients: int = 1,
+        rate: float = 1000, payload_size: int = 64, qos: int = 0,
+        window: int = 1, duration: float = 10, warmup: float = 1,
+        drain: float = 1, role: str = 'both',
+        protocol: int = mqtt.MQTTv311) -> dict:
+    """Run one load test and return the :func:`report` of the ping side."""
+    kwargs = dict(host=host, port=port, qos=qos, protocol=protocol)
+    echo = [EchoReactor(**kwargs)] if role in ('both', 'echo') else []
+    pingers = [PingReactor(i, payload_size=payload_size, window=window,
+                           **kwargs)
+               for i in range(clients)] if role in ('both', 'ping') else []
+    engines = [(reactors, ) + _run_engine(reactors)
+               for reactors in (echo, pingers) if reactors]
+    try:
+        for reactor in echo + pingers:
+            if not reactor.ready.wait(30):
+                raise RuntimeError(f'{reactor.plugin_name}: subscriptions '
+                                   'not acknowledged by the broker.')
+        if not pingers:
+            # Echo only: serve until interrupted.
+            while True:
+                time.sleep(1)
+
+        if rate <= 0:
+            for pinger in pingers:
+                pinger.start_closed()
+            time.sleep(warmup)
+            for pinger in pingers:
+                pinger.recording = True
+            start = time.perf_counter()
+            time.sleep(duration)
+        else:
+            _send_open_loop(pingers, rate, time.perf_counter() + warmup)
+            for pinger in pingers:
+                pinger.recording = True
+            start = time.perf_counter()
+            _send_open_loop(pingers, rate, start + duration)
+        seconds = time.perf_counter() - start
+        for pinger in pingers:
+            pinger.closed_loop = False
+        # Wait for pongs still in flight, then stop counting.
+        time.sleep(drain)
+        for pinger in pingers:
+            pinger.recording = False
+        return report(pingers, seconds)
+    finally:
+        for args in engines:
+            _stop_engine(*args)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--local', action='store_true',
+                        help='Run against an in-process FakeBroker.')
+    parser.add_argument('--role', choices=('both', 'echo', 'ping'),
+                        default='both')
+    parser.add_argument('--clients', type=int, default=1,
+                        help='Number of ping clients (default: 1).')
+    parser.add_argument('--rate', type=float, default=1000,
+                        help='Total pings per second; 0 for closed loop '
+                        '(default: 1000).')
+    parser.add_argument('--window', type=int, default=1,
+                        help='Pings in flight per client in closed loop.')
+    parser.add_argument('--payload-size', type=int, default=64)
+    parser.add_argument('--qos', type=int, choices=(0, 1), default=0)
+    parser.add_argument('--mqtt5', action='store_true')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Seconds measured (default: 10).')
+    parser.add_argument('--warmup', type=float, default=1,
+                        help='Seconds of load before measuring.')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the report as JSON.')
+    args = parser.parse_args()
+
+    broker = None
+    if args.local:
+        from .broker import FakeBroker
+
+        broker = FakeBroker().start()
+        args.host, args.port = '127.0.0.1', broker.port
+    try:
+        result = run(host=args.host, port=args.port, clients=args.clients,
+                     rate=args.rate, payload_size=args.payload_size,
+                     qos=args.qos, window=args.window,
+                     duration=args.duration, warmup=args.warmup,
+                     role=args.role,
+                     protocol=mqtt.MQTTv5 if args.mqtt5 else mqtt.MQTTv311)
+    except KeyboardInterrupt:
+        return
+    finally:
+        if broker is not None:
+            broker.stop()
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        for key, value in result.items():
+            print(f'{key:<24} {value:14.3f}' if isinstance(value, float)
+                  else f'{key:<24} {value:14d}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+# coding: utf-8
+"""
+Low-overhead per-route metrics for :class:`paho_mqtt_helpers.BaseMqttReactor`.
+
+Counters and fixed-bucket histograms are plain Python integers updated from
+the MQTT callback thread; recording a value is a :func:`bisect.bisect_left`
+and two additions.  A :class:`MetricsRegistry` can be rendered in the
+Prometheus text exposition format or as a JSON-serializable dictionary.
+
+:class:`PhaseStats` breaks reactor CPU time down by phase (network I/O,
+decode, handler, encode, publish) and thread.
+"""
+import bisect
+import logging
+import threading
+import time
+
+from typing import Callable, Dict, Sequence
+
+logger = logging.getLogger(__name__)
+
+#: Upper bounds (seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3,
+                   5e-3, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+#: Upper bounds (bytes) of the payload size histogram buckets.
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1 << 20, 4 << 20,
+                16 << 20)
+
+
+class Histogram:
+    """Histogram with fixed bucket upper bounds (plus a ``+Inf`` bucket)."""
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: Sequence[float]) -> None:
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket containing the ``q`` quantile."""
+        if not self.count:
+            return 0.
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'), ), self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float('inf')
+
+    def to_dict(self) -> dict:
+        return {'bounds': list(self.bounds), 'counts': list(self.counts),
+                'sum': self.sum, 'count': self.count}
+
+
+class RouteMetrics:
+    """Counters and histograms for one route pattern."""
+    __slots__ = ('messages', 'errors', 'decode_errors', 'slow_handlers',
+                 'sequence_gaps', 'decode_seconds', 'handler_seconds',
+                 'payload_bytes', 'latency_seconds')
+
+    def __init__(self) -> None:
+        self.messages = 0
+        #: Exceptions raised by the handler.
+        self.errors = 0
+        #: Payloads that could not be decoded.
+        self.decode_errors = 0
+        #: Handler runs reported by the watchdog.
+        self.slow_handlers = 0
+        #: Messages missing according to envelope sequence numbers.
+        self.sequence_gaps = 0
+        self.decode_seconds = Histogram(LATENCY_BUCKETS)
+        self.handler_seconds = Histogram(LATENCY_BUCKETS)
+        self.payload_bytes = Histogram(SIZE_BUCKETS)
+        #: End-to-end latency of enveloped messages.
+        self.latency_seconds = Histogram(LATENCY_BUCKETS)
+
+    def histograms(self) -> Dict[str, Histogram]:
+        return {'decode_seconds': self.decode_seconds,
+                'handler_seconds': self.handler_seconds,
+                'payload_bytes': self.payload_bytes,
+                'latency_seconds': self.latency_seconds}
+
+    def counters(self) -> Dict[str, int]:
+        return {'messages': self.messages, 'errors': self.errors,
+                'decode_errors': self.decode_errors,
+                'slow_handlers': self.slow_handlers,
+                'sequence_gaps': self.sequence_gaps}
+
+    def to_dict(self) -> dict:
+        result = self.counters()
+        result.update({name: histogram.to_dict()
+                       for name, histogram in self.histograms().items()})
+        return result
+
+
+class MetricsRegistry:
+    """:class:`RouteMetrics` by route pattern."""
+
+    def __init__(self) -> None:
+        self.routes = {}
+        #: Messages that matched no route.
+        self.unmatched = 0
+
+    def route(self, pattern: str) -> RouteMetrics:
+        try:
+            return self.routes[pattern]
+        except KeyError:
+            return self.routes.setdefault(pattern, RouteMetrics())
+
+    def to_dict(self) -> dict:
+        return {'unmatched': self.unmatched,
+                'routes': {pattern: metrics.to_dict()
+                           for pattern, metrics in
+                           list(self.routes.items())}}
+
+    def to_prometheus(self, prefix: str = 'mqtt_reactor') -> str:
+        """Render in the Prometheus text exposition format."""
+        lines = [f'# TYPE {prefix}_unmatched_total counter',
+                 f'{prefix}_unmatched_total {self.unmatched}']
+        routes = sorted(self.routes.items())
+        for name in RouteMetrics().counters():
+            lines.append(f'# TYPE {prefix}_{name}_total counter')
+            for pattern, metrics in routes:
+                lines.append(f'{prefix}_{name}_total{{route="'
+                             f'{_escape(pattern)}"}} '
+                             f'{metrics.counters()[name]}')
+        # Bounds and sums in full (``:g`` would round them to 6 significant
+        # digits).
+        for name in RouteMetrics().histograms():
+            lines.append(f'# TYPE {prefix}_{name} histogram')
+            for pattern, metrics in routes:
+                histogram = metrics.histograms()[name]
+                label = f'route="{_escape(pattern)}"'
+                total = 0
+                for bound, count in zip(histogram.bounds, histogram.counts):
+                    total += count
+                    lines.append(f'{prefix}_{name}_bucket{{{label},'
+                                 f'le="{float(bound)!r}"}} {total}')
+                lines.append(f'{prefix}_{name}_bucket{{{label},le="+Inf"}} '
+                             f'{histogram.count}')
+                lines.append(f'{prefix}_{name}_sum{{{label}}} '
+                             f'{float(histogram.sum)!r}')
+                lines.append(f'{prefix}_{name}_count{{{label}}} '
+                             f'{histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n',
+                                                                   '\\n')
+
+
+class PeriodicTask:
+    """Call ``func()`` every ``interval`` seconds on a daemon thread."""
+
+    def __init__(self, interval: float, func: Callable,
+                 name: str = 'PeriodicTask') -> None:
+        self.interval = interval
+        self.func = func
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name,
+                                        daemon=True)
+
+    def start(self) -> 'PeriodicTask':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.func()
+            except Exception:
+                logger.exception('Error in periodic task.')
+
+
+class PhaseStats:
+    """
+    Cumulative exclusive time per phase and per thread.
+
+    Phases nest (e.g., ``encode`` inside ``handler`` inside ``network`` when
+    paho calls ``on_message`` from ``loop_read()``); time spent in a nested
+    phase is only counted for the inner phase, so per-thread totals add up
+    to the time actually spent.
+    """
+
+    def __init__(self) -> None:
+        # ``{thread name: {phase: [seconds, count]}}``.
+        self.threads = {}
+        self._local = threading.local()
+        self._started = time.monotonic()
+
+    def enter(self, phase: str) -> None:
+        try:
+            stack = self._local.stack
+        except AttributeError:
+            stack = self._local.stack = []
+        stack.append([phase, time.perf_counter(), 0.])
+
+    def exit(self) -> None:
+        phase, start, children = self._local.stack.pop()
+        elapsed = time.perf_counter() - start
+        if self._local.stack:
+            self._local.stack[-1][2] += elapsed
+        name = threading.current_thread().name
+        try:
+            phases = self.threads[name]
+        except KeyError:
+            phases = self.threads.setdefault(name, {})
+        try:
+            totals = phases[phase]
+        except KeyError:
+            totals = phases.setdefault(phase, [0., 0])
+        totals[0] += elapsed - children
+        totals[1] += 1
+
+    def to_dict(self) -> dict:
+        """
+        ``{'wall_seconds', 'threads': {thread: {phase: {seconds, count}}},
+        'phases': {phase: seconds}}``
+        """
+        threads = {name: {phase: {'seconds': seconds, 'count': count}
+                          for phase, (seconds, count) in
+                          list(phases.items())}
+                   for name, phases in list(self.threads.items())}
+        totals = {}
+        for phases in threads.values():
+            for phase, values in phases.items():
+                totals[phase] = totals.get(phase, 0.) + values['seconds']
+        return {'wall_seconds': time.monotonic() - self._started,
+                'threads': threads, 'phases': totals}
+
+    def summary(self) -> str:
+        stats = self.to_dict()
+        busy = sum(stats['phases'].values()) or 1.
+        parts = [f'{phase} {seconds:.3f}s ({seconds / busy:.0%})'
+                 for phase, seconds in sorted(stats['phases'].items(),
+                                              key=lambda item: -item[1])]
+        return f"{stats['wall_seconds']:.0f}s wall: " + ', '.join(parts)
+
+    def reset(self) -> None:
+        self.threads = {}
+        self._started = time.monotonic()
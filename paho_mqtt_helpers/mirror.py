@@ -0,0 +1,215 @@
+# coding: utf-8
+"""
+Local mirror of the last value received on a set of topics.
+
+:meth:`BaseMqttReactor.enable_mirror` subscribes to topic filters (e.g.,
+``'microdrop/+/state/#'``) and keeps the last decoded payload of every
+matching topic in a :class:`StateMirror`, so the current state of other
+plugins is an in-memory read::
+
+    mirror = reactor.enable_mirror('microdrop/+/state/#')
+    ...
+    mirror.get('microdrop/dmf-device-ui/state/device')
+    mirror.query('microdrop/+/state/#')  # {topic: value}
+
+An empty payload (a cleared retained message) removes the topic.  The
+mirror holds at most ``max_topics`` topics and about ``max_bytes`` of
+payloads (by wire size); least recently updated topics are evicted first.
+Values are the decoded objects handed to handlers: do not modify them.
+"""
+import collections
+import threading
+
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+
+class _Node:
+    __slots__ = ('children', 'value')
+
+    def __init__(self) -> None:
+        self.children = {}
+        self.value = None
+
+
+class TopicTrie:
+    """
+    Values keyed by topic (or topic filter), one level per trie node.
+
+    :meth:`match` returns the values of the topics matching a filter, and
+    :meth:`matches` whether any stored filter matches a topic.
+    """
+
+    def __init__(self) -> None:
+        self._root = _Node()
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def insert(self, topic: str, value: Any) -> None:
+        node = self._root
+        for level in topic.split('/'):
+            node = node.children.setdefault(level, _Node())
+        if node.value is None:
+            self._size += 1
+        node.value = (topic, value)
+
+    def remove(self, topic: str) -> None:
+        path = [self._root]
+        for level in topic.split('/'):
+            node = path[-1].children.get(level)
+            if node is None:
+                return
+            path.append(node)
+        if path[-1].value is None:
+            return
+        path[-1].value = None
+        self._size -= 1
+        # Prune the nodes left without values or children.
+        for parent, level, node in zip(reversed(path[:-1]),
+                                       reversed(topic.split('/')),
+                                       reversed(path[1:])):
+            if node.children or node.value is not None:
+                break
+            del parent.children[level]
+
+    def match(self, filter_: str) -> Iterator[Tuple[str, Any]]:
+        """``(topic, value)`` of the topics matching ``filter_``."""
+        levels = filter_.split('/')
+        stack = [(self._root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if depth == len(levels):
+                if node.value is not None:
+                    yield node.value
+                continue
+            level = levels[depth]
+            if level == '#':
+                # Matches the parent level too; ``$`` topics (e.g., ``$SYS``)
+                # only match explicitly.
+                nodes = [child for key, child in node.children.items()
+                         if depth or not key.startswith('$')]
+                if node.value is not None:
+                    yield node.value
+                while nodes:
+                    node = nodes.pop()
+                    if node.value is not None:
+                        yield node.value
+                    nodes.extend(node.children.values())
+            elif level == '+':
+                for key, child in node.children.items():
+                    if depth or not key.startswith('$'):
+                        stack.append((child, depth + 1))
+            else:
+                child = node.children.get(level)
+                if child is not None:
+                    stack.append((child, depth + 1))
+
+    def matches(self, topic: str) -> bool:
+        """``True`` if a stored filter matches ``topic``."""
+        levels = topic.split('/')
+        stack = [(self._root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if '#' in node.children:
+                return True
+            if depth == len(levels):
+                if node.value is not None:
+                    return True
+                continue
+            for key in (levels[depth], '+'):
+                child = node.children.get(key)
+                if child is not None:
+                    stack.append((child, depth + 1))
+        return False
+
+
+class StateMirror:
+    """
+    Last decoded value per topic, for the topics matching ``filters``.
+
+    Parameters
+    ----------
+    filters : iterable of str
+        Topic filters to mirror.
+    max_topics : int
+        Topics kept.
+    max_bytes : int
+        Total (wire) size of the payloads kept.
+    """
+
+    def __init__(self, filters=(), max_topics: int = 10000,
+                 max_bytes: int = 64 << 20) -> None:
+        self.max_topics = max_topics
+        self.max_bytes = max_bytes
+        #: Updates applied, and topics evicted to stay within the limits.
+        self.updates = 0
+        self.evicted = 0
+        self.filters = []
+        self._filters = TopicTrie()
+        self._lock = threading.Lock()
+        self._values = TopicTrie()
+        # Topic -> payload size, least recently updated first.
+        self._sizes = collections.OrderedDict()
+        self._bytes = 0
+        for filter_ in filters:
+            self.add_filter(filter_)
+
+    def __len__(self) -> int:
+        return len(self._sizes)
+
+    def __contains__(self, topic: str) -> bool:
+        return topic in self._sizes
+
+    @property
+    def nbytes(self) -> int:
+        """Total (wire) size of the payloads kept."""
+        return self._bytes
+
+    def add_filter(self, filter_: str) -> None:
+        if filter_ not in self.filters:
+            self.filters.append(filter_)
+            self._filters.insert(filter_, True)
+
+    def mirrors(self, topic: str) -> bool:
+        """``True`` if ``topic`` matches one of the mirrored filters."""
+        return self._filters.matches(topic)
+
+    def update(self, topic: str, value: Any, size: int) -> None:
+        """
+        Set the value of ``topic``, with ``size`` its payload size; an
+        empty payload (``size == 0``) removes the topic.
+        """
+        with self._lock:
+            self.updates += 1
+            self._remove(topic)
+            if not size:
+                return
+            self._values.insert(topic, value)
+            self._sizes[topic] = size
+            self._bytes += size
+            while len(self._sizes) > self.max_topics or \
+                    self._bytes > self.max_bytes:
+                self._remove(next(iter(self._sizes)))
+                self.evicted += 1
+
+    def get(self, topic: str, default: Any = None) -> Any:
+        """Last value received on ``topic``."""
+        with self._lock:
+            if topic not in self._sizes:
+                return default
+            for _, value in self._values.match(topic):
+                return value
+        return default
+
+    def query(self, filter_: str) -> Dict[str, Any]:
+        """``{topic: value}`` of the mirrored topics matching ``filter_``."""
+        with self._lock:
+            return dict(self._values.match(filter_))
+
+    def _remove(self, topic: str) -> Optional[int]:
+        size = self._sizes.pop(topic, None)
+        if size is not None:
+            self._bytes -= size
+            self._values.remove(topic)
+        return size
@@ -0,0 +1,208 @@
+# coding: utf-8
+"""
+On-demand profiling of a running reactor.
+
+:class:`RemoteProfiler` backs the ``<base>/<plugin>/profile/...`` and
+``<base>/<plugin>/tracemalloc/...`` control routes that
+:meth:`paho_mqtt_helpers.BaseMqttReactor.enable_profiling` adds.  Two CPU
+profilers are available:
+
+- ``cprofile``: deterministic :mod:`cProfile` of the thread that handles
+  the start request, i.e., the MQTT loop thread running the handlers;
+- ``sampler``: :class:`StatisticalSampler`, which samples the stacks of all
+  threads with :func:`sys._current_frames` from a background thread (low
+  overhead, safe to leave running for longer).
+
+Memory is inspected through :mod:`tracemalloc` snapshots; tracing stops
+after each snapshot unless asked otherwise, since it slows every
+allocation down.
+
+Numeric request parameters are clamped to :data:`LIMITS`.
+"""
+import base64
+import collections
+import cProfile
+import io
+import marshal
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+from typing import Optional, Union
+
+#: ``(minimum, maximum)`` of the numeric parameters of profiling requests.
+LIMITS = {'seconds': (0.1, 600.), 'interval': (0.001, 1.), 'top': (1, 500),
+          'frames': (1, 100)}
+
+
+def parameter(payload: dict, name: str,
+              default: Union[int, float]) -> Union[int, float]:
+    """
+    ``payload[name]`` (or ``default``), of the type of ``default``, clamped
+    to :data:`LIMITS`.
+
+    Raises
+    ------
+    ValueError
+        If the value is not a number.
+    """
+    value = payload.get(name, default)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or \
+            value != value:
+        raise ValueError(f'Invalid {name}: {value!r}')
+    low, high = LIMITS[name]
+    return type(default)(min(max(value, low), high))
+
+
+class StatisticalSampler:
+    """Count the stacks of all other threads every ``interval`` seconds."""
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run,
+                                        name='StatisticalSampler',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_filename}:{code.co_name}:'
+                                 f'{frame.f_lineno}')
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def result(self, top: int = 50) -> dict:
+        """Most frequent stacks, in collapsed (flame graph) format."""
+        return {'samples': self.samples, 'interval': self.interval,
+                'stacks': [{'stack': stack, 'count': count}
+                           for stack, count in self.stacks.most_common(top)]}
+
+
+class RemoteProfiler:
+    """State of the profiling session started over MQTT (one at a time)."""
+
+    def __init__(self) -> None:
+        self.mode = None
+        self.top = 50
+        self._profile = None
+        self._sampler = None
+        self._started = None
+        self._snapshot = None
+        # Whether tracing was started by :meth:`snapshot` (tracing started
+        # by the application is left running).
+        self._tracing = False
+
+    @property
+    def running(self) -> bool:
+        return self.mode is not None
+
+    def start(self, mode: str = 'cprofile', interval: float = 0.005,
+              top: int = 50) -> None:
+        """
+        Raises
+        ------
+        RuntimeError
+            If a profiling session is already running.
+        ValueError
+            If ``mode`` is unknown.
+        """
+        if self.running:
+            raise RuntimeError(f'{self.mode} profiling already running.')
+        if mode == 'cprofile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        elif mode == 'sampler':
+            self._sampler = StatisticalSampler(interval=interval)
+            self._sampler.start()
+        else:
+            raise ValueError(f'Unknown profiling mode: {mode!r}')
+        self.mode = mode
+        self.top = top
+        self._started = time.monotonic()
+
+    def stop(self) -> Optional[dict]:
+        """Stop the running session and return its result (if any)."""
+        if not self.running:
+            return None
+        result = {'mode': self.mode,
+                  'seconds': time.monotonic() - self._started}
+        if self.mode == 'cprofile':
+            self._profile.disable()
+            self._profile.create_stats()
+            stream = io.StringIO()
+            stats = pstats.Stats(self._profile, stream=stream)
+            stats.sort_stats('cumulative').print_stats(self.top)
+            result['stats'] = stream.getvalue()
+            # Raw stats, loadable with ``pstats.Stats(path)`` once written
+            # to a file.
+            result['pstats'] = base64.b64encode(
+                marshal.dumps(self._profile.stats)).decode('ascii')
+            self._profile = None
+        else:
+            self._sampler.stop()
+            result.update(self._sampler.result(self.top))
+            self._sampler = None
+        self.mode = None
+        return result
+
+    def snapshot(self, top: int = 25, frames: int = 1,
+                 stop: bool = True) -> dict:
+        """
+        Take a :mod:`tracemalloc` snapshot (starting tracing if needed),
+        then stop tracing unless ``stop`` is false or tracing was already
+        started by someone else.
+
+        Returns the top allocation sites, and the top differences to the
+        previous snapshot if there is one (i.e., if tracing was left
+        running).
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            self._tracing = True
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        result = {'traced_bytes': current, 'peak_bytes': peak,
+                  'top': [_statistic(stat) for stat in
+                          snapshot.statistics('traceback')[:top]]}
+        if self._snapshot is not None:
+            result['diff'] = [_statistic(stat) for stat in
+                              snapshot.compare_to(self._snapshot,
+                                                  'traceback')[:top]]
+        self._snapshot = snapshot
+        if stop:
+            if self._tracing:
+                tracemalloc.stop()
+                self._tracing = False
+            self._snapshot = None
+        return result
+
+
+def _statistic(stat) -> dict:
+    result = {'size': stat.size, 'count': stat.count,
+              'traceback': [f'{frame.filename}:{frame.lineno}'
+                            for frame in stat.traceback]}
+    if hasattr(stat, 'size_diff'):
+        result['size_diff'] = stat.size_diff
+        result['count_diff'] = stat.count_diff
+    return result
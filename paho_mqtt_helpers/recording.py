@@ -0,0 +1,272 @@
+# coding: utf-8
+"""
+Record received traffic to disk and replay it into a reactor.
+
+A traffic log is a directory of append-only segments.  Each segment
+``<n>.log`` is a sequence of records::
+
+    timestamp (f8) | flags (u1: qos | retain << 2) | topic length (u2) |
+    payload length (u4) | topic | payload
+
+(big-endian), and ``<n>.idx`` holds ``(timestamp, offset)`` pairs for every
+``index_interval``-th record, so readers seek to a point in time with a
+binary search over the memory-mapped index.  Segments are never appended to
+once closed, and a truncated last record (e.g., after a crash) is ignored.
+
+Example
+-------
+
+>>> reactor.enable_recording('capture')  # Record everything received.
+>>> ...
+>>> replay(TrafficLog('capture'), other_reactor, speed=None)  # Max speed.
+{'messages': 120000, 'seconds': 1.9, 'msgs_per_s': 63157.9}
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from typing import Iterator, Optional, Tuple
+
+RECORD = struct.Struct('!dBHI')
+INDEX = struct.Struct('!dQ')
+
+Record = Tuple[float, str, bytes, int, bool]
+
+
+class Recorder:
+    """
+    Append records to the traffic log in ``directory`` (thread-safe).
+
+    Parameters
+    ----------
+    directory : str
+        Created if needed.  Recording always starts a new segment.
+    segment_bytes : int
+        Size after which the current segment is closed.
+    index_interval : int
+        Index one record in this many.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int = 64 << 20,
+                 index_interval: int = 64) -> None:
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        #: Records written.
+        self.records = 0
+        os.makedirs(directory, exist_ok=True)
+        segments = _segments(directory)
+        self._segment = int(segments[-1]) + 1 if segments else 0
+        self._lock = threading.Lock()
+        self._log = None
+        self._index = None
+        self._offset = 0
+        self._count = 0
+        self._last = 0.
+        self._open_segment()
+
+    @property
+    def closed(self) -> bool:
+        return self._log is None
+
+    def record(self, topic: str, payload: bytes, qos: int = 0,
+               retain: bool = False,
+               timestamp: Optional[float] = None) -> None:
+        """Append a record; ignored once the recorder is closed."""
+        topic = topic.encode('utf-8')
+        with self._lock:
+            if self._log is None:
+                # E.g., a message dispatched while the reactor exits.
+                return
+            # Keep timestamps non-decreasing (wall clock adjustments), so
+            # the index stays sorted.
+            timestamp = max(time.time() if timestamp is None else timestamp,
+                            self._last)
+            self._last = timestamp
+            if self._count % self.index_interval == 0:
+                self._index.write(INDEX.pack(timestamp, self._offset))
+            header = RECORD.pack(timestamp, qos | retain << 2, len(topic),
+                                 len(payload))
+            self._log.write(header)
+            self._log.write(topic)
+            self._log.write(payload)
+            self._offset += len(header) + len(topic) + len(payload)
+            self._count += 1
+            self.records += 1
+            if self._offset >= self.segment_bytes:
+                self._close_segment()
+                self._segment += 1
+                self._open_segment()
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._log is None:
+                return
+            self._log.flush()
+            self._index.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._log is not None:
+                self._close_segment()
+                self._log = self._index = None
+
+    def __enter__(self) -> 'Recorder':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _open_segment(self) -> None:
+        path = os.path.join(self.directory, f'{self._segment:08d}')
+        self._log = open(path + '.log', 'ab')
+        self._index = open(path + '.idx', 'ab')
+        self._offset = 0
+        self._count = 0
+
+    def _close_segment(self) -> None:
+        self._log.close()
+        self._index.close()
+
+
+class TrafficLog:
+    """Read the traffic log in ``directory``."""
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def __iter__(self) -> Iterator[Record]:
+        return self.read()
+
+    def read(self, start: Optional[float] = None,
+             end: Optional[float] = None) -> Iterator[Record]:
+        """
+        Yield ``(timestamp, topic, payload, qos, retain)`` records with
+        ``start <= timestamp <= end``, oldest first.
+        """
+        segments = _segments(self.directory)
+        firsts = [self._first_timestamp(segment) for segment in segments]
+        for i, segment in enumerate(segments):
+            if start is not None and i + 1 < len(segments) and \
+                    firsts[i + 1] is not None and firsts[i + 1] < start:
+                # All records of this segment precede ``start``.
+                continue
+            if end is not None and firsts[i] is not None and \
+                    firsts[i] > end:
+                return
+            yield from self._read_segment(segment, start, end)
+
+    def _path(self, segment: str, extension: str) -> str:
+        return os.path.join(self.directory, segment + extension)
+
+    def _first_timestamp(self, segment: str) -> Optional[float]:
+        with open(self._path(segment, '.idx'), 'rb') as index:
+            data = index.read(INDEX.size)
+        return INDEX.unpack(data)[0] if len(data) == INDEX.size else None
+
+    def _seek(self, segment: str, start: float) -> int:
+        """Offset of the last indexed record before ``start``."""
+        with open(self._path(segment, '.idx'), 'rb') as file_:
+            size = os.fstat(file_.fileno()).st_size
+            n = size // INDEX.size
+            if not n:
+                return 0
+            with mmap.mmap(file_.fileno(), n * INDEX.size,
+                           access=mmap.ACCESS_READ) as index:
+                low, high = 0, n
+                while low < high:
+                    middle = (low + high) // 2
+                    if INDEX.unpack_from(index, middle * INDEX.size)[0] < \
+                            start:
+                        low = middle + 1
+                    else:
+                        high = middle
+                if low == 0:
+                    return 0
+                return INDEX.unpack_from(index, (low - 1) * INDEX.size)[1]
+
+    def _read_segment(self, segment: str, start: Optional[float],
+                      end: Optional[float]) -> Iterator[Record]:
+        offset = self._seek(segment, start) if start is not None else 0
+        with open(self._path(segment, '.log'), 'rb') as file_:
+            size = os.fstat(file_.fileno()).st_size
+            if not size:
+                return
+            with mmap.mmap(file_.fileno(), size,
+                           access=mmap.ACCESS_READ) as log:
+                while offset + RECORD.size <= size:
+                    timestamp, flags, topic_length, payload_length = \
+                        RECORD.unpack_from(log, offset)
+                    topic_start = offset + RECORD.size
+                    payload_start = topic_start + topic_length
+                    offset = payload_start + payload_length
+                    if offset > size:
+                        # Truncated last record.
+                        return
+                    if start is not None and timestamp < start:
+                        continue
+                    if end is not None and timestamp > end:
+                        return
+                    yield (timestamp,
+                           log[topic_start:payload_start].decode('utf-8'),
+                           log[payload_start:offset], flags & 0x3,
+                           bool(flags & 0x4))
+
+
+def replay(log: TrafficLog, reactor, speed: Optional[float] = 1.0,
+           through_broker: bool = False, start: Optional[float] = None,
+           end: Optional[float] = None) -> dict:
+    """
+    Feed recorded messages to ``reactor``.
+
+    Parameters
+    ----------
+    log : TrafficLog
+    reactor : BaseMqttReactor
+        Messages are passed directly to its :meth:`on_message`, or, with
+        ``through_broker``, published by its (connected) client for other
+        subscribers.
+    speed : float, optional
+        Replay speed relative to the recording (e.g., ``1`` or ``10``);
+        ``None`` or ``0`` replays as fast as possible.
+    start, end : float, optional
+        Time range (UNIX time) of the records to replay.
+
+    Returns
+    -------
+    dict
+        ``messages``, ``seconds`` and ``msgs_per_s``.
+    """
+    client = reactor.mqtt_client
+    count = 0
+    began = time.perf_counter()
+    first = None
+    for timestamp, topic, payload, qos, retain in log.read(start, end):
+        if speed:
+            if first is None:
+                first = timestamp
+            delay = began + (timestamp - first) / speed - \
+                time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        if through_broker:
+            client.publish(topic, payload, qos=qos, retain=retain)
+        else:
+            message = mqtt.MQTTMessage(topic=topic.encode('utf-8'))
+            message.payload = payload
+            message.qos = qos
+            message.retain = retain
+            reactor.on_message(client, None, message)
+        count += 1
+    seconds = time.perf_counter() - began
+    return {'messages': count, 'seconds': seconds,
+            'msgs_per_s': count / seconds if seconds else float('nan')}
+
+
+def _segments(directory: str) -> list:
+    return sorted(name[:-4] for name in os.listdir(directory)
+                  if name.endswith('.log'))
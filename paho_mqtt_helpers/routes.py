@@ -0,0 +1,31 @@
+# coding: utf-8
+"""
+Route table entries for :class:`paho_mqtt_helpers.BaseMqttReactor`.
+"""
+from typing import Any, Callable, Optional
+
+
+class Route:
+    """
+    Handler registered through :meth:`BaseMqttReactor.addGetRoute`.
+
+    Stored in the router in place of the bare handler so that, after a
+    topic is matched, the reactor knows which route pattern it matched
+    (e.g., to attribute metrics).  Calling a :class:`Route` calls its
+    handler.
+    """
+    __slots__ = ('pattern', 'handler', 'slow_threshold')
+
+    def __init__(self, pattern: str, handler: Callable,
+                 slow_threshold: Optional[float] = None) -> None:
+        self.pattern = pattern
+        self.handler = handler
+        #: Run time (seconds) after which the watchdog reports the handler
+        #: (``None``: watchdog default).
+        self.slow_threshold = slow_threshold
+
+    def __call__(self, payload: Any, args: dict) -> Any:
+        return self.handler(payload, args)
+
+    def __repr__(self) -> str:
+        return f'Route({self.pattern!r}, {self.handler!r})'
@@ -0,0 +1,437 @@
+# coding: utf-8
+"""
+Hand large arrays to reactors on the same host through shared memory.
+
+``sendMessage(topic, array, shared_memory=True)`` copies a
+:class:`numpy.ndarray`, :class:`pandas.DataFrame` (single dtype) or
+:class:`pandas.Series` into a :class:`multiprocessing.shared_memory`
+segment and publishes only a small framed (see
+:data:`paho_mqtt_helpers.codec.SHARED_MEMORY`) JSON descriptor::
+
+    0x04 | {"name": ..., "generation": ..., "kind": "DataFrame",
+            "dtype": "<f8", "shape": [...], "offset": 64,
+            "columns": [...], "index": ...}
+
+Receivers map the segment and get an array (or pandas object) backed by it
+without copying.  Each mapping is reference counted: it is closed once
+every object built on it has been garbage collected.
+
+Receivers map segments on receipt and hold a shared :func:`fcntl.flock`
+on each mapped segment, so the kernel counts readers across processes.
+Once a segment's ``lease`` (seconds since it was published) is over, the
+sender reuses it for a later payload if no receiver holds it anymore
+(fresh segments cost page faults, reused ones copy at memcpy speed), or
+unlinks it; a mapping stays valid after the segment is unlinked.  Every
+export writes a random generation to the segment header and the
+descriptor, so a late receiver rejects a segment reused for a later
+payload.  Without :mod:`fcntl` and ``/dev/shm`` (e.g., Windows, macOS),
+segments are never reused.  Objects received through shared memory are
+read-only.
+"""
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import weakref
+
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+from typing import Any, Optional
+
+from .codec import SHARED_MEMORY
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Alignment of the values and index arrays.
+ALIGNMENT = 64
+# Segment header (generation of the payload), padded to ``ALIGNMENT``.
+HEADER = struct.Struct('!Q')
+# Where POSIX shared memory segments can be opened as files (Linux).
+SHM_DIRECTORY = '/dev/shm'
+KINDS = ('ndarray', 'DataFrame', 'Series')
+
+
+# Names of the segments created by this process.
+_created = set()
+
+
+class _Segment(shared_memory.SharedMemory):
+    """Segment with a file descriptor of its own for :func:`fcntl.flock`."""
+    lock_fd = None
+
+    def open_lock(self) -> None:
+        if fcntl is None:
+            return
+        try:
+            self.lock_fd = os.open(os.path.join(SHM_DIRECTORY, self.name),
+                                   os.O_RDONLY)
+        except OSError:
+            # Segments are not files here: never reused.
+            pass
+
+    @property
+    def generation(self) -> int:
+        return HEADER.unpack_from(self.buf)[0]
+
+    @generation.setter
+    def generation(self, value: int) -> None:
+        HEADER.pack_into(self.buf, 0, value)
+
+    def close(self) -> None:
+        super().close()
+        if self.lock_fd is not None:
+            # Releases the lock.
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+
+def _attach(name: str) -> _Segment:
+    """Map an existing segment without letting this process unlink it."""
+    try:
+        segment = _Segment(name=name, track=False)
+    except TypeError:
+        segment = _Segment(name=name)
+        if name not in _created and os.name == 'posix':
+            # Python < 3.13: the resource tracker would unlink the segment
+            # when this process exits.
+            resource_tracker.unregister('/' + name, 'shared_memory')
+    segment.open_lock()
+    if segment.lock_fd is not None:
+        # Released when the segment is closed.
+        fcntl.flock(segment.lock_fd, fcntl.LOCK_SH)
+    return segment
+
+
+def _in_use(segment: _Segment) -> bool:
+    """``True`` if a receiver may still have ``segment`` mapped."""
+    if segment.lock_fd is None:
+        return True
+    try:
+        fcntl.flock(segment.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    fcntl.flock(segment.lock_fd, fcntl.LOCK_UN)
+    return False
+
+
+def _claim(segment: _Segment, generation: int) -> bool:
+    """
+    Set the generation of ``segment`` if no receiver holds it; receivers
+    attaching afterwards reject descriptors of the previous payload.
+    """
+    if segment.lock_fd is None:
+        return False
+    try:
+        fcntl.flock(segment.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    try:
+        segment.generation = generation
+    finally:
+        fcntl.flock(segment.lock_fd, fcntl.LOCK_UN)
+    return True
+
+
+def _array(spec: dict) -> tuple:
+    """
+    ``(dtype, shape, offset, end offset)`` of the array described by
+    ``spec`` (values or index of a descriptor).
+
+    Raises
+    ------
+    KeyError, TypeError, ValueError
+        If ``spec`` is invalid.
+    """
+    import numpy as np
+
+    dtype = np.dtype(spec['dtype'])
+    shape, offset = spec['shape'], spec['offset']
+    if dtype.hasobject or not isinstance(shape, list) or \
+            not all(isinstance(n, int) and n >= 0 for n in shape) or \
+            not isinstance(offset, int) or offset < HEADER.size:
+        raise ValueError(spec)
+    return dtype, shape, offset, offset + dtype.itemsize * int(np.prod(shape))
+
+
+def _descriptor(data: bytes) -> dict:
+    """
+    Descriptor decoded from ``data``, with ``'values'`` (and ``'index'``,
+    if stored in the segment) as returned by :func:`_array`.
+
+    Raises
+    ------
+    ValueError
+        If the descriptor is invalid.
+    """
+    try:
+        descriptor = json.loads(data)
+        name, generation = descriptor['name'], descriptor['generation']
+        kind = descriptor['kind']
+        if not isinstance(name, str) or not name or '/' in name or \
+                type(generation) is not int or kind not in KINDS:
+            raise ValueError
+        descriptor['values'] = _array(descriptor)
+        if kind == 'DataFrame' and \
+                not isinstance(descriptor['columns'], list):
+            raise ValueError
+        index = descriptor.get('index')
+        if isinstance(index, dict):
+            descriptor['index'] = _array(index)
+        elif index is not None and not isinstance(index, list):
+            raise ValueError
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('Invalid shared memory descriptor.')
+    return descriptor
+
+
+def _unlink(segment: _Segment) -> None:
+    _created.discard(segment.name)
+    segment.close()
+    try:
+        segment.unlink()
+    except FileNotFoundError:
+        pass
+
+
+class _Mapping:
+    __slots__ = ('segment', 'references')
+
+    def __init__(self, segment: _Segment) -> None:
+        self.segment = segment
+        self.references = 0
+
+
+class SharedMemoryStore:
+    """
+    Export objects to, and attach objects from, shared memory segments.
+
+    Parameters
+    ----------
+    lease : float
+        Seconds during which receivers may attach an exported segment;
+        afterwards the segment is reused or unlinked.
+    pool_size : int
+        Unused segments kept for reuse.
+    """
+
+    def __init__(self, lease: float = 60., pool_size: int = 4) -> None:
+        self.lease = lease
+        self.pool_size = pool_size
+        #: Segments created and reused.
+        self.created = 0
+        self.reused = 0
+        self._lock = threading.Lock()
+        # Exported segments, oldest first: ``[(deadline, segment)]``.
+        self._exported = []
+        # Unused segments past their lease.
+        self._pool = []
+        # Attached segments by name, and segments to close.
+        self._mappings = {}
+        self._closing = []
+
+    @property
+    def attached(self) -> int:
+        """Segments currently mapped by received objects."""
+        return len(self._mappings)
+
+    ###########################################################################
+    # Sender
+    # ======
+    def export(self, obj: Any) -> bytes:
+        """
+        Copy ``obj`` into a new segment; returns the framed descriptor.
+
+        Raises
+        ------
+        ValueError
+            If ``obj`` is not an array or pandas object of a single,
+            non-object dtype.
+        """
+        import numpy as np
+
+        descriptor = {'kind': 'ndarray'}
+        index = None
+        if isinstance(obj, np.ndarray):
+            values = obj
+        elif type(obj).__name__ in ('DataFrame', 'Series') and \
+                type(obj).__module__.startswith('pandas'):
+            descriptor['kind'] = type(obj).__name__
+            values = obj.to_numpy()
+            if descriptor['kind'] == 'DataFrame':
+                descriptor['columns'] = obj.columns.tolist()
+            else:
+                descriptor['series_name'] = obj.name
+            index = obj.index.to_numpy()
+            if index.dtype.hasobject:
+                descriptor['index'] = obj.index.tolist()
+                index = None
+        else:
+            raise ValueError(f'Cannot share {type(obj).__name__} objects '
+                             'through shared memory.')
+        if values.dtype.hasobject:
+            raise ValueError('Cannot share object arrays through shared '
+                             'memory.')
+        size = ALIGNMENT + values.nbytes
+        if index is not None:
+            index_offset = -(-size // ALIGNMENT) * ALIGNMENT
+            size = index_offset + index.nbytes
+        generation = int.from_bytes(os.urandom(HEADER.size), 'big')
+        now = time.monotonic()
+        segment = self._reusable(size, now, generation)
+        if segment is None:
+            segment = _Segment(create=True, size=size)
+            segment.open_lock()
+            segment.generation = generation
+            _created.add(segment.name)
+            self.created += 1
+        else:
+            self.reused += 1
+        target = np.ndarray(values.shape, values.dtype, buffer=segment.buf,
+                            offset=ALIGNMENT)
+        np.copyto(target, values)
+        if index is not None:
+            np.copyto(np.ndarray(index.shape, index.dtype, buffer=segment.buf,
+                                 offset=index_offset), index)
+            descriptor['index'] = {'dtype': index.dtype.str,
+                                   'shape': list(index.shape),
+                                   'offset': index_offset}
+        del target
+        descriptor.update(name=segment.name, generation=generation,
+                          dtype=values.dtype.str, shape=list(values.shape),
+                          offset=ALIGNMENT)
+        with self._lock:
+            self._exported.append((now + self.lease, segment))
+        return bytes([SHARED_MEMORY]) + \
+            json.dumps(descriptor).encode('utf-8')
+
+    def close(self) -> None:
+        """Unlink all exported segments."""
+        with self._lock:
+            segments = [segment for _, segment in self._exported] + \
+                self._pool
+            self._exported, self._pool = [], []
+        for segment in segments:
+            _unlink(segment)
+
+    def _reusable(self, size: int, now: float,
+                  generation: int) -> Optional[_Segment]:
+        """
+        Pool the segments past their lease that no receiver holds (unlink
+        the others), and claim (see :func:`_claim`) a pooled segment of
+        ``size`` to ``2 * size`` bytes for ``generation``, if any.
+        """
+        unlink = []
+        with self._lock:
+            while self._exported and self._exported[0][0] <= now:
+                segment = self._exported.pop(0)[1]
+                if _in_use(segment):
+                    unlink.append(segment)
+                else:
+                    self._pool.append(segment)
+            found = None
+            for segment in self._pool:
+                if size <= segment.size <= 2 * size and \
+                        _claim(segment, generation):
+                    found = segment
+                    break
+            if found is not None:
+                self._pool.remove(found)
+            while len(self._pool) > self.pool_size:
+                unlink.append(self._pool.pop(0))
+        for segment in unlink:
+            _unlink(segment)
+        return found
+
+    ###########################################################################
+    # Receiver
+    # ========
+    def attach(self, data: bytes) -> Any:
+        """
+        Object described by ``data`` (a framed descriptor without its frame
+        byte), backed by the shared memory segment.
+
+        Raises
+        ------
+        ValueError
+            If the descriptor is invalid or the segment no longer exists.
+        """
+        import numpy as np
+
+        descriptor = _descriptor(data)
+        name = descriptor['name']
+        index = descriptor.get('index')
+        with self._lock:
+            mapping = self._mappings.get(name)
+            segment = None if mapping is None else mapping.segment
+            if segment is None:
+                try:
+                    segment = _attach(name)
+                except FileNotFoundError:
+                    raise ValueError(f'Shared memory segment {name} no '
+                                     'longer exists (lease expired?).')
+                except OSError as exception:
+                    raise ValueError(f'Cannot attach shared memory segment '
+                                     f'{name}: {exception}')
+            error = None
+            if segment.generation != descriptor['generation']:
+                error = f'Shared memory segment {name} was reused for a ' \
+                    'later payload (lease expired?).'
+            elif any(array[3] > segment.size
+                     for array in (descriptor['values'], index)
+                     if isinstance(array, tuple)):
+                error = 'Invalid shared memory descriptor (out of bounds).'
+            if error is not None:
+                if mapping is None:
+                    segment.close()
+                raise ValueError(error)
+            if mapping is None:
+                mapping = self._mappings[name] = _Mapping(segment)
+            mapping.references += 1
+        buffer = segment.buf
+        dtype, shape, offset, _ = descriptor['values']
+        values = np.ndarray(shape, dtype, buffer=buffer, offset=offset)
+        values.flags.writeable = False
+        weakref.finalize(values, self._release, name)
+        kind = descriptor['kind']
+        if kind == 'ndarray':
+            return values
+
+        import pandas as pd
+
+        if isinstance(index, tuple):
+            dtype, shape, offset, _ = index
+            index = np.ndarray(shape, dtype, buffer=buffer, offset=offset)
+            index.flags.writeable = False
+            with self._lock:
+                mapping.references += 1
+            weakref.finalize(index, self._release, name)
+        if kind == 'DataFrame':
+            return pd.DataFrame(values, index=index,
+                                columns=descriptor['columns'], copy=False)
+        return pd.Series(values, index=index,
+                         name=descriptor.get('series_name'), copy=False)
+
+    def _release(self, name: str) -> None:
+        with self._lock:
+            mapping = self._mappings[name]
+            mapping.references -= 1
+            if mapping.references:
+                return
+            del self._mappings[name]
+            # Called while the last array is being deallocated, i.e., before
+            # it releases the buffer: close the mapping on the next call.
+            self._closing.append(mapping.segment)
+            closing, self._closing = self._closing, []
+        for segment in closing:
+            try:
+                segment.close()
+            except BufferError:
+                with self._lock:
+                    self._closing.append(segment)
@@ -0,0 +1,309 @@
+# coding: utf-8
+"""
+Streaming routes: process large payloads as their chunks arrive.
+
+A handler registered with :meth:`BaseMqttReactor.addStreamRoute` is called
+on its own thread as ``handler(stream, args)`` as soon as the first chunk
+of a transfer (see :mod:`paho_mqtt_helpers.chunking`) arrives.  ``stream``
+is a :class:`ChunkStream`, an iterator over the (decompressed) payload
+bytes, fed through a bounded queue so a transfer is processed in constant
+memory.  With ``records`` set, the handler instead receives the JSON
+records under that :mod:`ijson` prefix (e.g., ``'item'`` for the elements
+of a top-level array), decoded incrementally.
+
+The MQTT loop thread never waits for a stream handler: if the handler
+falls ``queue_size`` chunks behind, the transfer is dropped and the
+handler's stream raises :class:`ValueError`, as it does when the payload is
+corrupt or decompresses to more than :attr:`Decompressor.max_size` bytes.
+Payloads sent without chunking are delivered as a stream of one chunk.
+"""
+import logging
+import queue
+import threading
+import time
+
+from typing import Callable, Optional
+
+from . import codec, envelope
+from .chunking import HEADER
+from .compression import Decompressor
+from .routes import Route
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+def _load_ijson():
+    try:
+        import ijson
+    except ImportError:
+        raise ValueError('Streaming records requires the ijson package.')
+    return ijson
+
+
+class StreamRoute(Route):
+    """Handler registered through :meth:`BaseMqttReactor.addStreamRoute`."""
+    __slots__ = ('records', 'queue_size', 'timeout')
+
+    def __init__(self, pattern: str, handler: Callable,
+                 records: Optional[str] = None, queue_size: int = 16,
+                 timeout: float = 60.) -> None:
+        super().__init__(pattern, handler)
+        if records is not None:
+            _load_ijson()
+        self.records = records
+        self.queue_size = queue_size
+        self.timeout = timeout
+
+    def __repr__(self) -> str:
+        return f'StreamRoute({self.pattern!r}, {self.handler!r})'
+
+
+class ChunkStream:
+    """
+    Iterator over the payload chunks of one transfer.
+
+    Also a minimal binary file object (:meth:`read`), e.g., for
+    :func:`ijson.items`.  Iterating raises :class:`TimeoutError` if no
+    chunk arrives for ``timeout`` seconds, and :class:`ValueError` if the
+    transfer is dropped (e.g., corrupt, out of order beyond repair, or the
+    consumer fell ``maxsize`` chunks behind, see :meth:`put`).
+    """
+
+    def __init__(self, topic: str, maxsize: int = 16,
+                 timeout: float = 60.) -> None:
+        self.topic = topic
+        self.timeout = timeout
+        self.maxsize = maxsize
+        # Unbounded: :meth:`put` bounds the chunks, while the end marker or
+        # an error always fits.
+        self._queue = queue.Queue()
+        self._closed = False
+        self._done = False
+        self._error = None
+        self._buffer = b''
+
+    def __iter__(self) -> 'ChunkStream':
+        return self
+
+    def __next__(self) -> bytes:
+        if self._done:
+            raise StopIteration
+        if self._error is not None:
+            # Aborted: skip the chunks still queued.
+            self._done = True
+            raise self._error
+        try:
+            item = self._queue.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f'No chunk on {self.topic} for '
+                               f'{self.timeout} s.')
+        if item is _END:
+            self._done = True
+            raise StopIteration
+        if isinstance(item, Exception):
+            self._done = True
+            raise item
+        return item
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            return self._buffer + b''.join(self)
+        while len(self._buffer) < size:
+            try:
+                self._buffer += next(self)
+            except StopIteration:
+                break
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self) -> None:
+        """Stop accepting chunks (the consumer is done)."""
+        self._closed = True
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    # Producer side (MQTT loop thread).
+    def put(self, data: bytes) -> None:
+        """
+        Queue ``data`` without waiting for the consumer.
+
+        Raises
+        ------
+        ValueError
+            If ``maxsize`` chunks are already queued; the stream must then
+            be aborted.
+        """
+        if self._closed:
+            return
+        if self._queue.qsize() >= self.maxsize:
+            raise ValueError(f'Stream handler for {self.topic} fell '
+                             f'{self.maxsize} chunks behind.')
+        self._queue.put(data)
+
+    def finish(self) -> None:
+        if not self._closed:
+            self._queue.put(_END)
+
+    def abort(self, exception: Exception) -> None:
+        """Make the consumer raise ``exception``."""
+        self._error = exception
+        if not self._closed:
+            # Wake up the consumer if it is waiting for a chunk.
+            self._queue.put(exception)
+
+
+class _StreamTransfer:
+    """Order chunks and strip frame headers for one stream."""
+
+    def __init__(self, stream: ChunkStream, decompressor: Decompressor,
+                 total: int, deadline: float, max_pending: int) -> None:
+        self.stream = stream
+        self.decompressor = decompressor
+        self.total = total
+        self.deadline = deadline
+        self.max_pending = max_pending
+        self.expected = 0
+        self.pending = {}
+        self.stamp = None
+        self._decompress = None
+        self._started = False
+
+    def add(self, offset: int, data: bytes) -> bool:
+        """Add a chunk; ``True`` once the transfer is complete."""
+        if offset < self.expected:
+            # Redelivered (QoS 1) chunk.
+            return False
+        if offset > self.expected:
+            if len(self.pending) >= self.max_pending:
+                raise ValueError('Too many out of order chunks.')
+            self.pending[offset] = data
+            return False
+        while True:
+            self._feed(data)
+            self.expected += len(data)
+            data = self.pending.pop(self.expected, None)
+            if data is None:
+                break
+        if self.expected < self.total:
+            return False
+        self._finish()
+        return True
+
+    def _feed(self, data: bytes) -> None:
+        if not self._started:
+            self._started = True
+            if data and data[0] == codec.ENVELOPE:
+                self.stamp, data = envelope.split(data[1:])
+            if data and data[0] == codec.COMPRESSED:
+                self._decompress, size = \
+                    self.decompressor.decompressobj(data[1:])
+                data = data[1 + size:]
+            if codec.is_framed(data):
+                raise ValueError(f'Unknown frame type: {data[0]:#x}')
+        if self._decompress is not None:
+            data = self._decompress.decompress(data)
+        if data:
+            self.stream.put(data)
+
+    def _finish(self) -> None:
+        if self._decompress is not None:
+            data = self._decompress.flush()
+            if data:
+                self.stream.put(data)
+        self.stream.finish()
+
+
+class StreamDispatcher:
+    """
+    Feed messages matching stream routes to their handlers' streams.
+
+    Parameters
+    ----------
+    decompressor : Decompressor
+        Used for compressed payloads.
+    max_pending : int
+        Out of order chunks buffered per transfer before it is dropped.
+    """
+
+    def __init__(self, decompressor: Decompressor,
+                 max_pending: int = 16) -> None:
+        self.decompressor = decompressor
+        self.max_pending = max_pending
+        #: Streams started, and dropped (corrupt, expired).
+        self.started = 0
+        self.dropped = 0
+        self._transfers = {}
+        self._next_expiry = 0.
+
+    def dispatch(self, route: StreamRoute, args: dict, topic: str,
+                 payload: bytes) -> None:
+        now = time.monotonic()
+        if now >= self._next_expiry:
+            self._expire(now)
+        if payload and payload[0] == codec.CHUNK:
+            transfer_id, offset, total = HEADER.unpack_from(payload, 1)
+            data = payload[1 + HEADER.size:]
+        else:
+            transfer_id, offset, total, data = None, 0, len(payload), payload
+        key = (topic, transfer_id)
+        transfer = self._transfers.get(key)
+        if transfer is None:
+            if offset > 0:
+                # Tail of a transfer dropped earlier (or started before we
+                # subscribed).
+                return
+            transfer = _StreamTransfer(self._open(route, args, topic),
+                                       self.decompressor, total,
+                                       now + route.timeout, self.max_pending)
+            self._transfers[key] = transfer
+        transfer.deadline = now + route.timeout
+        try:
+            done = transfer.add(offset, data)
+        except Exception as exception:
+            logger.error('Dropping stream on %s: %s', topic, exception)
+            self.dropped += 1
+            del self._transfers[key]
+            if not isinstance(exception, TimeoutError):
+                exception = ValueError(str(exception))
+            transfer.stream.abort(exception)
+            return
+        if done:
+            del self._transfers[key]
+
+    def _open(self, route: StreamRoute, args: dict,
+              topic: str) -> ChunkStream:
+        stream = ChunkStream(topic, maxsize=route.queue_size,
+                             timeout=route.timeout)
+        self.started += 1
+        threading.Thread(target=self._run, args=(route, stream, args),
+                         name=f'Stream {topic}', daemon=True).start()
+        return stream
+
+    def _run(self, route: StreamRoute, stream: ChunkStream,
+             args: dict) -> None:
+        try:
+            if route.records is None:
+                route.handler(stream, args)
+            else:
+                route.handler(_load_ijson().items(stream, route.records),
+                              args)
+        except Exception:
+            logger.exception('Error in stream handler for %s (%s).',
+                             route.pattern, stream.topic)
+        finally:
+            stream.close()
+
+    def _expire(self, now: float) -> None:
+        for key, transfer in list(self._transfers.items()):
+            if transfer.deadline <= now:
+                logger.warning('Dropping stalled stream on %s.', key[0])
+                self.dropped += 1
+                del self._transfers[key]
+                transfer.stream.abort(TimeoutError(f'Stream on {key[0]} '
+                                                   'stalled.'))
+        self._next_expiry = now + 1.
@@ -0,0 +1,113 @@
+# coding: utf-8
+"""
+Sampled tracing of the :meth:`BaseMqttReactor.on_message` hot path.
+
+A :class:`Tracer` selects one in every ``1 / sample_rate`` messages.  For a
+selected message the reactor reports each phase (``receive``,
+``route-match``, ``decode``, ``handler`` and ``publish`` for messages sent
+from the handler) to the :class:`Trace`, which calls any registered pre/post
+hooks and appends a timing span to a fixed-size ring buffer.  Messages that
+are not sampled cost one counter decrement.
+"""
+import collections
+import itertools
+import json
+import threading
+import time
+
+from typing import Callable, List, Optional
+
+PHASES = ('receive', 'route-match', 'decode', 'handler', 'publish')
+
+Span = collections.namedtuple('Span', 'trace_id phase topic start duration '
+                                      'thread')
+
+
+class Trace:
+    """Phases of one sampled message."""
+    __slots__ = ('tracer', 'trace_id', 'topic', '_starts')
+
+    def __init__(self, tracer: 'Tracer', trace_id: int, topic: str) -> None:
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.topic = topic
+        self._starts = {}
+
+    def enter(self, phase: str) -> None:
+        for hook in self.tracer.pre_hooks:
+            hook(phase, self)
+        self._starts[phase] = time.perf_counter()
+
+    def exit(self, phase: str) -> None:
+        end = time.perf_counter()
+        start = self._starts.pop(phase, end)
+        self.tracer.spans.append(Span(self.trace_id, phase, self.topic, start,
+                                      end - start, threading.get_ident()))
+        for hook in self.tracer.post_hooks:
+            hook(phase, self, end - start)
+
+    def event(self, phase: str) -> None:
+        """Record an instantaneous phase (e.g., ``receive``)."""
+        self.enter(phase)
+        self.exit(phase)
+
+
+class Tracer:
+    """
+    Parameters
+    ----------
+    sample_rate : float
+        Fraction of messages to trace (e.g., ``0.01`` for 1%).
+    capacity : int
+        Number of spans kept in the ring buffer.
+    """
+
+    def __init__(self, sample_rate: float = 0.01,
+                 capacity: int = 10000) -> None:
+        self.sample_rate = sample_rate
+        self.spans = collections.deque(maxlen=capacity)
+        #: ``hook(phase, trace)`` called before each traced phase.
+        self.pre_hooks = []
+        #: ``hook(phase, trace, duration)`` called after each traced phase.
+        self.post_hooks = []
+        self._interval = max(int(round(1 / sample_rate)), 1) \
+            if sample_rate > 0 else 0
+        self._countdown = self._interval
+        self._ids = itertools.count(1)
+        self._local = threading.local()
+
+    def add_hooks(self, pre: Callable = None, post: Callable = None) -> None:
+        if pre is not None:
+            self.pre_hooks.append(pre)
+        if post is not None:
+            self.post_hooks.append(post)
+
+    def sample(self, topic: str) -> Optional[Trace]:
+        """Return a :class:`Trace` if this message is selected."""
+        if not self._interval:
+            return None
+        self._countdown -= 1
+        if self._countdown > 0:
+            return None
+        self._countdown = self._interval
+        return Trace(self, next(self._ids), topic)
+
+    def current(self) -> Optional[Trace]:
+        """Trace of the message being handled on this thread, if any."""
+        return getattr(self._local, 'trace', None)
+
+    def activate(self, trace: Optional[Trace]) -> None:
+        self._local.trace = trace
+
+    def dump(self, clear: bool = False) -> List[dict]:
+        """Buffered spans as dictionaries (oldest first)."""
+        spans = [span._asdict() for span in list(self.spans)]
+        if clear:
+            self.spans.clear()
+        return spans
+
+    def dump_json(self, path: str, clear: bool = False) -> None:
+        """Write buffered spans to ``path`` as JSON lines."""
+        with open(path, 'w') as output:
+            for span in self.dump(clear=clear):
+                output.write(json.dumps(span) + '\n')
@@ -0,0 +1,130 @@
+# coding: utf-8
+"""
+Transport profiles for :class:`paho_mqtt_helpers.BaseMqttReactor`.
+
+A profile decides how the client socket is created and tuned, and how long
+the network loop may block waiting for traffic.
+
+- :class:`TcpProfile`: host/port TCP (the default, with OS socket defaults).
+- :data:`LOW_LATENCY_TCP`: TCP with ``TCP_NODELAY``, larger buffers and
+  kernel busy polling, for sub-millisecond round trips to a nearby broker.
+- :class:`UnixSocketProfile`: a co-located broker listening on a Unix domain
+  socket, skipping the TCP/IP stack entirely.
+
+Profiles hook into ``Client._create_socket_connection()`` and read the
+client's connection settings (``_host``, ``_connect_timeout``, ...): paho
+1.6 has no public API to supply the socket, hence the ``paho-mqtt<2``
+requirement.
+"""
+import logging
+import socket
+
+import paho.mqtt.client as mqtt
+
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+#: Linux ``SO_BUSY_POLL`` (not exported by the :mod:`socket` module).
+SO_BUSY_POLL = getattr(socket, 'SO_BUSY_POLL', 46)
+
+
+class TransportProfile:
+    """Base class; subclasses implement :meth:`create_connection`."""
+    #: Timeout (in seconds) passed to ``loop_forever()``.
+    loop_timeout = 1.0
+
+    def create_client(self, **kwargs) -> mqtt.Client:
+        """Create an MQTT client that connects through this profile."""
+        client = _ProfileClient(**kwargs)
+        client._transport_profile = self
+        return client
+
+    def create_connection(self, client: mqtt.Client) -> socket.socket:
+        raise NotImplementedError
+
+
+class TcpProfile(TransportProfile):
+    """
+    TCP connection to ``host:port``, opened by paho (so through the proxy
+    set with ``proxy_set()`` or the ``mqtt_proxy`` environment variable, if
+    any), then tuned.
+
+    Parameters
+    ----------
+    nodelay : bool
+        Disable Nagle's algorithm so small publishes are sent immediately.
+    sndbuf, rcvbuf : int, optional
+        Socket send/receive buffer sizes (bytes).
+    busy_poll : int, optional
+        ``SO_BUSY_POLL`` time in microseconds (Linux only).
+    loop_timeout : float
+        Timeout (in seconds) passed to ``loop_forever()``.
+    """
+
+    def __init__(self, nodelay: bool = False, sndbuf: Optional[int] = None,
+                 rcvbuf: Optional[int] = None,
+                 busy_poll: Optional[int] = None,
+                 loop_timeout: float = 1.0) -> None:
+        self.nodelay = nodelay
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+        self.busy_poll = busy_poll
+        self.loop_timeout = loop_timeout
+
+    def create_connection(self, client: mqtt.Client) -> socket.socket:
+        sock = mqtt.Client._create_socket_connection(client)
+        self.configure(sock)
+        return sock
+
+    def configure(self, sock: socket.socket) -> None:
+        if self.nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        if self.busy_poll:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, SO_BUSY_POLL,
+                                self.busy_poll)
+            except OSError:
+                # Not supported (or not permitted) on this platform.
+                logger.debug('SO_BUSY_POLL not available.', exc_info=True)
+
+
+class UnixSocketProfile(TransportProfile):
+    """
+    Connect to a broker listening on the Unix domain socket ``path``.
+
+    The reactor ``host``/``port`` (and any proxy) are ignored.
+    """
+
+    def __init__(self, path: str, loop_timeout: float = 1.0) -> None:
+        self.path = path
+        self.loop_timeout = loop_timeout
+
+    def create_connection(self, client: mqtt.Client) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(client._connect_timeout)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+
+#: Plain TCP with operating system defaults.
+DEFAULT_TCP = TcpProfile()
+#: TCP tuned for round trips to a nearby broker.
+LOW_LATENCY_TCP = TcpProfile(nodelay=True, sndbuf=1 << 20, rcvbuf=1 << 20,
+                             busy_poll=50, loop_timeout=0.01)
+
+
+class _ProfileClient(mqtt.Client):
+    """MQTT client whose socket is created by a :class:`TransportProfile`."""
+    _transport_profile = DEFAULT_TCP
+
+    def _create_socket_connection(self):
+        return self._transport_profile.create_connection(self)
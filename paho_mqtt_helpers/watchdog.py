@@ -0,0 +1,91 @@
+# coding: utf-8
+"""
+Detect route handlers that block the MQTT loop.
+
+A handler running in ``on_message`` blocks the paho loop, and the symptom
+is usually a keepalive timeout much later.  :class:`HandlerWatchdog` keeps
+track of the handler running on each thread and, from its own thread,
+reports any handler that runs past its route's threshold together with the
+handler thread's current stack.
+"""
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class HandlerWatchdog:
+    """
+    Parameters
+    ----------
+    threshold : float
+        Default time (in seconds) a handler may run before it is reported;
+        routes may override it (``addGetRoute(..., slow_threshold=...)``).
+    check_interval : float
+        How often (in seconds) running handlers are checked.
+    on_slow : callable, optional
+        Called as ``on_slow(event)`` for each slow handler, where ``event``
+        is a dictionary with ``route``, ``topic``, ``elapsed``, ``threshold``,
+        ``thread`` and ``stack`` (list of formatted frames).
+    """
+
+    def __init__(self, threshold: float = 1.0, check_interval: float = 0.1,
+                 on_slow: Optional[Callable] = None) -> None:
+        self.threshold = threshold
+        self.check_interval = check_interval
+        self.on_slow = on_slow
+        #: Number of slow handler events reported.
+        self.events = 0
+        # ``{thread id: [route, topic, start time, reported]}``.
+        self._active = {}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='HandlerWatchdog', daemon=True)
+
+    def start(self) -> 'HandlerWatchdog':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def enter(self, route, topic: str) -> None:
+        """Mark ``route``'s handler as running on the calling thread."""
+        self._active[threading.get_ident()] = [route, topic,
+                                               time.monotonic(), False]
+
+    def exit(self) -> None:
+        self._active.pop(threading.get_ident(), None)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.check_interval):
+            now = time.monotonic()
+            for thread_id, entry in list(self._active.items()):
+                route, topic, start, reported = entry
+                threshold = getattr(route, 'slow_threshold', None) or \
+                    self.threshold
+                if reported or now - start < threshold:
+                    continue
+                entry[3] = True
+                frame = sys._current_frames().get(thread_id)
+                if frame is None or self._active.get(thread_id) is not entry:
+                    # Handler returned in the meantime.
+                    continue
+                self.events += 1
+                event = {'route': route.pattern, 'topic': topic,
+                         'elapsed': now - start, 'threshold': threshold,
+                         'thread': thread_id,
+                         'stack': traceback.format_stack(frame)}
+                logger.warning('Handler for %s (%s) running for %.3f s:\n%s',
+                               event['route'], topic, event['elapsed'],
+                               ''.join(event['stack']))
+                if self.on_slow is not None:
+                    try:
+                        self.on_slow(event)
+                    except Exception:
+                        logger.exception('Error in slow handler callback.')
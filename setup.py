@@ -13,6 +13,6 @@ setup(name='paho-mqtt-helpers',
       author='Christian Fobel',
       author_email='christian@fobel.net',
       url='https://github.com/Lucaszw/paho-mqtt-helpers',
-      install_requires=['paho-mqtt', 'wheezy.routing', 'pandas-helpers',
-                        'mqtt-messages'],
+      install_requires=['paho-mqtt>=1.6,<2', 'wheezy.routing',
+                        'pandas-helpers', 'mqtt-messages'],
       packages=['paho_mqtt_helpers'])
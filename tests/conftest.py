@@ -0,0 +1,32 @@
+# coding: utf-8
+import time
+
+import pytest
+
+from paho_mqtt_helpers.broker import FakeBroker
+from paho_mqtt_helpers.engine import MqttSelectorEngine
+
+
+@pytest.fixture
+def broker():
+    with FakeBroker() as broker_:
+        yield broker_
+
+
+@pytest.fixture
+def engine():
+    engine_ = MqttSelectorEngine()
+    yield engine_
+    engine_.close()
+
+
+@pytest.fixture
+def run_until():
+    """``run_until(engine, condition)`` runs ``engine`` until ``condition()``
+    is true (or ``timeout`` seconds), and returns ``condition()``."""
+    def run_until_(engine, condition, timeout=5.):
+        end = time.monotonic() + timeout
+        while not condition() and time.monotonic() < end:
+            engine.run_once(0.05)
+        return condition()
+    return run_until_
@@ -0,0 +1,117 @@
+# coding: utf-8
+import json
+import os
+import time
+
+import pytest
+
+from paho_mqtt_helpers import codec
+from paho_mqtt_helpers.blobs import (BROKER, DISK, MISSING, BlobStore,
+                                     digest)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store_ = BlobStore('microdrop/blobs', json.loads, directory=str(tmp_path))
+    store_.threshold = 10
+    return store_
+
+
+def test_accepts(store):
+    assert not store.accepts(9)
+    assert store.accepts(10) and store.accepts(1000)
+    # Retained broker blobs cannot be chunked.
+    assert not store.accepts(1000, max_size=100)
+    store.store = DISK
+    assert store.accepts(1000, max_size=100)
+
+
+def test_broker_blob(store):
+    data = json.dumps({'a': list(range(10))}).encode('utf-8')
+    frame, topic = store.reference(data)
+    assert frame[0] == codec.BLOB
+    assert topic == f'microdrop/blobs/{digest(data).hex()}'
+    # Stored once.
+    assert store.reference(data) == (frame, None)
+
+    key, payload = store.lookup(frame[1:])
+    assert payload is MISSING
+    assert store.wait(key, 'message 1')
+    assert not store.wait(key, 'message 2')
+    assert store.is_blob_topic(topic)
+    assert not store.is_blob_topic('microdrop/blobsx/00')
+    assert store.resolve(topic, data) == ['message 1', 'message 2']
+    assert store.lookup(frame[1:]) == (key, {'a': list(range(10))})
+    assert (store.hits, store.misses) == (1, 1)
+
+
+def test_disk_blob(store):
+    store.store = DISK
+    data = b'[1, 2, 3, 4, 5, 6]'
+    frame, topic = store.reference(data)
+    assert topic is None
+    receiver = BlobStore('microdrop/blobs', json.loads,
+                         directory=store.directory)
+    assert receiver.lookup(frame[1:])[1] == [1, 2, 3, 4, 5, 6]
+    with pytest.raises(ValueError, match='not found'):
+        receiver.lookup(bytes([DISK]) + digest(b'other'))
+
+
+def test_digest_mismatch(store):
+    frame, topic = store.reference(b'[1, 2, 3, 4, 5, 6]')
+    with pytest.raises(ValueError, match='digest'):
+        store.resolve(topic, b'[1, 2, 3, 4, 5, 7]')
+
+
+def test_expire(store):
+    store.timeout = 0
+    key = digest(b'blob')
+    store.wait(key, 'message')
+    time.sleep(0.01)
+    assert store.expire() == [key]
+    assert not store.pending and store.expired == 1
+    assert store.expire() == []
+
+
+def test_reference_format(store):
+    frame, _ = store.reference(b'0123456789')
+    assert frame == bytes([codec.BLOB, BROKER]) + digest(b'0123456789')
+
+
+def test_cache_bytes_readded(store):
+    store.store = DISK
+    data = b'[1, 2, 3, 4, 5, 6]'
+    frame, _ = store.reference(data)
+    key, _ = store.lookup(frame[1:])
+    # The same blob cached again (e.g., its broker copy arrives).
+    store.resolve(store.topic(key), data)
+    assert store._cached_bytes == len(data) and len(store._cache) == 1
+
+
+def test_clean(store, tmp_path):
+    store.store = DISK
+    # Blobs are written again on each reference.
+    store.republish_interval = 0
+    old, new = b'[1, 2, 3, 4, 5, 6]', b'[7, 8, 9, 10, 11, 12]'
+    store.reference(old)
+    store.reference(new)
+    (tmp_path / f'{digest(b"x").hex()}.123.tmp').write_bytes(b'partial')
+    (tmp_path / 'other.txt').write_text('not a blob')
+    aged = time.time() - store.max_age - 10
+    for path in tmp_path.iterdir():
+        os.utime(path, (aged, aged))
+    # Referenced again: rewritten.
+    store.reference(new)
+    assert store.clean() == 2 and store.removed == 2
+    assert sorted(path.name for path in tmp_path.iterdir()) == \
+        sorted([digest(new).hex(), 'other.txt'])
+    receiver = BlobStore('microdrop/blobs', json.loads,
+                         directory=store.directory)
+    assert receiver.lookup(bytes([DISK]) + digest(new))[1] == \
+        [7, 8, 9, 10, 11, 12]
+
+
+def test_clean_missing_directory(tmp_path):
+    store = BlobStore('microdrop/blobs', json.loads,
+                      directory=str(tmp_path / 'missing'))
+    assert store.clean() == 0
@@ -0,0 +1,207 @@
+# coding: utf-8
+import queue
+import socket
+import struct
+import time
+
+import paho.mqtt.client as mqtt
+import pytest
+
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from paho_mqtt_helpers import broker as broker_module
+from paho_mqtt_helpers.broker import (CONNACK, CONNECT, PUBLISH, SUBACK,
+                                      SUBSCRIBE, decode_varint, topic_matches)
+
+
+def wait(condition, timeout: float = 5.) -> bool:
+    end = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+@pytest.fixture
+def clients(broker):
+    """``clients(client_id='', **kwargs)`` connects a looping client."""
+    started = []
+
+    def connect(client_id: str = '', protocol: int = mqtt.MQTTv311,
+                clean: bool = True, expiry: int = None) -> mqtt.Client:
+        if protocol == mqtt.MQTTv5:
+            client = mqtt.Client(client_id=client_id, protocol=protocol)
+        else:
+            client = mqtt.Client(client_id=client_id, clean_session=clean)
+        client.received = queue.Queue()
+        client.on_message = lambda client_, userdata, msg: \
+            client.received.put(msg)
+        connected = queue.Queue()
+        client.on_connect = lambda *args: connected.put(args[2])
+        kwargs = {}
+        if protocol == mqtt.MQTTv5:
+            properties = None
+            if expiry is not None:
+                properties = Properties(PacketTypes.CONNECT)
+                properties.SessionExpiryInterval = expiry
+            kwargs = {'clean_start': clean, 'properties': properties}
+        client.connect('127.0.0.1', broker.port, **kwargs)
+        client.loop_start()
+        client.flags = connected.get(timeout=5)
+        started.append(client)
+        return client
+
+    yield connect
+    for client in started:
+        client.disconnect()
+        client.loop_stop()
+
+
+def subscribe(client: mqtt.Client, topic: str, qos: int = 0) -> None:
+    acknowledged = queue.Queue()
+    client.on_subscribe = lambda *args: acknowledged.put(args)
+    client.subscribe(topic, qos=qos)
+    acknowledged.get(timeout=5)
+
+
+def test_topic_matches():
+    assert topic_matches('a/+/c', 'a/b/c')
+    assert not topic_matches('a/+', 'a/b/c')
+    assert topic_matches('a/#', 'a') and topic_matches('a/#', 'a/b/c')
+    assert topic_matches('#', 'a/b')
+    assert not topic_matches('#', '$SYS/uptime')
+    assert topic_matches('$SYS/#', '$SYS/uptime')
+
+
+def test_publish_subscribe(clients):
+    subscriber = clients()
+    subscribe(subscriber, 'test/+')
+    publisher = clients()
+    publisher.publish('test/a', b'1')
+    publisher.publish('other/a', b'2')
+    publisher.publish('test/b', b'3')
+    assert [subscriber.received.get(timeout=5).payload
+            for _ in range(2)] == [b'1', b'3']
+    assert subscriber.received.empty()
+
+
+def test_retained(broker, clients):
+    publisher = clients()
+    publisher.publish('test/state', b'on', qos=1,
+                      retain=True).wait_for_publish()
+    subscriber = clients()
+    subscribe(subscriber, 'test/#')
+    message = subscriber.received.get(timeout=5)
+    assert (message.topic, message.payload, message.retain) == \
+        ('test/state', b'on', True)
+    # An empty retained payload clears the topic.
+    publisher.publish('test/state', b'', qos=1, retain=True)
+    assert subscriber.received.get(timeout=5).payload == b''
+    assert wait(lambda: 'test/state' not in broker.retained)
+    late = clients()
+    subscribe(late, 'test/#')
+    with pytest.raises(queue.Empty):
+        late.received.get(timeout=0.2)
+
+
+def test_shared_subscription(clients):
+    members = [clients(), clients()]
+    for member in members:
+        subscribe(member, '$share/group/test/+')
+    publisher = clients()
+    for i in range(4):
+        publisher.publish('test/a', str(i).encode(), qos=1)
+    # Round robin within the group.
+    received = [[member.received.get(timeout=5).payload for _ in range(2)]
+                for member in members]
+    assert sorted(received[0] + received[1]) == [b'0', b'1', b'2', b'3']
+    assert all(member.received.empty() for member in members)
+
+
+def test_queued_while_offline(clients):
+    subscriber = clients('persistent', clean=False)
+    assert not subscriber.flags['session present']
+    subscribe(subscriber, 'test/queue', qos=1)
+    subscriber.disconnect()
+    subscriber.loop_stop()
+    publisher = clients()
+    publisher.publish('test/queue', b'queued', qos=1).wait_for_publish()
+    subscriber = clients('persistent', clean=False)
+    assert subscriber.flags['session present']
+    assert subscriber.received.get(timeout=5).payload == b'queued'
+
+
+class RawClient:
+    """MQTT 3.1.1 client that never acknowledges what it receives."""
+
+    def __init__(self, port: int, client_id: str) -> None:
+        self.socket = socket.create_connection(('127.0.0.1', port),
+                                               timeout=5)
+        body = broker_module._encode_str('MQTT') + bytes([4, 0]) + \
+            struct.pack('!H', 60) + broker_module._encode_str(client_id)
+        self.socket.sendall(broker_module._packet(CONNECT, body))
+        kind, _, body = self.read()
+        assert kind == CONNACK
+        self.session_present = bool(body[0] & 0x01)
+
+    def subscribe(self, filter_: str, qos: int) -> None:
+        body = struct.pack('!H', 1) + broker_module._encode_str(filter_) + \
+            bytes([qos])
+        self.socket.sendall(broker_module._packet(SUBSCRIBE, body, 0x02))
+        assert self.read()[0] == SUBACK
+
+    def read(self):
+        header = self._read(2)
+        data = header
+        while data[-1] & 0x80:
+            data += self._read(1)
+        length, _ = decode_varint(data, 1)
+        return header[0] >> 4, header[0] & 0x0f, self._read(length)
+
+    def _read(self, size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            chunk = self.socket.recv(size - len(data))
+            assert chunk, 'Connection closed.'
+            data += chunk
+        return data
+
+    def close(self) -> None:
+        self.socket.close()
+
+
+def test_redelivery_on_reconnect(broker, clients):
+    subscriber = RawClient(broker.port, 'raw')
+    subscriber.subscribe('test/redeliver', 1)
+    publisher = clients()
+    publisher.publish('test/redeliver', b'1', qos=1)
+    kind, flags, _ = subscriber.read()
+    assert kind == PUBLISH and not flags & 0x08
+    # Closed without acknowledging the message.
+    subscriber.close()
+    assert wait(lambda: broker.sessions['raw'].writer is None)
+    subscriber = RawClient(broker.port, 'raw')
+    try:
+        assert subscriber.session_present
+        kind, flags, body = subscriber.read()
+        # Sent again, with the DUP flag.
+        assert kind == PUBLISH and flags & 0x08 and body.endswith(b'1')
+    finally:
+        subscriber.close()
+
+
+@pytest.mark.parametrize('expiry', [None, 0, 3600])
+def test_session_expiry(broker, clients, expiry):
+    client = clients('mqtt5', protocol=mqtt.MQTTv5, clean=False,
+                     expiry=expiry)
+    subscribe(client, 'test/expiry', qos=1)
+    client.disconnect()
+    client.loop_stop()
+    # MQTT 5 sessions end on disconnect unless they have an expiry.
+    kept = bool(expiry)
+    assert wait(lambda: broker.sessions.get('mqtt5') is None or
+                broker.sessions['mqtt5'].writer is None)
+    assert ('mqtt5' in broker.sessions) == kept
+    client = clients('mqtt5', protocol=mqtt.MQTTv5, clean=False,
+                     expiry=expiry)
+    assert client.flags['session present'] == kept
@@ -0,0 +1,127 @@
+# coding: utf-8
+import time
+
+import paho.mqtt.client as mqtt
+import pytest
+
+from paho_mqtt_helpers.chunking import HEADER, ChunkSender, Reassembler
+from paho_mqtt_helpers.codec import CHUNK
+
+
+class Client:
+    """Records publishes; ``on_publish`` is called by the test."""
+
+    def __init__(self) -> None:
+        self.published = []
+
+    def publish(self, topic, payload, qos=0, properties=None):
+        info = mqtt.MQTTMessageInfo(len(self.published) + 1)
+        info.rc = mqtt.MQTT_ERR_SUCCESS
+        self.published.append((info.mid, payload))
+        return info
+
+
+def chunks(data: bytes, size: int, transfer_id: int = 1) -> list:
+    return [HEADER.pack(transfer_id, offset, len(data)) +
+            data[offset:offset + size] for offset in range(0, len(data), size)]
+
+
+def test_sender_window():
+    client = Client()
+    sender = ChunkSender(client, chunk_size=10, window=2)
+    data = bytes(range(45))
+    sender.send('test', data)
+    assert len(client.published) == 2 and sender.pending == 2
+    for i in range(5):
+        sender.on_publish(client, None, client.published[i][0])
+    assert sender.pending == 0
+    reassembler = Reassembler()
+    payloads = [payload for _, payload in client.published]
+    assert all(payload[0] == CHUNK for payload in payloads)
+    results = [reassembler.add('test', payload[1:]) for payload in payloads]
+    assert results[:-1] == [None] * 4 and results[-1] == data
+
+
+def test_sender_published_early():
+    # paho may report QoS 0 messages published before publish() returns.
+    client = Client()
+    sender = ChunkSender(client, chunk_size=10, window=1)
+    publish = client.publish
+
+    def publish_now(*args, **kwargs):
+        info = publish(*args, **kwargs)
+        sender.on_publish(client, None, info.mid)
+        return info
+
+    client.publish = publish_now
+    sender.send('test', bytes(30))
+    assert len(client.published) == 3 and sender.pending == 0
+
+
+def test_reassemble_out_of_order():
+    data = bytes(range(100))
+    parts = chunks(data, 30)
+    reassembler = Reassembler()
+    for part in reversed(parts[1:]):
+        assert reassembler.add('test', part) is None
+    # Redelivered chunk.
+    assert reassembler.add('test', parts[2]) is None
+    assert reassembler.in_use == len(data)
+    assert reassembler.add('test', parts[0]) == data
+    assert reassembler.in_use == 0 and reassembler.completed == 1
+
+
+def test_reassemble_interleaved():
+    reassembler = Reassembler()
+    a, b = chunks(b'a' * 20, 10, 1), chunks(b'b' * 20, 10, 2)
+    assert reassembler.add('test', a[0]) is None
+    assert reassembler.add('test', b[0]) is None
+    assert reassembler.add('other', a[0]) is None
+    assert reassembler.add('test', b[1]) == b'b' * 20
+    assert reassembler.add('test', a[1]) == b'a' * 20
+
+
+def test_chunk_beyond_total():
+    with pytest.raises(ValueError):
+        Reassembler().add('test', HEADER.pack(1, 90, 100) + bytes(20))
+
+
+def test_memory_limit():
+    reassembler = Reassembler(max_bytes=100)
+    parts = chunks(bytes(200), 50)
+    for part in parts:
+        assert reassembler.add('test', part) is None
+    assert reassembler.rejected == 1 and reassembler.in_use == 0
+
+
+def test_expiry():
+    reassembler = Reassembler(timeout=0.01)
+    parts = chunks(bytes(100), 50)
+    assert reassembler.add('test', parts[0]) is None
+    time.sleep(0.05)
+    # The transfer was dropped: its last chunk starts a new one.
+    assert reassembler.add('test', parts[1]) is None
+    assert reassembler.expired == 1 and reassembler.in_use == 100
+
+
+def test_reassemble_overlapping():
+    data = bytes(range(100))
+    reassembler = Reassembler()
+    # Overlapping chunks add up to the total size, with bytes 90-99 missing.
+    for start, end in ((0, 50), (20, 70), (40, 90)):
+        part = HEADER.pack(1, start, len(data)) + data[start:end]
+        assert reassembler.add('test', part) is None
+    # Duplicate chunks of another size.
+    assert reassembler.add('test', HEADER.pack(1, 0, 100) + data[:30]) is None
+    assert reassembler.add('test', HEADER.pack(1, 50, 100) + data[50:90]) \
+        is None
+    assert reassembler.add('test', HEADER.pack(1, 80, 100) + data[80:]) == \
+        data
+
+
+def test_periodic_expiry():
+    reassembler = Reassembler(timeout=0.01)
+    assert reassembler.add('test', chunks(bytes(100), 50)[0]) is None
+    time.sleep(0.05)
+    reassembler.expire()
+    assert reassembler.expired == 1 and reassembler.in_use == 0
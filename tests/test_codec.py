@@ -0,0 +1,107 @@
+# coding: utf-8
+import pytest
+
+from paho_mqtt_helpers import codec
+from paho_mqtt_helpers.codec import EncodeCache
+
+
+def test_is_framed():
+    assert codec.is_framed(bytes([codec.COMPRESSED]) + b'x')
+    assert not codec.is_framed(b'{"a": 1}')
+    assert not codec.is_framed(b'\t[1]')
+    assert not codec.is_framed(b'')
+
+
+def test_pre_encode():
+    encoded = codec.pre_encode({'ping': True})
+    assert isinstance(encoded, codec.Encoded)
+    assert codec.decode(encoded) == {'ping': True}
+
+
+@pytest.mark.parametrize('msg', ['ping', 1, 1.5])
+def test_encode_cache_by_value(msg):
+    cache = EncodeCache()
+    assert cache.encode(msg) == codec.encode(msg).encode('utf-8')
+    # An equal object of the same type hits the cache.
+    assert cache.encode(type(msg)(str(msg))) == cache.encode(msg)
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_encode_cache_exact_types():
+    cache = EncodeCache()
+    # Equal (and equally hashed) values of other types are not mixed up.
+    assert [cache.encode(msg) for msg in (1, 1.0, True)] == \
+        [b'1', b'1.0', b'true']
+    assert cache.misses == 3
+
+
+class _Label(str):
+    # Labels compare by their first letter.
+    def __eq__(self, other):
+        return self[:1] == other[:1]
+
+    def __hash__(self):
+        return hash(self[:1])
+
+
+def test_encode_cache_subclass():
+    cache = EncodeCache()
+    assert cache.encode(_Label('electrode1')) == b'"electrode1"'
+    assert cache.encode(_Label('electrode2')) == b'"electrode2"'
+
+
+def test_encode_cache_by_identity():
+    cache = EncodeCache()
+    state = {'a': [1]}
+    assert cache.encode(state) == b'{"a": [1]}'
+    assert cache.encode(state) == b'{"a": [1]}'
+    assert cache.hits == 1
+    # Tuples are hashable, but may hold mutable items.
+    items = [1]
+    cache.encode((0, items))
+    items.append(2)
+    assert cache.encode((0, items)) == b'[0, [1, 2]]'
+    assert cache.misses == 3
+
+
+def test_encode_cache_bounds():
+    cache = EncodeCache(max_entries=2)
+    for msg in ('a', 'b', 'c'):
+        cache.encode(msg)
+    assert len(cache) == 2
+    cache = EncodeCache(max_bytes=10)
+    cache.encode('x' * 20)
+    assert len(cache) == 0
+
+
+class _Helpers:
+    """Stands in for :mod:`pandas_helpers` (tags every object it sees)."""
+
+    @staticmethod
+    def pandas_object_hook(obj):
+        return dict(obj, hooked=True)
+
+
+def test_decode_object_hook(monkeypatch):
+    monkeypatch.setattr(codec, '_pandas_helpers', _Helpers)
+    # Every object of a payload holding a pandas object goes through the
+    # hook.
+    assert codec.decode(b'{"a": {"__type__": "DataFrame"}}') == \
+        {'a': {'__type__': 'DataFrame', 'hooked': True}, 'hooked': True}
+    assert codec.decode('[{"type": "Series"}]') == \
+        [{'type': 'Series', 'hooked': True}]
+    monkeypatch.setattr(codec, '_pandas_helpers', None)
+    # Other payloads do not load pandas_helpers.
+    assert codec.decode(b'{"a": 1, "index": [1, 2]}') == \
+        {'a': 1, 'index': [1, 2]}
+    assert codec.decode(b'[1, "x", 2.5]') == [1, 'x', 2.5]
+    assert codec._pandas_helpers is None
+
+
+def test_frame_round_trip():
+    pd = pytest.importorskip('pandas')
+    pytest.importorskip('pandas_helpers')
+    frame = pd.DataFrame({'x': [0.1, 2.5, -3.], 'electrode': [1, 2, 3],
+                          'id': ['e1', 'e2', 'e3']}, index=[10, 11, 12])
+    result = codec.decode(codec.encode({'frame': frame}))['frame']
+    pd.testing.assert_frame_equal(result, frame, check_dtype=False)
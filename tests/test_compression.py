@@ -0,0 +1,91 @@
+# coding: utf-8
+import zlib
+
+import pytest
+
+from paho_mqtt_helpers import codec
+from paho_mqtt_helpers.compression import (Compressor, Decompressor,
+                                           available, build_dictionary)
+
+DATA = b'{"electrodes": [' + b', '.join(b'"electrode%03d"' % i
+                                         for i in range(200)) + b']}'
+
+
+@pytest.mark.parametrize('name', available())
+def test_round_trip(name):
+    compressor = Compressor(name, threshold=100)
+    frame = compressor.compress(DATA)
+    assert frame[0] == codec.COMPRESSED and len(frame) < len(DATA)
+    assert Decompressor().decompress(frame[1:]) == DATA
+    # Small payloads are sent as they are.
+    assert compressor.compress(b'{"a": 1}') == b'{"a": 1}'
+
+
+def test_dictionary():
+    dictionary = build_dictionary([DATA])
+    compressor = Compressor('zlib', threshold=10, dictionary=dictionary)
+    frame = compressor.compress(DATA[:200] + b'"]}')
+    decompressor = Decompressor()
+    with pytest.raises(ValueError, match='dictionary'):
+        decompressor.decompress(frame[1:])
+    decompressor.add_dictionary(dictionary)
+    assert decompressor.decompress(frame[1:]) == DATA[:200] + b'"]}'
+
+
+@pytest.mark.parametrize('name', available())
+def test_max_size(name):
+    frame = Compressor(name, threshold=100).compress(DATA)
+    assert Decompressor(max_size=len(DATA)).decompress(frame[1:]) == DATA
+    with pytest.raises(ValueError, match='more than'):
+        Decompressor(max_size=len(DATA) - 1).decompress(frame[1:])
+    assert Decompressor(max_size=None).decompress(frame[1:]) == DATA
+
+
+def test_bomb():
+    frame = Compressor('zlib', threshold=100).compress(bytes(64 << 20))
+    assert len(frame) < 100 << 10
+    with pytest.raises(ValueError, match='more than'):
+        Decompressor(max_size=1 << 20).decompress(frame[1:])
+
+
+def incremental(decompressor, frame, size):
+    """Feed ``frame`` to an incremental decompressor ``size`` bytes at a
+    time."""
+    decompress, header = decompressor.decompressobj(frame[1:])
+    data = frame[1 + header:]
+    return b''.join(decompress.decompress(data[i:i + size])
+                    for i in range(0, len(data), size)) + decompress.flush()
+
+
+@pytest.mark.parametrize('name', available())
+def test_incremental_max_size(name):
+    frame = Compressor(name, threshold=100).compress(DATA)
+    assert incremental(Decompressor(max_size=len(DATA)), frame, 50) == DATA
+    with pytest.raises(ValueError, match='more than'):
+        incremental(Decompressor(max_size=len(DATA) - 1), frame, 50)
+    assert incremental(Decompressor(max_size=None), frame, 50) == DATA
+
+
+def test_incremental_bomb():
+    frame = Compressor('zlib', threshold=100).compress(bytes(64 << 20))
+    decompress, header = Decompressor(max_size=1 << 20).decompressobj(
+        frame[1:])
+    with pytest.raises(ValueError, match='more than'):
+        # A single call would otherwise inflate the whole payload.
+        decompress.decompress(frame[1 + header:])
+    assert decompress.size == (1 << 20) + 1
+
+
+def test_incremental_truncated():
+    frame = Compressor('zlib', threshold=100).compress(DATA)
+    with pytest.raises(ValueError, match='truncated'):
+        incremental(Decompressor(), frame[:-10], 50)
+
+
+def test_corrupt():
+    frame = Compressor('zlib', threshold=100).compress(DATA)
+    with pytest.raises(ValueError, match='Corrupt'):
+        Decompressor().decompress(frame[1:-10] + bytes(10))
+    with pytest.raises(ValueError, match='Unknown'):
+        Decompressor().decompress(b'\x09' + frame[2:])
+    assert zlib.decompress(frame[6:]) == DATA
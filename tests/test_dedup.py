@@ -0,0 +1,61 @@
+# coding: utf-8
+import pytest
+
+from paho_mqtt_helpers import dedup
+from paho_mqtt_helpers.dedup import PublishDeduplicator
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Fake ``time.monotonic()``; advance with ``clock[0] += seconds``."""
+    now = [1000.]
+    monkeypatch.setattr(dedup.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_identical_suppressed():
+    deduplicator = PublishDeduplicator()
+    assert not deduplicator.suppress('t', '{"a": 1}')
+    assert deduplicator.suppress('t', b'{"a": 1}')
+    assert (deduplicator.suppressed, deduplicator.suppressed_bytes) == (1, 8)
+    # Other payload, topic, retain flag or QoS.
+    assert not deduplicator.suppress('t', '{"a": 2}')
+    assert not deduplicator.suppress('u', '{"a": 2}')
+    assert not deduplicator.suppress('t', '{"a": 2}', retain=True)
+    assert not deduplicator.suppress('t', '{"a": 2}', retain=True, qos=1)
+    assert deduplicator.suppress('t', '{"a": 2}', retain=True, qos=1)
+    assert deduplicator.to_dict() == {'suppressed': 2, 'suppressed_bytes': 16}
+
+
+def test_max_interval(clock):
+    deduplicator = PublishDeduplicator(max_interval=10)
+    assert not deduplicator.suppress('t', 'x')
+    clock[0] += 9
+    assert deduplicator.suppress('t', 'x')
+    # Suppressed publishes do not postpone the next forced one.
+    clock[0] += 1
+    assert not deduplicator.suppress('t', 'x')
+    clock[0] += 5
+    assert deduplicator.suppress('t', 'x')
+
+
+def test_forget():
+    deduplicator = PublishDeduplicator()
+    for topic in 'abc':
+        deduplicator.suppress(topic, 'x')
+    deduplicator.forget('a')
+    assert not deduplicator.suppress('a', 'x')
+    assert deduplicator.suppress('b', 'x')
+    deduplicator.forget()
+    assert not deduplicator.suppress('b', 'x')
+    assert not deduplicator.suppress('c', 'x')
+
+
+def test_max_topics():
+    deduplicator = PublishDeduplicator(max_topics=2)
+    deduplicator.suppress('a', 'x')
+    deduplicator.suppress('b', 'x')
+    # Table full: cleared, then ``c`` remembered.
+    assert not deduplicator.suppress('c', 'x')
+    assert not deduplicator.suppress('a', 'x')
+    assert deduplicator.suppress('c', 'x')
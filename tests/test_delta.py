@@ -0,0 +1,108 @@
+# coding: utf-8
+import numpy as np
+import pytest
+
+from paho_mqtt_helpers import codec
+from paho_mqtt_helpers.delta import DeltaCodec, _snapshot, diff, patch
+
+
+def _codec():
+    requests = []
+    delta = DeltaCodec(requests.append, request_interval=0)
+    delta.keyframe_interval = 100
+    return delta, requests
+
+
+def _decode(delta, topic, frame):
+    assert frame[0] == codec.DELTA
+    return delta.decode(topic, frame[1:])
+
+
+def test_diff_patch():
+    old = {'a': 1, 'b': {'c': 2, 'd/e': 3}, 'f': [1], 'g~': 4}
+    new = {'a': 1, 'b': {'c': 5}, 'f': [1, 2], 'h': None, 'g~': 6}
+    operations = diff(old, new)
+    assert {'op': 'remove', 'path': '/b/d~1e'} in operations
+    assert {'op': 'replace', 'path': '/g~0', 'value': 6} in operations
+    assert patch(old, operations) == new
+    # Unpatched nested dictionaries are shared, patched ones are copies.
+    assert old['b'] == {'c': 2, 'd/e': 3}
+
+
+@pytest.mark.parametrize('operations', [
+    None, {}, 'x', [None], [{}], [{'op': 'move', 'path': '/a'}],
+    [{'op': 'add', 'path': '/a'}], [{'op': 'remove', 'path': 'a'}],
+    [{'op': 'remove', 'path': 1}], [{'op': 'add', 'path': '/a/b/c',
+                                     'value': 1}]])
+def test_invalid_patch(operations):
+    with pytest.raises(ValueError):
+        patch({'a': 1}, operations)
+
+
+def test_round_trip():
+    sender, _ = _codec()
+    receiver, _ = _codec()
+    states = [{'voltage': 100, 'electrodes': {'e1': True}},
+              {'voltage': 100, 'electrodes': {'e1': False, 'e2': True}},
+              {'voltage': 90, 'electrodes': {'e2': True}}]
+    for state in states:
+        assert _decode(receiver, 't', sender.encode('t', state)) == state
+    assert (sender.keyframes, sender.deltas, receiver.applied) == (1, 2, 2)
+
+
+def test_modified_in_place():
+    pd = pytest.importorskip('pandas')
+    state = {'list': [1, 2], 'array': np.zeros(3),
+             'frame': pd.DataFrame({'x': [1., 2.]}), 'same': np.ones(2)}
+    old = _snapshot(state)
+    assert diff(old, state) == []
+    state['list'].append(3)
+    state['array'][0] = 1
+    state['frame'].loc[0, 'x'] = 5.
+    assert sorted(operation['path'] for operation in diff(old, state)) == \
+        ['/array', '/frame', '/list']
+
+
+def test_lost_delta_requests_keyframe():
+    sender, _ = _codec()
+    receiver, requests = _codec()
+    _decode(receiver, 't', sender.encode('t', {'a': 1}))
+    sender.encode('t', {'a': 2})  # Lost.
+    assert _decode(receiver, 't', sender.encode('t', {'a': 3})) is None
+    assert requests == ['t'] and receiver.dropped == 1
+    state, _, _ = sender.keyframe_request('t')
+    assert _decode(receiver, 't', sender.encode('t', state)) == {'a': 3}
+
+
+@pytest.mark.parametrize('data', [b'', b'\x00', b'\x07' + bytes(12) + b'{}',
+                                  b'\x00' + bytes(12) + b'[]',
+                                  b'\x00' + bytes(12) + b'{'])
+def test_invalid_frame(data):
+    receiver, _ = _codec()
+    with pytest.raises(ValueError):
+        receiver.decode('t', data)
+
+
+def test_invalid_delta_body():
+    sender, _ = _codec()
+    receiver, _ = _codec()
+    _decode(receiver, 't', sender.encode('t', {'a': 1}))
+    frame = bytearray(sender.encode('t', {'a': 2}))
+    body = codec.encode({'op': 'replace'}).encode('utf-8')
+    with pytest.raises(ValueError):
+        _decode(receiver, 't', bytes(frame[:18]) + body)
+
+
+def test_redelivered_and_old_keyframes():
+    sender, _ = _codec()
+    receiver, _ = _codec()
+    keyframe = sender.encode('t', {'a': 1})
+    assert _decode(receiver, 't', keyframe) == {'a': 1}
+    assert _decode(receiver, 't', sender.encode('t', {'a': 2})) == {'a': 2}
+    # Redelivered (QoS 1) or reordered keyframe: the state stays current.
+    assert _decode(receiver, 't', keyframe) is None
+    assert _decode(receiver, 't', sender.encode('t', {'a': 3})) == {'a': 3}
+    assert receiver.dropped == 0
+    # Keyframes from another sender always apply.
+    other, _ = _codec()
+    assert _decode(receiver, 't', other.encode('t', {'b': 1})) == {'b': 1}
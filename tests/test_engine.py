@@ -0,0 +1,78 @@
+# coding: utf-8
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from paho_mqtt_helpers.engine import TimerWheel
+
+
+def _client(engine, broker, run_until, client_id, received=None):
+    client = mqtt.Client(client_id=client_id)
+    connected = threading.Event()
+    client.on_connect = lambda *args: connected.set()
+    if received is not None:
+        client.on_message = lambda client, userdata, msg: \
+            received.append(msg.payload)
+    client.connect(broker.host, broker.port)
+    engine.add(client)
+    assert run_until(engine, connected.is_set)
+    if received is not None:
+        subscribed = threading.Event()
+        client.on_subscribe = lambda *args: subscribed.set()
+        client.subscribe('engine/#')
+        assert run_until(engine, subscribed.is_set)
+    return client
+
+
+def test_timer_wheel():
+    wheel = TimerWheel(tick=0.01, slots=4)
+    fired = []
+    wheel.schedule(0.005, lambda: fired.append('a'))
+    # More than one round of the wheel.
+    wheel.schedule(0.1, lambda: fired.append('b'))
+    wheel.schedule(0.05, lambda: fired.append('c')).cancel()
+    assert len(wheel) == 3
+    wheel.advance(time.monotonic() + 0.02)
+    assert fired == ['a']
+    wheel.advance(time.monotonic() + 0.2)
+    assert fired == ['a', 'b']
+    assert len(wheel) == 0
+
+
+def test_unregister_write_race(broker, engine, run_until):
+    received = []
+    _client(engine, broker, run_until, 'subscriber', received)
+    publisher = _client(engine, broker, run_until, 'publisher')
+    # A publish from another thread queues its packet (and registers write
+    # interest) after ``loop_write()`` found the queue empty, but before
+    # paho calls ``on_socket_unregister_write``.
+    publisher.publish('engine/race', b'payload')
+    engine._on_socket_unregister_write(publisher, None, publisher.socket())
+    assert run_until(engine, lambda: received == [b'payload'])
+
+
+def test_publish_from_threads(broker, engine, run_until):
+    received = []
+    _client(engine, broker, run_until, 'subscriber', received)
+    publisher = _client(engine, broker, run_until, 'publisher')
+    thread = threading.Thread(target=engine.run_forever, daemon=True)
+    thread.start()
+
+    def publish(i):
+        for j in range(200):
+            publisher.publish('engine/threads', b'%d-%d' % (i, j))
+
+    publishers = [threading.Thread(target=publish, args=(i, ))
+                  for i in range(4)]
+    for publisher_thread in publishers:
+        publisher_thread.start()
+    for publisher_thread in publishers:
+        publisher_thread.join()
+    end = time.monotonic() + 5
+    while len(received) < 800 and time.monotonic() < end:
+        time.sleep(0.01)
+    engine.stop()
+    thread.join(5)
+    assert sorted(received) == sorted(b'%d-%d' % (i, j) for i in range(4)
+                                      for j in range(200))
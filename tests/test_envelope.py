@@ -0,0 +1,61 @@
+# coding: utf-8
+import time
+
+from paho_mqtt_helpers import envelope
+from paho_mqtt_helpers.envelope import (HOST_ID, Envelope, EnvelopeStamper,
+                                        SequenceTracker)
+
+
+def test_round_trip():
+    stamp = EnvelopeStamper('sender').stamp('test')
+    assert Envelope.from_bytes(stamp.to_bytes()) == stamp
+    assert Envelope.from_property(stamp.to_property()) == stamp
+    assert envelope.split(stamp.to_bytes() + b'body') == (stamp, b'body')
+
+
+def test_latency():
+    stamp = EnvelopeStamper('sender').stamp('test')
+    assert stamp.host == HOST_ID
+    assert 0 <= stamp.latency() < 1
+    # Other hosts: wall clock.
+    remote = stamp._replace(host=HOST_ID ^ 1, wall=time.time() - 10)
+    assert 10 <= remote.latency() < 11
+
+
+def test_host_id(monkeypatch, tmp_path):
+    boot_id = tmp_path / 'boot_id'
+    monkeypatch.setattr(envelope, 'BOOT_ID_PATH', str(boot_id))
+    assert envelope._host_id() == 0
+    boot_id.write_text('0b1e5c1e-7d3a-4a55-9f0e-2d5b3c1a8e77\n')
+    assert envelope._host_id() != 0
+    # Without a boot ID, latency always uses the wall clock.
+    monkeypatch.setattr(envelope, 'HOST_ID', 0)
+    stamp = Envelope(0, 1, 1, time.monotonic_ns() - 10 ** 10,
+                     time.time() - 20)
+    assert 20 <= stamp.latency() < 21
+
+
+def test_sequences():
+    stamper = EnvelopeStamper('sender')
+    assert [stamper.stamp(topic).seq for topic in 'aaba'] == [1, 2, 1, 3]
+    stamps = [stamper.stamp('c') for _ in range(5)]
+    tracker = SequenceTracker()
+    assert tracker.observe(stamps[0], 'c') == 0
+    assert tracker.observe(stamps[3], 'c') == 2
+    # Reordered or restarted.
+    assert tracker.observe(stamps[1], 'c') == 0
+    assert tracker.observe(stamps[2], 'other') == 0
+
+
+def test_sequence_tracker_bounded():
+    stamper = EnvelopeStamper('sender')
+    stamps = [stamper.stamp('a') for _ in range(3)]
+    tracker = SequenceTracker(capacity=2)
+    tracker.observe(stamps[0], 'a')
+    tracker.observe(stamps[0], 'b')
+    # "a" is now the most recently seen pair, "b" is evicted.
+    assert tracker.observe(stamps[1], 'a') == 0
+    tracker.observe(stamps[0], 'c')
+    assert len(tracker._last) == 2
+    assert tracker.observe(stamps[2], 'a') == 0
+    assert tracker.observe(stamps[2], 'b') == 0
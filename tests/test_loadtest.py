@@ -0,0 +1,29 @@
+# coding: utf-8
+import math
+
+import pytest
+
+from paho_mqtt_helpers import loadtest
+
+
+def test_percentile():
+    samples = [float(i) for i in range(1, 101)]
+    assert loadtest.percentile(samples, .5) == 51
+    assert loadtest.percentile(samples, .999) == 100
+    assert math.isnan(loadtest.percentile([], .5))
+
+
+@pytest.mark.parametrize('rate', [200, 0], ids=['open', 'closed'])
+def test_run(broker, rate):
+    result = loadtest.run(host='127.0.0.1', port=broker.port, clients=2,
+                          rate=rate, window=2, duration=0.5, warmup=0.1,
+                          drain=0.3)
+    assert result['sent'] > 0 and result['lost'] == 0
+    assert result['received'] == result['sent']
+    if rate:
+        # 200 pings/s for 0.5 s.
+        assert 50 <= result['sent'] <= 101
+    assert result['throughput_msgs_per_s'] == \
+        pytest.approx(result['received'] / result['seconds'])
+    assert 0 < result['p50_ms'] <= result['p99_ms'] <= result['p999_ms'] \
+        <= result['max_ms']
@@ -0,0 +1,23 @@
+# coding: utf-8
+from paho_mqtt_helpers.metrics import MetricsRegistry
+
+
+def test_prometheus_sum_exact():
+    registry = MetricsRegistry()
+    metrics = registry.route('test/{key}')
+    metrics.payload_bytes.observe(123456789)
+    metrics.payload_bytes.observe(1)
+    lines = registry.to_prometheus().splitlines()
+    assert 'mqtt_reactor_payload_bytes_sum{route="test/{key}"} 123456790.0' \
+        in lines
+
+
+def test_prometheus_bucket_bounds_exact():
+    registry = MetricsRegistry()
+    registry.route('test').payload_bytes.observe(1 << 20)
+    lines = registry.to_prometheus().splitlines()
+    # Power-of-two bounds beyond 6 significant digits are kept as is.
+    assert 'mqtt_reactor_payload_bytes_bucket{route="test",' \
+        'le="1048576.0"} 1' in lines
+    assert 'mqtt_reactor_decode_seconds_bucket{route="test",' \
+        'le="2.5e-05"} 0' in lines
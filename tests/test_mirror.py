@@ -0,0 +1,81 @@
+# coding: utf-8
+import pytest
+
+from paho_mqtt_helpers.mirror import StateMirror, TopicTrie
+
+TOPICS = ['a', 'a/b', 'a/b/c', 'a/c', 'a/b/d/e', 'b/b', '$SYS/a']
+
+
+@pytest.fixture
+def trie():
+    trie_ = TopicTrie()
+    for topic in TOPICS:
+        trie_.insert(topic, topic.upper())
+    return trie_
+
+
+@pytest.mark.parametrize('filter_, expected', [
+    ('a/b', ['a/b']),
+    ('a/x', []),
+    ('a/+', ['a/b', 'a/c']),
+    ('+/b', ['a/b', 'b/b']),
+    ('a/+/c', ['a/b/c']),
+    ('+/+/+', ['a/b/c']),
+    # ``#`` also matches the parent level.
+    ('a/#', ['a', 'a/b', 'a/b/c', 'a/b/d/e', 'a/c']),
+    ('a/b/#', ['a/b', 'a/b/c', 'a/b/d/e']),
+    ('+/b/#', ['a/b', 'a/b/c', 'a/b/d/e', 'b/b']),
+    # ``$`` topics only match explicitly.
+    ('#', [topic for topic in TOPICS if topic[0] != '$']),
+    ('+/a', []),
+    ('$SYS/#', ['$SYS/a']),
+])
+def test_match(trie, filter_, expected):
+    assert sorted(trie.match(filter_)) == \
+        sorted((topic, topic.upper()) for topic in expected)
+
+
+@pytest.mark.parametrize('topic, expected', [
+    ('a', False), ('a/b', True), ('a/b/c', True), ('a/x/c', True),
+    ('a/x', False), ('x/y/z', True), ('x/y', False)])
+def test_matches(topic, expected):
+    filters = TopicTrie()
+    for filter_ in ('a/b/#', 'a/+/c', '+/+/z'):
+        filters.insert(filter_, True)
+    assert filters.matches(topic) == expected
+
+
+def test_matches_all():
+    filters = TopicTrie()
+    filters.insert('#', True)
+    assert filters.matches('a') and filters.matches('a/b/c')
+
+
+def test_remove(trie):
+    trie.remove('a/b')
+    assert len(trie) == len(TOPICS) - 1
+    assert sorted(topic for topic, _ in trie.match('a/#')) == \
+        ['a', 'a/b/c', 'a/b/d/e', 'a/c']
+    trie.remove('a/b/d/e')
+    # Nodes without values or children are pruned.
+    assert 'd' not in trie._root.children['a'].children['b'].children
+    # Unknown topics and prefixes without values are ignored.
+    trie.remove('a/x')
+    trie.remove('a/b')
+    assert len(trie) == len(TOPICS) - 2
+    for topic in TOPICS:
+        trie.remove(topic)
+    assert len(trie) == 0 and not trie._root.children
+
+
+def test_mirror_limits():
+    mirror = StateMirror(['test/#'], max_topics=2, max_bytes=10)
+    mirror.update('test/a', 1, 4)
+    mirror.update('test/b', 2, 4)
+    mirror.update('test/a', 3, 4)
+    mirror.update('test/c', 4, 4)
+    # Least recently updated first.
+    assert mirror.query('test/#') == {'test/a': 3, 'test/c': 4}
+    assert mirror.evicted == 1 and mirror.nbytes == 8
+    mirror.update('test/a', None, 0)
+    assert mirror.query('#') == {'test/c': 4} and mirror.get('test/a') is None
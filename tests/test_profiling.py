@@ -0,0 +1,45 @@
+# coding: utf-8
+import math
+import tracemalloc
+
+import pytest
+
+from paho_mqtt_helpers.profiling import LIMITS, RemoteProfiler, parameter
+
+
+def test_parameter_clamped():
+    assert parameter({}, 'seconds', 10.) == 10.
+    assert parameter({'seconds': 1e9}, 'seconds', 10.) == LIMITS['seconds'][1]
+    assert parameter({'interval': 0}, 'interval', 0.005) == \
+        LIMITS['interval'][0]
+    top = parameter({'top': 1e6}, 'top', 50)
+    assert top == LIMITS['top'][1] and isinstance(top, int)
+
+
+@pytest.mark.parametrize('value', ['10', None, True, [1], math.nan])
+def test_parameter_invalid(value):
+    with pytest.raises(ValueError):
+        parameter({'seconds': value}, 'seconds', 10.)
+
+
+def test_snapshot_stops_tracing():
+    assert not tracemalloc.is_tracing()
+    profiler = RemoteProfiler()
+    result = profiler.snapshot(top=5)
+    assert len(result['top']) <= 5
+    assert not tracemalloc.is_tracing()
+    try:
+        profiler.snapshot(stop=False)
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+
+def test_snapshot_keeps_application_tracing():
+    tracemalloc.start()
+    try:
+        profiler = RemoteProfiler()
+        profiler.snapshot(top=5)
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
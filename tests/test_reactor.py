@@ -0,0 +1,462 @@
+# coding: utf-8
+import json
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+import pytest
+
+import paho_mqtt_helpers
+
+from paho_mqtt_helpers import BaseMqttReactor, codec
+from paho_mqtt_helpers.chunking import HEADER
+from paho_mqtt_helpers.broker import FakeBroker
+from paho_mqtt_helpers.recording import TrafficLog
+
+
+class Reactor(BaseMqttReactor):
+    def __init__(self, routes=(), streams=(), host='127.0.0.1',
+                 **kwargs) -> None:
+        self.routes = routes
+        self.stream_routes = streams
+        self.received = queue.Queue()
+        super().__init__(host=host, **kwargs)
+
+    def listen(self) -> None:
+        for route in self.routes:
+            self.addGetRoute(route, self.on_payload)
+        for route in self.stream_routes:
+            self.addStreamRoute(route, self.on_stream, queue_size=64)
+
+    def on_payload(self, payload, args) -> None:
+        self.received.put(payload)
+
+    def on_stream(self, stream, args) -> None:
+        """Queue the whole payload, or the error the stream raised."""
+        try:
+            self.received.put(b''.join(stream))
+        except Exception as exception:
+            self.received.put(exception)
+
+    def get(self, timeout: float = 5.):
+        return self.received.get(timeout=timeout)
+
+
+@pytest.fixture
+def reactors(broker, engine):
+    """
+    ``reactors(*routes, **kwargs)`` starts a :class:`Reactor` subscribed to
+    ``routes``, driven by ``engine`` on a background thread.
+    """
+    thread = threading.Thread(target=engine.run_forever, daemon=True)
+    thread.start()
+    started = []
+
+    def start(*routes, **kwargs) -> Reactor:
+        reactor = Reactor(routes, host=broker.host, port=broker.port,
+                          **kwargs)
+        subscribed = threading.Event()
+        acknowledged = []
+
+        def on_subscribe(*args):
+            acknowledged.append(args)
+            if len(acknowledged) == len(reactor.subscriptions):
+                subscribed.set()
+
+        reactor.mqtt_client.on_subscribe = on_subscribe
+        reactor.start(engine=engine)
+        started.append(reactor)
+        assert subscribed.wait(5)
+        return reactor
+
+    yield start
+    for reactor in started:
+        reactor.should_exit = True
+        reactor.mqtt_client.disconnect()
+    engine.stop()
+    thread.join(5)
+
+
+def test_engine_reconnect(monkeypatch, engine, run_until):
+    monkeypatch.setattr(paho_mqtt_helpers, 'RECONNECT_DELAY', 0.05)
+    broker = FakeBroker().start()
+    reactor = Reactor(port=broker.port)
+    reactor.start(engine=engine)
+    client = reactor.mqtt_client
+    assert run_until(engine, client.is_connected)
+    broker.stop()
+    assert run_until(engine, lambda: not client.is_connected())
+    # Reconnection attempts fail while the broker is down...
+    run_until(engine, lambda: False, timeout=0.3)
+    assert not client.is_connected()
+    # ...and go on until it is back.
+    broker.start()
+    try:
+        assert run_until(engine, client.is_connected)
+    finally:
+        reactor.should_exit = True
+        broker.stop()
+
+
+def test_lazy_imports():
+    # Feature modules load when enabled, pandas with the first pandas
+    # payload.
+    modules = ['pandas', 'pandas_helpers', 'cProfile', 'tracemalloc'] + \
+        [f'paho_mqtt_helpers.{name}' for name in
+         ('dedup', 'mirror', 'profiling', 'recording', 'sharedmem',
+          'streaming', 'tracing', 'watchdog')]
+    code = 'import sys, paho_mqtt_helpers; ' \
+        f'print([m for m in {modules!r} if m in sys.modules])'
+    output = subprocess.run([sys.executable, '-c', code], check=True,
+                            stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    assert output.strip() == '[]'
+
+
+###############################################################################
+# Routes and sessions
+# ===================
+def test_route_override():
+    reactor = Reactor()
+    first, second = [], []
+    reactor.addGetRoute('test/{key}', lambda payload, args: first.append(1))
+    reactor.addGetRoute('other/{key}', reactor.on_payload)
+    reactor.addGetRoute('test/{key}', lambda payload, args: second.append(1))
+    # Registering the same handler again (e.g., on reconnect) is a no-op.
+    reactor.addGetRoute('other/{key}', reactor.on_payload)
+    route, args = reactor.router.match('test/a')
+    route(None, args)
+    assert (first, second) == ([], [1]) and args['key'] == 'a'
+    assert reactor.subscriptions == ['test/+', 'other/+']
+    assert reactor.router.match('other/b')[0].handler == reactor.on_payload
+
+
+@pytest.mark.parametrize('protocol', [mqtt.MQTTv311, mqtt.MQTTv5],
+                         ids=['mqttv311', 'mqttv5'])
+def test_persistent_session(monkeypatch, reactors, protocol):
+    # Long enough for the message below to be sent while offline.
+    monkeypatch.setattr(paho_mqtt_helpers, 'RECONNECT_DELAY', 0.3)
+    receiver = reactors('test/session', persistent_session=True,
+                        protocol=protocol)
+    sender = reactors()
+    subscribed = []
+    receiver.subscribe = lambda: subscribed.append(1)
+    reconnected = threading.Event()
+    on_connect = receiver.on_connect
+
+    def on_reconnect(client, userdata, flags, *args):
+        on_connect(client, userdata, flags, *args)
+        reconnected.set()
+
+    receiver.mqtt_client.on_connect = on_reconnect
+    disconnected = threading.Event()
+    on_disconnect = receiver.mqtt_client.on_disconnect
+
+    def on_disconnected(*args):
+        disconnected.set()
+        on_disconnect(*args)
+
+    receiver.mqtt_client.on_disconnect = on_disconnected
+    receiver.mqtt_client.disconnect()
+    assert disconnected.wait(5)
+    # Queued by the broker while the receiver is offline.
+    sender.sendMessage('test/session', 'offline', qos=1)
+    assert reconnected.wait(5)
+    assert receiver.get() == 'offline'
+    # The broker resumed the session, subscriptions included.
+    assert not subscribed
+
+
+@pytest.mark.parametrize('base', ['microdrop', 'test'])
+def test_exit_topic(reactors, base):
+    # Independent of ``base``.
+    receiver = reactors(base=base)
+    topic = f'microdrop/{receiver.url_safe_plugin_name}/exit'
+    assert receiver.subscriptions.count(topic) == 1
+    exited = threading.Event()
+    receiver.mqtt_client.on_disconnect = lambda *args: exited.set()
+    reactors().sendMessage(topic, None)
+    assert exited.wait(5) and receiver.should_exit
+
+
+###############################################################################
+# Envelopes and chunking
+# ======================
+@pytest.mark.parametrize('protocol', [mqtt.MQTTv311, mqtt.MQTTv5],
+                         ids=['mqttv311', 'mqttv5'])
+def test_envelopes(reactors, protocol):
+    receiver = reactors('test/envelope', protocol=protocol)
+    metrics = receiver.enable_metrics().route('test/envelope')
+    sender = reactors(protocol=protocol)
+    sender.enable_envelopes()
+    for i in range(3):
+        sender.sendMessage('test/envelope', {'i': i})
+        assert receiver.get() == {'i': i}
+    assert metrics.latency_seconds.count == 3
+    assert metrics.sequence_gaps == 0
+
+
+def test_chunking(reactors):
+    receiver = reactors('test/{key}')
+    sender = reactors()
+    sender.enable_chunking(chunk_size=100, window=2)
+    payload = {'values': list(range(1000))}
+    sender.sendMessage('test/chunks', payload)
+    sender.sendMessage('test/small', 'small')
+    received = [receiver.get(), receiver.get()]
+    assert payload in received and 'small' in received
+    assert sender.chunker.transfers == 1
+    assert receiver.reassembler.completed == 1
+
+
+def test_stalled_transfer_expires(monkeypatch, reactors):
+    monkeypatch.setattr(paho_mqtt_helpers, 'CHUNK_EXPIRY_INTERVAL', 0.05)
+    receiver = reactors('test/{key}')
+    receiver.reassembler.timeout = 0.1
+    sender = reactors()
+    # Only the first chunk is ever sent.
+    sender.mqtt_client.publish('test/chunks', bytes([codec.CHUNK]) +
+                               HEADER.pack(1, 0, 1000) + bytes(100))
+    end = time.monotonic() + 5
+    while not receiver.reassembler.expired and time.monotonic() < end:
+        time.sleep(0.05)
+    assert receiver.reassembler.expired == 1
+    assert receiver.reassembler.in_use == 0
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_streaming(reactors, compressed):
+    receiver = reactors(streams=['test/stream/{key}'])
+    sender = reactors()
+    sender.enable_chunking(chunk_size=1000)
+    if compressed:
+        sender.enable_compression(threshold=100)
+    payload = {'values': [str(i) for i in range(5000)]}
+    sender.sendMessage('test/stream/a', payload)
+    assert json.loads(receiver.get()) == payload
+    assert receiver.streams.started == 1 and receiver.streams.dropped == 0
+
+
+def test_streaming_max_size(reactors):
+    receiver = reactors(streams=['test/stream/{key}'])
+    receiver.decompressor.max_size = 10000
+    sender = reactors()
+    sender.enable_chunking(chunk_size=1000)
+    sender.enable_compression(threshold=100)
+    sender.sendMessage('test/stream/a', {'values': ['x' * 100] * 1000})
+    error = receiver.get()
+    assert isinstance(error, ValueError) and 'more than' in str(error)
+    assert receiver.streams.dropped == 1
+
+
+###############################################################################
+# Blobs
+# =====
+def test_broker_blob(reactors):
+    receiver = reactors('test/blob')
+    sender = reactors()
+    sender.enable_blobs(threshold=100)
+    payload = {'values': list(range(100))}
+    for _ in range(2):
+        sender.sendMessage('test/blob', payload)
+        assert receiver.get() == payload
+    assert sender.blobs.stored == 1
+    # The first message is handled again once the blob arrives.
+    assert (receiver.blobs.misses, receiver.blobs.hits) == (1, 2)
+
+
+def test_blob_timeout(monkeypatch, reactors):
+    monkeypatch.setattr(paho_mqtt_helpers, 'BLOB_EXPIRY_INTERVAL', 0.05)
+    receiver = reactors('test/blob')
+    receiver.blobs.timeout = 0.1
+    sender = reactors()
+    sender.enable_blobs(threshold=100)
+    # Blob publish lost: the broker never gets it.
+    sender.mqtt_client.publish = lambda topic, *args, **kwargs: \
+        None if topic.startswith(sender.blobs.prefix) else \
+        type(sender.mqtt_client).publish(sender.mqtt_client, topic, *args,
+                                          **kwargs)
+    sender.sendMessage('test/blob', {'values': list(range(100))})
+    with pytest.raises(queue.Empty):
+        receiver.get(timeout=1)
+    assert receiver.blobs.expired == 1 and not receiver.blobs.pending
+
+
+def test_blob_larger_than_chunks(reactors):
+    receiver = reactors('test/blob')
+    sender = reactors()
+    sender.enable_blobs(threshold=100)
+    sender.enable_chunking(chunk_size=200)
+    payload = {'values': list(range(100))}
+    sender.sendMessage('test/blob', payload)
+    assert receiver.get() == payload
+    assert sender.blobs.references == 0
+
+
+###############################################################################
+# Publishing
+# ==========
+def test_send_error_exits_phases():
+    reactor = Reactor()
+    reactor.enable_phase_stats()
+    reactor.enable_tracing(sample_rate=1)
+    trace = reactor.tracer.sample('test/error')
+    reactor.tracer.activate(trace)
+    with pytest.raises(TypeError):
+        # Not JSON serializable.
+        reactor.sendMessage('test/error', object())
+    assert reactor.phase_stats._local.stack == []
+    assert not trace._starts
+    assert [span.phase for span in reactor.tracer.spans] == ['publish']
+
+
+def test_dedup():
+    reactor = Reactor()
+    published = []
+    reactor.mqtt_client.publish = \
+        lambda topic, payload, **kwargs: published.append((topic, payload))
+    reactor.sendMessage('test/state', {'a': 1})
+    deduplicator = reactor.enable_dedup()
+    for _ in range(3):
+        reactor.sendMessage('test/state', {'a': 1})
+    reactor.sendMessage('test/state', {'a': 2})
+    reactor.sendMessage('test/state', {'a': 2})
+    assert [payload for _, payload in published] == \
+        ['{"a": 1}', '{"a": 1}', '{"a": 2}']
+    assert deduplicator.suppressed == 3
+    # Receivers may have missed messages while disconnected.
+    reactor.on_connect(reactor.mqtt_client, None, {}, 0)
+    reactor.sendMessage('test/state', {'a': 2})
+    assert published[-1] == ('test/state', '{"a": 2}')
+    assert len(published) == 4
+
+
+###############################################################################
+# Tracing and watchdog
+# ====================
+def test_trace_propagates_to_publish():
+    reactor = Reactor()
+    reactor.enable_tracing(sample_rate=1)
+    active = []
+
+    def forward(payload, args):
+        active.append(reactor.tracer.current())
+        reactor.sendMessage('test/out', payload)
+
+    reactor.addGetRoute('test/in', forward)
+    message = mqtt.MQTTMessage(topic=b'test/in')
+    message.payload = b'{"a": 1}'
+    reactor.on_message(None, None, message)
+    trace, = active
+    assert trace is not None and trace.topic == 'test/in'
+    assert reactor.tracer.current() is None
+    spans = list(reactor.tracer.spans)
+    assert {span.trace_id for span in spans} == {trace.trace_id}
+    phases = [span.phase for span in spans]
+    assert set(phases) == {'receive', 'route-match', 'decode', 'handler',
+                           'publish'}
+    # The publish happens within the handler.
+    assert phases.index('publish') < phases.index('handler')
+
+
+def test_watchdog_reports_stalled_handler():
+    reactor = Reactor()
+    reactor.enable_metrics()
+    events = []
+    watchdog = reactor.enable_watchdog(threshold=10, check_interval=0.01)
+    watchdog.on_slow = events.append
+
+    def stall(payload, args):
+        time.sleep(0.5)
+
+    reactor.addGetRoute('test/slow', stall, slow_threshold=0.05)
+    reactor.addGetRoute('test/fast', lambda payload, args: None)
+    for topic in (b'test/fast', b'test/slow'):
+        message = mqtt.MQTTMessage(topic=topic)
+        message.payload = b'1'
+        reactor.on_message(None, None, message)
+    reactor.exit()
+    event, = events
+    assert (event['route'], event['topic']) == ('test/slow', 'test/slow')
+    assert event['threshold'] == 0.05 and event['elapsed'] >= 0.05
+    assert event['thread'] == threading.get_ident()
+    assert 'in stall' in event['stack'][-1]
+    assert watchdog.events == 1
+
+
+###############################################################################
+# Recording
+# =========
+def test_exit_stops_recording(tmp_path):
+    reactor = Reactor(['test/record'])
+    reactor.listen()
+    recorder = reactor.enable_recording(str(tmp_path))
+    message = mqtt.MQTTMessage(topic=b'test/record')
+    message.payload = b'{"a": 1}'
+    reactor.mqtt_client.on_message(reactor.mqtt_client, None, message)
+    reactor.exit()
+    assert recorder.closed
+    assert reactor.mqtt_client.on_message == reactor.on_message
+    # Messages dispatched while exiting are no longer recorded.
+    recorder.record('test/record', b'{}')
+    assert [record[1] for record in TrafficLog(str(tmp_path))] == \
+        ['test/record']
+    assert reactor.get() == {'a': 1}
+
+
+###############################################################################
+# Mirror
+# ======
+def test_mirror_keeps_last_valid_value(reactors):
+    receiver = reactors('test/state/{key}')
+    mirror = receiver.enable_mirror('test/state/+')
+    sender = reactors()
+    sender.sendMessage('test/state/a', {'a': 1})
+    assert receiver.get() == {'a': 1}
+    sender.mqtt_client.publish('test/state/a', b'{invalid')
+    assert receiver.get() is None
+    assert mirror.get('test/state/a') == {'a': 1}
+
+
+def test_mirror_cleared_retained(caplog, reactors):
+    receiver = reactors('test/state/{key}')
+    mirror = receiver.enable_mirror('test/state/+')
+    sender = reactors()
+    sender.sendMessage('test/state/a', {'a': 1}, retain=True)
+    assert receiver.get() == {'a': 1} and 'test/state/a' in mirror
+    # Clear the retained message.
+    sender.mqtt_client.publish('test/state/a', b'', retain=True)
+    assert receiver.get() is None
+    assert 'test/state/a' not in mirror and mirror.nbytes == 0
+    assert not [record for record in caplog.records
+                if record.levelname == 'ERROR']
+
+
+def test_mirror_fast_path():
+    reactor = Reactor(routes=('test/{key}',))
+    reactor.listen()
+    reactor.enable_mirror('test/state')
+    instrumented = []
+    reactor._on_message_instrumented = \
+        lambda msg, trace: instrumented.append(msg.topic)
+    for topic in ('test/other', 'test/state'):
+        msg = mqtt.MQTTMessage(topic=topic.encode())
+        msg.payload = b'1'
+        reactor.on_message(None, None, msg)
+    assert instrumented == ['test/state']
+    assert reactor.get() == 1
+
+
+###############################################################################
+# Profiling
+# =========
+def test_profiling_opt_in():
+    reactor = Reactor()
+    topic = reactor.plugin_topic('profile', 'start')
+    assert reactor.profiler is None and topic not in reactor.subscriptions
+    profiler = reactor.enable_profiling()
+    assert reactor.profiler is profiler and topic in reactor.subscriptions
+    assert reactor.enable_profiling() is profiler
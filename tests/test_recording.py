@@ -0,0 +1,134 @@
+# coding: utf-8
+import os
+
+import pytest
+
+from paho_mqtt_helpers.recording import (INDEX, RECORD, Recorder, TrafficLog,
+                                         replay)
+
+
+def record(directory, timestamps, **kwargs) -> None:
+    with Recorder(str(directory), **kwargs) as recorder:
+        for i, timestamp in enumerate(timestamps):
+            recorder.record(f'test/{i}', b'%d' % i, qos=i % 2,
+                            retain=i == 3, timestamp=timestamp)
+
+
+def files(directory, extension):
+    return sorted(name for name in os.listdir(directory)
+                  if name.endswith(extension))
+
+
+@pytest.fixture
+def segmented(tmp_path):
+    """40 records, timestamps 1 to 40, in segments of 4 records indexed
+    every other record."""
+    size = RECORD.size + len('test/10') + 2
+    record(tmp_path, range(1, 41), segment_bytes=4 * size - 1,
+           index_interval=2)
+    return tmp_path
+
+
+def test_round_trip(tmp_path):
+    record(tmp_path, [1., 2., 3., 4.])
+    assert list(TrafficLog(str(tmp_path))) == [
+        (1., 'test/0', b'0', 0, False), (2., 'test/1', b'1', 1, False),
+        (3., 'test/2', b'2', 0, False), (4., 'test/3', b'3', 1, True)]
+
+
+def test_segments(segmented):
+    logs = files(segmented, '.log')
+    assert len(logs) > 5 and files(segmented, '.idx') == \
+        [name[:-4] + '.idx' for name in logs]
+    # Segments roll over once they reach ``segment_bytes``.
+    limit = 4 * (RECORD.size + len('test/10') + 2) - 1
+    for name in logs[:-1]:
+        assert limit <= os.path.getsize(segmented / name) < limit + 29
+    assert os.path.getsize(segmented / '00000000.idx') == 3 * INDEX.size
+    assert [record[0] for record in TrafficLog(str(segmented))] == \
+        list(range(1, 41))
+
+
+@pytest.mark.parametrize('start, end', [(None, None), (1, 40), (0, 100),
+                                        (7.5, None), (None, 22.5), (8, 13),
+                                        (9, 9), (12.5, 12.7), (41, None)])
+def test_read_range(segmented, start, end):
+    expected = [timestamp for timestamp in range(1, 41)
+                if (start is None or timestamp >= start) and
+                (end is None or timestamp <= end)]
+    log = TrafficLog(str(segmented))
+    assert [record[0] for record in log.read(start, end)] == expected
+
+
+def test_read_equal_timestamps(tmp_path):
+    # The same timestamp spans several segments.
+    record(tmp_path, [1] + [2] * 10 + [3], segment_bytes=40,
+           index_interval=1)
+    assert len(files(tmp_path, '.log')) > 3
+    log = TrafficLog(str(tmp_path))
+    assert [record[0] for record in log.read(2)] == [2] * 10 + [3]
+    assert [record[0] for record in log.read(2, 2)] == [2] * 10
+
+
+def test_timestamps_non_decreasing(tmp_path):
+    record(tmp_path, [5., 3., 6.])
+    assert [record[0] for record in TrafficLog(str(tmp_path))] == \
+        [5., 5., 6.]
+
+
+def test_new_recorder_new_segment(tmp_path):
+    record(tmp_path, [1., 2.])
+    record(tmp_path, [3.])
+    assert files(tmp_path, '.log') == ['00000000.log', '00000001.log']
+    assert [record[0] for record in TrafficLog(str(tmp_path))] == \
+        [1., 2., 3.]
+
+
+def test_truncated_record(tmp_path):
+    record(tmp_path, [1., 2., 3.])
+    path = tmp_path / '00000000.log'
+    size = os.path.getsize(path)
+    for truncated in (size - 1, size - 2 - len('test/2'), size - 2 - 20):
+        os.truncate(path, truncated)
+        assert [record[0] for record in TrafficLog(str(tmp_path))] == \
+            [1., 2.]
+
+
+def test_closed_recorder_ignores_records(tmp_path):
+    recorder = Recorder(str(tmp_path))
+    recorder.close()
+    assert recorder.closed
+    recorder.record('test', b'1')
+    recorder.flush()
+    assert recorder.records == 0 and list(TrafficLog(str(tmp_path))) == []
+
+
+class Sink:
+    mqtt_client = None
+
+    def __init__(self) -> None:
+        self.messages = []
+
+    def on_message(self, client, userdata, message) -> None:
+        self.messages.append((message.topic, message.payload, message.qos,
+                              message.retain))
+
+
+def test_replay(segmented):
+    sink = Sink()
+    result = replay(TrafficLog(str(segmented)), sink, speed=None, start=2,
+                    end=5)
+    assert result['messages'] == 4
+    assert sink.messages == [('test/1', b'1', 1, False),
+                             ('test/2', b'2', 0, False),
+                             ('test/3', b'3', 1, True),
+                             ('test/4', b'4', 0, False)]
+
+
+def test_replay_speed(tmp_path):
+    record(tmp_path, [100., 100.5, 101.])
+    sink = Sink()
+    result = replay(TrafficLog(str(tmp_path)), sink, speed=5)
+    assert len(sink.messages) == result['messages'] == 3
+    # One second of traffic at 5x.
+    assert 0.2 <= result['seconds'] < 0.4
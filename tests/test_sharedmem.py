@@ -0,0 +1,82 @@
+# coding: utf-8
+import gc
+import json
+
+import numpy as np
+import pytest
+
+from paho_mqtt_helpers import codec
+from paho_mqtt_helpers.sharedmem import SharedMemoryStore, fcntl
+
+
+@pytest.fixture
+def store():
+    store_ = SharedMemoryStore(lease=0)
+    yield store_
+    store_.close()
+
+
+def _export(store, obj):
+    frame = store.export(obj)
+    assert frame[0] == codec.SHARED_MEMORY
+    return frame[1:]
+
+
+def test_round_trip(store):
+    pd = pytest.importorskip('pandas')
+    array = np.arange(12.).reshape(3, 4)
+    result = store.attach(_export(store, array))
+    np.testing.assert_array_equal(result, array)
+    assert not result.flags.writeable
+    frame = pd.DataFrame({'a': [1., 2.], 'b': [3., 4.]}, index=[10, 20])
+    pd.testing.assert_frame_equal(store.attach(_export(store, frame)), frame)
+    series = pd.Series([1, 2, 3], index=['x', 'y', 'z'], name='s')
+    pd.testing.assert_series_equal(store.attach(_export(store, series)),
+                                   series)
+
+
+def test_release(store):
+    result = store.attach(_export(store, np.arange(10)))
+    assert store.attached == 1
+    del result
+    gc.collect()
+    assert store.attached == 0
+
+
+@pytest.mark.skipif(fcntl is None, reason='Segments are never reused.')
+def test_reused_segment(store):
+    stale = _export(store, np.arange(1000))
+    fresh = _export(store, np.arange(1000) * 2)
+    assert store.reused == 1
+    assert json.loads(stale)['name'] == json.loads(fresh)['name']
+    with pytest.raises(ValueError, match='reused'):
+        store.attach(stale)
+    np.testing.assert_array_equal(store.attach(fresh), np.arange(1000) * 2)
+
+
+@pytest.mark.skipif(fcntl is None, reason='Segments are never reused.')
+def test_held_segment_not_reused(store):
+    held = store.attach(_export(store, np.arange(1000)))
+    _export(store, np.arange(1000) * 2)
+    assert store.reused == 0
+    np.testing.assert_array_equal(held, np.arange(1000))
+
+
+@pytest.mark.parametrize('change', [
+    {'name': None}, {'name': '../x'}, {'generation': '1'},
+    {'kind': 'list'}, {'dtype': 'not a dtype'}, {'dtype': '|O'},
+    {'shape': 10}, {'shape': [-1]}, {'offset': 0}, {'offset': 1.5},
+    {'shape': [1 << 40]}, {'kind': 'DataFrame', 'columns': None}])
+def test_invalid_descriptor(store, change):
+    descriptor = json.loads(_export(store, np.arange(10)))
+    descriptor.update(change)
+    with pytest.raises(ValueError):
+        store.attach(json.dumps(descriptor).encode('utf-8'))
+    assert store.attached == 0
+
+
+@pytest.mark.parametrize('data', [b'', b'[]', b'{}', b'\xff',
+                                  b'{"name": "x"}'])
+def test_malformed_descriptor(store, data):
+    with pytest.raises(ValueError):
+        store.attach(data)
@@ -0,0 +1,68 @@
+# coding: utf-8
+import queue
+import threading
+import time
+
+import pytest
+
+from paho_mqtt_helpers import codec
+from paho_mqtt_helpers.chunking import HEADER
+from paho_mqtt_helpers.compression import Compressor, Decompressor
+from paho_mqtt_helpers.streaming import (ChunkStream, StreamDispatcher,
+                                         StreamRoute)
+
+
+def chunk(transfer_id: int, offset: int, total: int, data: bytes) -> bytes:
+    return bytes([codec.CHUNK]) + HEADER.pack(transfer_id, offset, total) + \
+        data
+
+
+def test_put_full():
+    stream = ChunkStream('test', maxsize=1, timeout=0.1)
+    stream.put(b'a')
+    with pytest.raises(ValueError, match='behind'):
+        stream.put(b'b')
+    # The end of the stream always fits.
+    stream.finish()
+    assert list(stream) == [b'a']
+
+
+def test_stalled_handler_dropped():
+    release = threading.Event()
+    errors = queue.Queue()
+
+    def handler(stream, args):
+        release.wait(5)
+        try:
+            list(stream)
+        except Exception as exception:
+            errors.put(exception)
+
+    route = StreamRoute('test', handler, queue_size=1, timeout=5)
+    dispatcher = StreamDispatcher(Decompressor())
+    start = time.monotonic()
+    # The first chunk fills the queue; the second one does not fit.
+    dispatcher.dispatch(route, {}, 'test', chunk(1, 0, 8, b'payl'))
+    dispatcher.dispatch(route, {}, 'test', chunk(1, 4, 8, b'oad!'))
+    assert time.monotonic() - start < 1
+    assert dispatcher.dropped == 1
+    release.set()
+    assert isinstance(errors.get(timeout=5), ValueError)
+
+
+def test_max_size():
+    results = queue.Queue()
+
+    def handler(stream, args):
+        try:
+            results.put(b''.join(stream))
+        except Exception as exception:
+            results.put(exception)
+
+    route = StreamRoute('test', handler)
+    dispatcher = StreamDispatcher(Decompressor(max_size=1 << 20))
+    frame = Compressor(threshold=100).compress(bytes(16 << 20))
+    dispatcher.dispatch(route, {}, 'test', frame)
+    assert dispatcher.dropped == 1
+    error = results.get(timeout=5)
+    assert isinstance(error, ValueError) and 'more than' in str(error)
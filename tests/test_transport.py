@@ -0,0 +1,36 @@
+# coding: utf-8
+import socket
+
+import paho.mqtt.client as mqtt
+
+from paho_mqtt_helpers.transport import LOW_LATENCY_TCP
+
+
+def test_low_latency_tcp(broker):
+    client = LOW_LATENCY_TCP.create_client(client_id='test')
+    client.connect(broker.host, broker.port)
+    try:
+        sock = client.socket()
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+    finally:
+        client.disconnect()
+
+
+def test_tcp_connects_through_paho(monkeypatch, broker):
+    # paho opens the connection, so its proxy support applies.
+    opened = []
+
+    def create_socket_connection(client):
+        opened.append(client)
+        return socket.create_connection((client._host, client._port))
+
+    monkeypatch.setattr(mqtt.Client, '_create_socket_connection',
+                        create_socket_connection)
+    client = LOW_LATENCY_TCP.create_client(client_id='test')
+    client.connect(broker.host, broker.port)
+    try:
+        assert opened == [client]
+        assert client.socket().getsockopt(socket.IPPROTO_TCP,
+                                          socket.TCP_NODELAY)
+    finally:
+        client.disconnect()